@@ -1,27 +1,30 @@
-from sim_controller import load_h5_data
+from sim_controller import read_h5_dataset
 import numpy as np
-import yt
 import os
+import re
+import glob
 import warnings
 import h5py
 
 
 def load_cnop(filename, solution_file=None, bbox=None):
-    f = load_h5_data(filename)
-
-    if solution_file is not None:
-        ds_solution = yt.load(solution_file)
-        dims = ds_solution.domain_dimensions
-        bbox = np.array([ds_solution.domain_left_edge, ds_solution.domain_right_edge]).T
-        warnings.warn("Solution file is provided, bbox is ignored.")
-    else:
-        dims = f["method"]["u_pert_best"].shape
-        if bbox is None:
-            bbox = np.array([[0., 1.], [0., 1.], [0., 1.]])
+    # yt is only needed for the datasets, so that the checkpoints can be read without it
+    import yt
+
+    with h5py.File(filename, 'r') as f:
+        if solution_file is not None:
+            ds_solution = yt.load(solution_file)
+            dims = ds_solution.domain_dimensions
+            bbox = np.array([ds_solution.domain_left_edge, ds_solution.domain_right_edge]).T
+            warnings.warn("Solution file is provided, bbox is ignored.")
+        else:
+            dims = f["method"]["u_pert_best"].shape
+            if bbox is None:
+                bbox = np.array([[0., 1.], [0., 1.], [0., 1.]])
 
-    data_dict, parameters_dict = {}, {}
-    load_group_data(f, "process", dims, data_dict, parameters_dict)
-    load_group_data(f, "method", dims, data_dict, parameters_dict)
+        data_dict, parameters_dict = {}, {}
+        load_group_data(f, "process", dims, data_dict, parameters_dict)
+        load_group_data(f, "method", dims, data_dict, parameters_dict)
 
     sim_time = 0
     path, dataset_name = os.path.split(filename)
@@ -32,24 +35,127 @@ def load_cnop(filename, solution_file=None, bbox=None):
 
 
 def load_group_data(file, group, dims, data_dict, parameter_dict):
+    # file is an open h5py.File; only the fields with dimension of dims are mapped, the rest are read as parameters
     for field in file[group].keys():
         field_unit = "dimensionless"
 
-        try:
-            if np.array_equal(file[group][field][...].shape, dims):
-                field_data = np.array(file[group][field])
-                data_dict[("gas", field)] = (field_data[...], field_unit)
-                print("%s field loaded with unit of %s" % (field, field_unit))
-            else:
-                # Send field_data to parameter_dict if it is not a field with dimension of dims
-                raise TypeError
-        except TypeError:
-            parameter_dict[field] = file[group][field]
+        if np.array_equal(file[group][field].shape, dims):
+            data_dict[("gas", field)] = (read_field(file[group][field]), field_unit)
+            print("%s field loaded with unit of %s" % (field, field_unit))
+        else:
+            # Send field_data to parameter_dict if it is not a field with dimension of dims
+            parameter_dict[field] = read_h5_dataset(file[group][field])
     return
 
 
+def map_field(dataset):
+    """
+    Memory-map a contiguous and uncompressed dataset of a checkpoint file, so that only the accessed part is read
+    :param dataset: the h5py dataset
+    :return: the read-only np.memmap, or None if the dataset is chunked, compressed or not allocated
+    """
+    offset = dataset.id.get_offset()
+    if dataset.chunks is not None or offset is None:
+        return None
+    return np.memmap(dataset.file.filename, mode='r', dtype=dataset.dtype, shape=dataset.shape, offset=offset)
+
+
+def read_field(dataset):
+    # memory-map the field if possible, otherwise (e.g., compressed) read it
+    field_data = map_field(dataset)
+    if field_data is None:
+        field_data = dataset[()]
+    return field_data
+
+
+class CheckpointSeries:
+    def __init__(self, base_dir, prefix="Flash_checkpoint"):
+        """
+        Lazy index of the checkpoint series "<prefix>_NNNN.h5" written by the CNOP methods. Files are only opened
+        when their data is accessed, the scalars are collected into a table across iterations, and the fields are
+        memory-mapped (or read chunk by chunk if compressed).
+        :param base_dir: the directory of the checkpoint files
+        :param prefix: prefix of the checkpoint files, e.g., "Flash_checkpoint" or "Flash_checkpoint_search_0"
+        """
+        pattern = re.compile(re.escape(prefix) + r"_(\d+)\.h5$")
+        files = {}
+        for fn in glob.glob(os.path.join(base_dir, prefix + "_*.h5")):
+            match = pattern.search(os.path.basename(fn))
+            if match is not None:
+                files[int(match.group(1))] = fn
+        if len(files) == 0:
+            raise FileNotFoundError("No checkpoint file found.")
+        self.iterations = np.array(sorted(files.keys()))
+        self.filenames = [files[i] for i in self.iterations]
+        self._scalars = {}
+        return
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def filename(self, iteration):
+        index = np.searchsorted(self.iterations, iteration)
+        if index == len(self.iterations) or self.iterations[index] != iteration:
+            raise KeyError("No checkpoint file for iteration {}.".format(iteration))
+        return self.filenames[index]
+
+    def scalars(self, names=("j_val", "j_best", "cgnorm", "lambda_", "ifcnt", "igcnt"), group="method"):
+        """
+        Table of scalars across iterations, only the requested datasets are read and each is read once
+        :param names: names of the scalar attributes
+        :param group: "method" or "process"
+        :return: structured array with the field "iter0" and one field per name (NaN if missing in a file)
+        """
+        missing = [name for name in dict.fromkeys(names) if (group, name) not in self._scalars]
+        values = {name: np.full(len(self), np.nan) for name in missing}
+        if len(missing) > 0:
+            # each file is opened once for all the missing names
+            for i, fn in enumerate(self.filenames):
+                with h5py.File(fn, 'r') as f:
+                    for name in missing:
+                        if name in f[group]:
+                            values[name][i] = np.squeeze(f[group][name][()])
+        for name in missing:
+            self._scalars[(group, name)] = values[name]
+        table = np.empty(len(self), dtype=[("iter0", int)] + [(name, float) for name in names])
+        table["iter0"] = self.iterations
+        for name in names:
+            table[name] = self._scalars[(group, name)]
+        return table
+
+    def field(self, iteration, name="u_pert_best", group="method"):
+        """
+        Access a field of one checkpoint without loading the whole file
+        :param iteration: the iteration (iter0) of the checkpoint
+        :param name: name of the field, e.g., "u_pert", "u_pert_best" or "g"
+        :param group: "method" or "process"
+        :return: np.memmap if possible, otherwise the array read from the (compressed) dataset
+        """
+        with h5py.File(self.filename(iteration), 'r') as f:
+            return read_field(f[group][name])
+
+    def load_yt(self, iteration, names=("u_pert", "u_pert_best", "g"), bbox=None):
+        """
+        Build a yt dataset of the fields of one checkpoint; memory-mapped fields are passed to yt without copying
+        :param iteration: the iteration (iter0) of the checkpoint
+        :param names: names of the fields in the method group
+        :param bbox: bounding box of the domain, the unit cube by default
+        :return: yt dataset
+        """
+        import yt
+
+        data_dict = {("gas", name): (self.field(iteration, name=name), "dimensionless") for name in names}
+        dims = data_dict[("gas", names[0])][0].shape
+        if bbox is None:
+            bbox = np.array([[0., 1.], [0., 1.], [0., 1.]])
+        dataset_name = os.path.basename(self.filename(iteration))
+        return yt.load_uniform_grid(data_dict, dims, bbox=bbox, sim_time=0, geometry="cartesian",
+                                    dataset_name=dataset_name)
+
+
 def extract_u_pert(filename, u_pert_fn="u_pert.h5", u_pert_name="u_pert_best"):
-    f_check = load_h5_data(filename)
-    with h5py.File(u_pert_fn, 'w') as f:
-        f.create_dataset('u_pert', data=f_check["method"][u_pert_name])
+    # only the requested field is read from the checkpoint
+    with h5py.File(filename, 'r') as f_check:
+        with h5py.File(u_pert_fn, 'w') as f:
+            f.create_dataset('u_pert', data=f_check["method"][u_pert_name][()])
     return
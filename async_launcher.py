@@ -0,0 +1,73 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from utils import slot_fork_id
+
+
+def run_concurrently(process, t1, jobs, on_result, runs_in_flight=1, pipelined=False):
+    """
+    Evolve the perturbations of jobs on this rank, with up to runs_in_flight solver runs in flight at the same time,
+    each in the fork_dir of its slot (see slot_fork_id). While the runs are going, the parent rank only polls their
+    outputs, so a few parent ranks per node can keep all the cores busy with children, instead of one parent per run.
+    The runs are driven by asyncio in the rank itself, no thread or collective is involved
+    :param process: the process object, with proceed_async for runs_in_flight > 1 (e.g., Flash)
+    :param t1: the final time
+    :param jobs: iterable of (key, u_pert), which is consumed lazily, so the perturbations need not all be in memory
+    :param on_result: called as on_result(key, ut) when a run is finished, in the order of completion
+    :param runs_in_flight: the maximum number of concurrent runs of the rank
+    :param pipelined: one run after another, but the output of each run is read and its fork_dir cleaned up while the
+        next one is going, see run_pipelined
+    :return: None
+    """
+    if pipelined:
+        if runs_in_flight > 1:
+            raise ValueError("pipelined runs need runs_in_flight = 1!")
+        if not hasattr(process, "proceed_launch"):
+            raise ValueError("The process has no proceed_launch, so the runs cannot be pipelined!")
+        run_pipelined(process, t1, iter(jobs), on_result)
+        return
+    if runs_in_flight <= 1:
+        # one run after another, exactly as process.proceed
+        for key, u_pert in jobs:
+            on_result(key, process.proceed(t1, u_pert=u_pert, fork_id=slot_fork_id(process, 0)))
+        return
+    if not hasattr(process, "proceed_async"):
+        raise ValueError("The process has no proceed_async, so runs_in_flight must be 1!")
+    asyncio.run(run_slots(process, t1, iter(jobs), on_result, runs_in_flight))
+    return
+
+
+async def run_slots(process, t1, jobs, on_result, runs_in_flight):
+    # each slot takes the next job when its run is finished; the jobs iterator is only advanced between two awaits
+    async def run_slot(slot):
+        fork_id = slot_fork_id(process, slot)
+        for key, u_pert in jobs:
+            ut = await process.proceed_async(t1, u_pert=u_pert, fork_id=fork_id)
+            on_result(key, ut)
+
+    await asyncio.gather(*[run_slot(slot) for slot in range(runs_in_flight)])
+    return
+
+
+def run_pipelined(process, t1, jobs, on_result):
+    """
+    One run at a time on two alternating fork slots: while run k + 1 is prepared, launched and running in one slot,
+    a background thread reads the output of run k and cleans up the other slot, so that the Python-side I/O is off
+    the critical path. on_result is called in the calling thread, right after run k + 1 is launched
+    :param process: the process object, with proceed_launch (e.g., Flash)
+    :param t1: the final time
+    :param jobs: iterator of (key, u_pert)
+    :param on_result: called as on_result(key, ut) in the order of the jobs
+    :return: None
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        collecting = None
+        for i, (key, u_pert) in enumerate(jobs):
+            # the slot of run k - 1 is free, since its collection was waited for in the previous iteration
+            wait = process.proceed_launch(t1, u_pert=u_pert, fork_id=slot_fork_id(process, i % 2))
+            if collecting is not None:
+                on_result(*collecting.result())
+            collect = wait()
+            collecting = executor.submit(lambda k=key, c=collect: (k, c()))
+        if collecting is not None:
+            on_result(*collecting.result())
+    return
@@ -0,0 +1,170 @@
+import json
+import sys
+import numpy as np
+from layout_tuner import fit_scaling_model, predict_time
+
+
+def expected_max_normal(n):
+    # the expected maximum of n standard normal variables, approximately
+    return np.sqrt(2. * np.log(n)) if n > 1 else 0.
+
+
+def gradient_time(n_indices, n_ranks, runs_in_flight, time_mean, time_std):
+    """
+    Predict the wall time of one grad_defn. The indices are split statically between the ranks (np.array_split), so
+    the ranks with the most indices set the pace, and among them the one with the slowest runs; within a rank, the
+    runs_in_flight slots take the next index when they are free
+    :param n_indices: the number of solver runs per gradient
+    :param n_ranks: the number of parent ranks
+    :param runs_in_flight: the number of concurrent runs of each rank
+    :param time_mean: the mean wall time of one run
+    :param time_std: the standard deviation of the wall time of one run
+    :return: the predicted time, and the parallel efficiency (the ideal time over the predicted one)
+    """
+    runs_per_rank = int(np.ceil(n_indices / n_ranks))
+    waves = np.ceil(runs_per_rank / runs_in_flight)
+    # the sum of the run times of the slowest slot fluctuates by the square root of its number of runs
+    straggle = time_std * np.sqrt(waves) * expected_max_normal(n_ranks * runs_in_flight)
+    # the objective at the current point is evaluated by rank 0 before the indices are started
+    time_grad = time_mean + waves * time_mean + straggle
+    efficiency = (time_mean + n_indices * time_mean / (n_ranks * runs_in_flight)) / time_grad
+    return time_grad, efficiency
+
+
+def job_script(n_nodes, tasks_per_node, parents_per_node, walltime, script, wrapper_nproc, runs_in_flight):
+    # the SLURM script of a layout, in the form of job_example.mpi
+    hours, rest = divmod(int(np.ceil(walltime)), 3600)
+    minutes, seconds = divmod(rest, 60)
+    return ("#!/bin/bash\n"
+            "#SBATCH -J cnop\n"
+            "#SBATCH -t {}:{:02d}:{:02d}\n"
+            "#SBATCH -N {}\n"
+            "#SBATCH --tasks-per-node={}\n"
+            "\n"
+            "executed=false\n"
+            "while [ \"$executed\" = false ] || [ -f resume_needed.txt ]; do\n"
+            "    mpirun --oversubscribe --map-by ppr:{}:node -np {} python3 {}\n"
+            "    executed=true\n"
+            "done\n"
+            "\n"
+            "# {} needs wrapper_nproc = {} and runs_in_flight = {}\n").format(
+        hours, minutes, seconds, n_nodes, tasks_per_node, parents_per_node, parents_per_node * n_nodes, script,
+        script, wrapper_nproc, runs_in_flight)
+
+
+class CapacityPlanner:
+    def __init__(self, wrapper_nprocs, times, cores_per_node, node_counts, n_indices=None, pert_mask=None,
+                 candidates=None, runs_in_flight_options=(1,), horizon_ratio=1., startup_time=None, n_iter=50,
+                 evals_per_iter=1.5, max_walltime=None, safety=1.2, run_time_cv=None, script="run_flash.py"):
+        """
+        Predict the wall time of a Spg2Defn search for the layouts of the allocation (nodes, parent ranks per node,
+        wrapper_nproc children per run and runs_in_flight per rank) from the measured wall times of proceed, and
+        recommend the job script (see report). The run time at any wrapper_nproc is given by the scaling model of
+        layout_tuner, the gradient time includes the imbalance of the static split of the indices (see gradient_time),
+        and each iteration costs one gradient plus evals_per_iter objective evaluations of rank 0
+        :param wrapper_nprocs: the wrapper_nproc of the measured runs, e.g., LayoutTuner.wrapper_nprocs
+        :param times: the measured wall times of proceed, one per wrapper_nproc (e.g., LayoutTuner.times), or one row
+            of repeated runs per wrapper_nproc, whose spread gives the variability of the run time
+        :param cores_per_node: the number of cores per node
+        :param node_counts: the numbers of nodes to consider
+        :param n_indices: the number of solver runs per gradient, i.e., the size of the perturbation
+        :param pert_mask: the pert_mask of the perturbation, if n_indices is not given. grad_defn runs every cell of
+            the perturbation, also the masked-out ones, so only its size counts
+        :param candidates: the wrapper_nproc to consider, wrapper_nprocs by default
+        :param runs_in_flight_options: the runs_in_flight to consider, see run_concurrently
+        :param horizon_ratio: the ratio of the evolution time t1 - t0 of the search to the one of the measured runs,
+            e.g., when the probe runs are a few steps only; the start-up part of the run time does not scale
+        :param startup_time: the start-up part of the run time, the constant of the scaling model by default
+        :param n_iter: the expected number of iterations, e.g., max_iter for the worst case
+        :param evals_per_iter: the mean number of objective evaluations per iteration of the line search
+        :param max_walltime: the walltime limit of one job (s); layouts within it are preferred, with the fewest
+            node-hours. Otherwise, the fastest layout is recommended
+        :param safety: the factor of the predicted time for the walltime of the job
+        :param run_time_cv: the coefficient of variation of the run time; from the repeated runs by default, else 0
+        :param script: the Python script of the job
+        """
+        wrapper_nprocs = np.asarray(wrapper_nprocs, dtype=int)
+        times = np.asarray(times, dtype=float).reshape(wrapper_nprocs.size, -1)
+        if n_indices is None:
+            if pert_mask is None:
+                raise ValueError("Either n_indices or pert_mask must be given!")
+            n_indices = np.size(pert_mask)
+        if candidates is None:
+            candidates = np.unique(wrapper_nprocs)
+        if run_time_cv is None:
+            run_time_cv = float(np.mean(times.std(axis=1) / times.mean(axis=1))) if times.shape[1] > 1 else 0.
+
+        if np.unique(wrapper_nprocs).size < 2:
+            # perfect scaling is assumed from a single measured wrapper_nproc
+            self.model = np.array([0., times.mean() * wrapper_nprocs[0], 0.])
+        else:
+            self.model = fit_scaling_model(np.repeat(wrapper_nprocs, times.shape[1]), times.reshape(-1))
+        startup_time = self.model[0] if startup_time is None else startup_time
+
+        self.layouts = []
+        for n_nodes in node_counts:
+            for w in candidates:
+                for runs_in_flight in runs_in_flight_options:
+                    parents_per_node = int(cores_per_node // (w * runs_in_flight))
+                    if parents_per_node == 0:
+                        continue
+                    n_ranks = parents_per_node * n_nodes
+                    time_run = startup_time + (predict_time(self.model, w) - self.model[0]) * horizon_ratio
+                    time_grad, efficiency = gradient_time(n_indices, n_ranks, runs_in_flight, time_run,
+                                                          run_time_cv * time_run)
+                    time_iter = time_grad + evals_per_iter * time_run
+                    # the basic state, the reference run and the first objective and gradient
+                    time_total = 3 * time_run + time_grad + n_iter * time_iter
+                    self.layouts.append({"n_nodes": int(n_nodes), "wrapper_nproc": int(w),
+                                         "runs_in_flight": int(runs_in_flight), "parents_per_node": parents_per_node,
+                                         "time_run": float(time_run), "time_grad": float(time_grad),
+                                         "efficiency": float(efficiency), "time_iter": float(time_iter),
+                                         "time_total": float(time_total),
+                                         "node_hours": float(time_total * n_nodes / 3600.)})
+        if len(self.layouts) == 0:
+            raise ValueError("No candidate wrapper_nproc fits into cores_per_node!")
+        self.layouts.sort(key=lambda layout: layout["time_total"])
+
+        fitting = [layout for layout in self.layouts
+                   if max_walltime is not None and layout["time_total"] * safety <= max_walltime]
+        if len(fitting) > 0:
+            self.recommended = min(fitting, key=lambda layout: layout["node_hours"])
+        else:
+            self.recommended = self.layouts[0]
+        walltime = self.recommended["time_total"] * safety
+        # the search continues from its checkpoints in the next job if the walltime limit is too short
+        self.n_jobs = 1 if max_walltime is None else int(np.ceil(walltime / max_walltime))
+        if max_walltime is not None:
+            walltime = min(walltime, max_walltime)
+        self.job_script = job_script(self.recommended["n_nodes"], cores_per_node,
+                                     self.recommended["parents_per_node"], walltime, script,
+                                     self.recommended["wrapper_nproc"], self.recommended["runs_in_flight"])
+
+        self.run_time_cv = run_time_cv
+        self.n_indices = n_indices
+        return
+
+    def report(self):
+        # the table of the layouts, the recommendation and its job script
+        lines = ["Capacity planner: T(w) = {:.3g} + {:.3g} / w + {:.3g} * w s, run time cv = {:.2f}, "
+                 "{} runs per gradient".format(*self.model, self.run_time_cv, self.n_indices),
+                 "  nodes  wrapper_nproc  in_flight  parents/node  run (s)  gradient (s)  efficiency  iteration (s)  "
+                 "total (h)  node-hours"]
+        for layout in self.layouts:
+            lines.append("  {n_nodes:5d}  {wrapper_nproc:13d}  {runs_in_flight:9d}  {parents_per_node:12d}  "
+                         "{time_run:7.1f}  {time_grad:12.1f}  {efficiency:10.2f}  {time_iter:13.1f}  {0:9.2f}  "
+                         "{node_hours:10.1f}".format(layout["time_total"] / 3600., **layout))
+        lines.append("Recommended: {} nodes, wrapper_nproc = {}, runs_in_flight = {}, {:.2f} h{}".format(
+            self.recommended["n_nodes"], self.recommended["wrapper_nproc"], self.recommended["runs_in_flight"],
+            self.recommended["time_total"] / 3600., ", in {} jobs".format(self.n_jobs) if self.n_jobs > 1 else ""))
+        lines.append(self.job_script)
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # e.g., python capacity_planner.py plan.json, where plan.json holds the arguments of CapacityPlanner, e.g.,
+    # {"wrapper_nprocs": [16, 32, 64], "times": [410, 230, 150], "cores_per_node": 128, "node_counts": [4, 8, 16],
+    #  "n_indices": 4096, "runs_in_flight_options": [1, 2], "max_walltime": 86400}
+    with open(sys.argv[1]) as f:
+        planner = CapacityPlanner(**json.load(f))
+    print(planner.report())
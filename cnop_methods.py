@@ -1,26 +1,113 @@
+import copy
+import time
+from abc import ABC, abstractmethod
 import numpy as np
 from sim_controller import load_checkpoint, save_checkpoint
+from dist_vector import DistVector
+from metrics import update_metrics
 
 
-class Spg2Defn:
-    def __init__(self, process, u_pert, t1, pert_delta, pert_mask=None, grad_epsilon=1e-8):
+class CnopMethod(ABC):
+    # attributes with the shape of u_pert (or a batch of them), which are distributed if distributed=True
+    vector_names = ("u_pert", "u_pert_best", "g", "surrogate_u", "surrogate_g")
+
+    def __init__(self, process, u_pert, t1, pert_delta, pert_mask=None, grad_epsilon=1e-8,
+                 max_iter=300, max_ifcnt=100000, eps=1e-8, j_num=10, distributed=False,
+                 storage_dtype=None, storage_compression=None, storage_compression_opts=None,
+                 storage_scaleoffset=None, multi_fidelity=False, fidelity_rtol=0.1, fidelity_agreement=0.9,
+                 metrics_fn=None, secant_gradient=False, secant_refresh=5, secant_probes=2, secant_rtol=0.1,
+                 secant_seed=0, speculative_grad=False, speculative_runs=1, grad_coloring=False,
+                 influence_radius=None, grad_periodic=False, runs_in_flight=1, pipelined_runs=False, surrogate=False,
+                 surrogate_num=5, surrogate_radius=None, horizon_weights=None, cleanup_scratch=True):
         """
+        Base class of the projected CNOP optimizers. The restart, checkpointing, counters, nonmonotone line search
+        and the outer iteration loop are shared here; the child class only decides the search direction
+        (search_direction) and how to update its own memory after each accepted step (update_memory).
         :param process: the process object
         :param u_pert: the initial perturbation
-        :param t1: the final time
+        :param t1: the final time, or a list of horizons which are all evolved by the same runs (see proceed), then the
+            weighted sum of their objectives is optimized and the objective of each is kept in j_horizons
         :param pert_delta: the perturbation bound
         :param pert_mask: the pert_mask for the perturbation
         :param grad_epsilon: for computing gradient
+        :param max_iter: the maximum number of iterations
+        :param max_ifcnt: the maximum number of objective evaluations
+        :param eps: the tolerance of the projected gradient norm for convergence
+        :param j_num: the number of recent objective values kept for the nonmonotone line search
+        :param distributed: whether the vectors are distributed over the ranks (see DistVector), instead of being
+            duplicated on every rank; u_pert_best is gathered on all ranks at the end
+        :param storage_dtype: precision of the vectors in the checkpoints and of the temporary gradient files,
+            e.g., "float32"; the arithmetic is always done in float64. None keeps float64
+        :param storage_compression: HDF5 compression filter of the vectors in the checkpoints, e.g., "gzip" or "lzf"
+        :param storage_compression_opts: option of the compression filter, e.g., the gzip level
+        :param storage_scaleoffset: number of decimal digits kept by the (lossy, error-bounded) HDF5 scale-offset
+            filter of the vectors in the checkpoints
+        :param multi_fidelity: whether to start from the coarsest level of process.fidelity_ladder, see update_fidelity
+        :param fidelity_rtol: the reduction of the projected gradient norm at a coarse level before checking whether
+            to move to the finer level
+        :param fidelity_agreement: stay at the coarse level if the cosine between its gradient and the gradient of
+            the finer level is at least fidelity_agreement
+        :param metrics_fn: the live metrics file (JSON, or Prometheus text if it ends with ".prom") updated by rank 0
+            with the progress of the gradient and of the iterations, see record_metrics. None disables it
+        :param secant_gradient: inexact-gradient mode, where the gradient at the new point is estimated from the
+            previous one by a secant correction with a few directional-derivative probes (see secant_grad), instead of
+            the finite-difference gradient of u_pert.size runs
+        :param secant_refresh: the full gradient is computed at least every secant_refresh iterations
+        :param secant_probes: the number of random probe directions (in addition to the step direction), the last
+            one is held out for the trust test
+        :param secant_rtol: the relative error of the held-out directional derivative above which the estimate is
+            rejected and the full gradient is computed
+        :param secant_seed: the seed of the random probe directions
+        :param speculative_grad: while rank 0 evaluates the objective at the first trial point u_pert + d of the line
+            search, the other ranks start the gradient there (see line_search); it is kept if the unit step is
+            accepted, which is the case in most iterations
+        :param speculative_runs: the number of gradient indices per rank started during the trial objective,
+            about the number of solver runs of one objective evaluation
+        :param grad_coloring: compute the gradient by Jacobian compression (see grad_colored), where the cells which
+            cannot influence each other's neighborhood by t1 are perturbed in the same run
+        :param influence_radius: the influence radius in cells for grad_coloring; estimated by one run if None
+        :param grad_periodic: whether the domain is periodic, for grad_coloring
+        :param runs_in_flight: the number of concurrent solver runs of each rank in the gradient (see
+            run_concurrently), so that fewer parent ranks are needed to keep the cores busy
+        :param pipelined_runs: read the output of each gradient run and clean up its fork_dir in a background thread
+            while the next run is going (see run_pipelined); needs runs_in_flight = 1
+        :param surrogate: surrogate-assisted mode, where a quadratic model fitted to the recent points, objective values
+            and gradients (see fit_surrogate) proposes a trust-region step before the line search, and the line search
+            trials which the model rejects within the trust region are not run (see line_search)
+        :param surrogate_num: the number of recent points kept for the surrogate model
+        :param surrogate_radius: the initial trust radius of the surrogate model, in the same (root-mean-square) norm as
+            pert_delta; pert_delta by default
+        :param horizon_weights: the weights of the objectives of the horizons if t1 is a list; by default, only the
+            last horizon is optimized and the others are monitored
+        :param cleanup_scratch: remove the staged files of the process from the node-local scratch (see stage_scratch)
+            when the search is finished; the drivers of several searches (e.g., MultiStartDefn) clean up at their end
         """
-        from utils import do_projection, compute_obj
-        from grad_defn import grad_defn
+        from utils import do_projection
 
         self.mpi_comm = process.mpi_comm
         self.mpi_rank = self.mpi_comm.Get_rank()
 
+        # the options of the gradient runs (see run_concurrently) are checked before any solver run
+        if pipelined_runs:
+            if runs_in_flight > 1:
+                raise ValueError("pipelined_runs needs runs_in_flight = 1!")
+            if not hasattr(process, "proceed_launch"):
+                raise ValueError("The process has no proceed_launch, so pipelined_runs is not supported!")
+        elif runs_in_flight > 1 and not hasattr(process, "proceed_async"):
+            raise ValueError("The process has no proceed_async, so runs_in_flight must be 1!")
+
         if process.restart:
             # load the method info from the restart checkpoint
             load_checkpoint(process.restart_checkpoint_fn, "method", self)
+            self.restore_vectors()
+            # the evaluation which was interrupted by the end of the previous job is resumed
+            self.resumed_evaluations = getattr(self, "resumed_evaluations", 0) + 1
+            if self.multi_fidelity:
+                process.set_fidelity(self.fidelity_level)
+            # the layout of the runs may differ between jobs
+            self.runs_in_flight = runs_in_flight
+            self.pipelined_runs = pipelined_runs
+            self.cleanup_scratch = cleanup_scratch
         else:
 
             self.pert_delta = pert_delta
@@ -32,53 +119,112 @@ class Spg2Defn:
             self.max_float = 1.e100  # np.finfo(float).max
             self.min_float = 1.e-100  # np.finfo(float).tiny
 
-            self.max_iter = 300
+            self.max_iter = max_iter
             self.ifcnt = 0
 
-            self.max_ifcnt = 100000
+            self.max_ifcnt = max_ifcnt
             self.igcnt = 0
 
-            self.eps = 1e-8
+            self.eps = eps
             self.gamma = 0.0001
 
-            # storage M = 10 recent numbers
-            self.j_num = 10
+            # storage M = j_num recent numbers
+            self.j_num = j_num
             self.j_values = -np.inf * np.ones(self.j_num)
+            self.storage_dtype = storage_dtype
+            self.storage_compression = storage_compression
+            self.storage_compression_opts = storage_compression_opts
+            self.storage_scaleoffset = storage_scaleoffset
+            self.multi_fidelity = multi_fidelity
+            self.fidelity_rtol = fidelity_rtol
+            self.fidelity_agreement = fidelity_agreement
+            self.metrics_fn = metrics_fn
+            self.secant_gradient = secant_gradient
+            self.secant_refresh = secant_refresh
+            self.secant_probes = secant_probes
+            self.secant_rtol = secant_rtol
+            self.secant_seed = secant_seed
+            # the iteration of the last full gradient, and the number of the estimated (secant) gradients
+            self.secant_full_iter = 0
+            self.iscnt = 0
+            self.speculative_grad = speculative_grad
+            self.speculative_runs = speculative_runs
+            self.grad_coloring = grad_coloring
+            self.influence_radius = influence_radius
+            self.grad_periodic = grad_periodic
+            self.runs_in_flight = runs_in_flight
+            self.pipelined_runs = pipelined_runs
+            self.cleanup_scratch = cleanup_scratch
+            self.surrogate = surrogate
+            self.surrogate_num = surrogate_num
+            self.surrogate_radius = surrogate_radius
+            # the number of the line search trials skipped and of the trust-region steps accepted by the surrogate
+            self.surrogate_skips = 0
+            self.surrogate_hits = 0
+            # the number of the job restarts, each of which resumes the interrupted evaluation from its checkpoint and
+            # gradient shards
+            self.resumed_evaluations = 0
+            self.horizon_weights = None
+            self.j_horizons = None
+            if np.ndim(t1) > 0:
+                if distributed or secant_gradient or speculative_grad or grad_coloring:
+                    raise ValueError("Several horizons are not supported with distributed, secant_gradient, "
+                                     "speculative_grad or grad_coloring!")
+                # the concurrent and pipelined runs (proceed_async, proceed_launch) are to a single final time
+                if runs_in_flight > 1 or pipelined_runs:
+                    raise ValueError("Several horizons are not supported with runs_in_flight > 1 or pipelined_runs!")
+                if horizon_weights is None:
+                    horizon_weights = np.eye(len(t1))[-1]
+                if len(horizon_weights) != len(t1):
+                    raise ValueError("horizon_weights must have one weight per horizon of t1!")
+                self.horizon_weights = np.array(horizon_weights, dtype=float)
+            # history of the iterations for the metrics, one entry per saved iteration
+            self.time_history = np.zeros(0)
+            self.j_best_history = np.zeros(0)
+            self.cgnorm_history = np.zeros(0)
+            self.ifcnt_history = np.zeros(0, dtype=int)
+            if self.multi_fidelity:
+                if not process.fidelity_ladder:
+                    raise ValueError("The process has no fidelity_ladder for the multi-fidelity CNOP!")
+                self.fidelity_level = 0
+                process.set_fidelity(self.fidelity_level)
+            self.distributed = distributed
+            if self.distributed:
+                u_pert = DistVector.from_global(self.mpi_comm, u_pert)
             self.u_pert = do_projection(u_pert, self.pert_delta, self.pert_mask)
             self.u_pert_best = self.u_pert.copy()
+            self.init_memory()
+            self.init_surrogate()
 
             if self.mpi_rank == 0:
                 print("----------------------- iter", self.iter0, "-----------------------")
 
             # compute objective value
-            if self.mpi_rank == 0:
-                self.j_val = compute_obj(process, self.u_pert, t1)
-                self.mpi_comm.Bcast(self.j_val, root=0)
-            else:
-                self.j_val = np.empty(1, dtype=float)
-                self.mpi_comm.Bcast(self.j_val, root=0)
+            self.j_val = self.evaluate_obj(process, self.u_pert, t1)
             self.j_values[0] = self.j_val
             self.j_best = self.j_val
-            self.ifcnt += 1
 
             # compute gradient (adjoint method)
-            self.g = grad_defn(process, self.u_pert, t1, self.grad_epsilon, iter0=self.iter0)
-            self.igcnt += 1
+            self.g = self.evaluate_grad(process, self.u_pert, t1)
 
             # step-1: discriminate whether the current point is stationary
-            cg = self.u_pert - self.g
-            cg = do_projection(cg, self.pert_delta, self.pert_mask)
-            self.cgnorm = (np.abs(cg - self.u_pert)).max()
+            self.cgnorm = self.projected_gradient_norm()
 
             if self.cgnorm != 0:
                 self.lambda_ = 1 / self.cgnorm
+            self.fidelity_cgnorm_target = self.fidelity_rtol * self.cgnorm
+            self.update_surrogate()
+            self.update_fidelity(process, t1)
 
             # save all needed information for restart
             if self.mpi_rank == 0:
                 print("lambda = ", self.lambda_)
                 print("j_val = ", self.j_val)
+                if self.j_horizons is not None:
+                    print("j_horizons = ", self.j_horizons)
                 print("cgnorm = ", self.cgnorm)
-                save_checkpoint(process=process, method=self)
+            self.save(process)
+            self.record_metrics()
 
         # step-2:   Backtracking
         while self.cgnorm > self.eps and self.iter0 <= self.max_iter and self.ifcnt <= self.max_ifcnt:
@@ -89,72 +235,40 @@ class Spg2Defn:
                 print("----------------------- iter", self.iter0, "-----------------------")
 
             # step-2.1: compute d
-            d = self.u_pert - self.lambda_ * self.g
-            d = do_projection(d, self.pert_delta, self.pert_mask)
-            d = d - self.u_pert
+            d = self.search_direction()
             gtd = (self.g * d).sum()
 
             # step-2.2 and step 2.3: compute alpha (lambda in paper) and u0_new,
-            j_max = self.j_values.max()
-            u_pert_new = self.u_pert + d
-            if self.mpi_rank == 0:
-                j_new = compute_obj(process, u_pert_new, t1)
-                self.mpi_comm.Bcast(j_new, root=0)
-            else:
-                j_new = np.empty(1, dtype=float)
-                self.mpi_comm.Bcast(j_new, root=0)
-            self.ifcnt = self.ifcnt + 1
-            alpha = 1
-
-            while j_new > j_max + self.gamma * alpha * gtd:
-                if alpha <= 0.1:
-                    alpha = alpha / 2.
-                else:
-                    atemp = - gtd * alpha ** 2 / (2 * (j_new - self.j_val - alpha * gtd))
-                    if atemp < 0.1 or atemp > 0.9 * alpha:
-                        atemp = alpha / 2.
-                    alpha = atemp
-                u_pert_new = self.u_pert + alpha * d
-                if self.mpi_rank == 0:
-                    j_new = compute_obj(process, u_pert_new, t1)
-                    self.mpi_comm.Bcast(j_new, root=0)
-                else:
-                    j_new = np.empty(1, dtype=float)
-                    self.mpi_comm.Bcast(j_new, root=0)
-                self.ifcnt += 1
+            u_pert_new, j_new = self.line_search(process, t1, d, gtd)
 
             self.j_val = j_new
             self.j_values[np.mod(self.iter0, self.j_num)] = self.j_val  # store the recent self.j_num values
             if j_new < self.j_best:
                 self.j_best = j_new
                 self.u_pert_best = u_pert_new.copy()
-            g_new = grad_defn(process, u_pert_new, t1, self.grad_epsilon, iter0=self.iter0)
-            self.igcnt += 1
-
-            # step-3: compute lambda (alpha in paper)
             s = u_pert_new - self.u_pert
+            g_new = self.next_grad(process, u_pert_new, j_new, s, t1)
+
+            # step-3: update the method memory (e.g., lambda, alpha in paper) with s and y
             y = g_new - self.g
-            sts = (s ** 2.).sum()
-            sty = (s * y).sum()
             self.u_pert = u_pert_new.copy()
             self.g = g_new.copy()
-            cg = self.u_pert - self.g
-            cg = do_projection(cg, self.pert_delta, self.pert_mask)
-            self.cgnorm = (np.abs(cg - self.u_pert)).max()
-
-            if sty <= 0:
-                self.lambda_ = self.max_float
-            else:
-                self.lambda_ = np.min((self.max_float, np.max((self.min_float, sts / sty))))
+            self.cgnorm = self.projected_gradient_norm()
+            info = self.update_memory(s, y)
+            self.update_surrogate()
+            self.update_fidelity(process, t1)
 
             # save all needed information for restart
             if self.mpi_rank == 0:
                 print("lambda = ", self.lambda_)
                 print("j_val = ", self.j_val)
-                print("sts = ", sts)
-                print("sty = ", sty)
+                if self.j_horizons is not None:
+                    print("j_horizons = ", self.j_horizons)
+                for key, value in info.items():
+                    print(key, "= ", value)
                 print("cgnorm = ", self.cgnorm)
-                save_checkpoint(process=process, method=self)
+            self.save(process)
+            self.record_metrics()
 
             # # set MPI barrier to make sure all processes are on the same page
             # self.mpi_comm.Barrier()
@@ -171,4 +285,671 @@ class Spg2Defn:
                     else:
                         print('unknown stop')
 
+        if self.distributed:
+            self.u_pert_best = self.u_pert_best.allgather()
+        if self.cleanup_scratch and hasattr(process, "cleanup_scratch"):
+            process.cleanup_scratch()
+        return
+
+    def restore_vectors(self):
+        # the vectors loaded from the checkpoint may be stored in reduced precision, but the arithmetic is in float64;
+        # if distributed, take the local slices of the full vectors
+        field_ndim = np.ndim(self.u_pert)
+        for name in self.vector_names:
+            value = np.asarray(getattr(self, name), dtype=float)
+            if self.distributed:
+                value = DistVector.from_global(self.mpi_comm, value, batch_ndim=np.ndim(value) - field_ndim)
+            setattr(self, name, value)
+        return
+
+    def storage_filters(self):
+        # HDF5 filters of the vectors in the checkpoints
+        filters = {}
+        if self.storage_compression is not None:
+            filters["compression"] = self.storage_compression
+            filters["compression_opts"] = self.storage_compression_opts
+            filters["shuffle"] = True
+        if self.storage_scaleoffset is not None:
+            filters["scaleoffset"] = self.storage_scaleoffset
+        return filters
+
+    def save(self, process):
+        # save all needed information for restart; distributed vectors are gathered on rank 0 first
+        state = self
+        if self.distributed:
+            state = copy.copy(self)
+            for name in self.vector_names:
+                setattr(state, name, getattr(self, name).gather())
+        if self.mpi_rank == 0:
+            save_checkpoint(process=process, method=state, field_names=self.vector_names,
+                            field_dtype=self.storage_dtype, **self.storage_filters())
+        return
+
+    def record_metrics(self):
+        """
+        Append the current iteration to the history and update the "method" section of the metrics file: the
+        objective, the number of objective evaluations of the line search, the time per iteration, and the ETA of
+        convergence extrapolated from the decay rate of the projected gradient norm over the recent iterations
+        :return: None
+        """
+        self.time_history = np.append(self.time_history, time.time())
+        self.j_best_history = np.append(self.j_best_history, np.squeeze(self.j_best))
+        self.cgnorm_history = np.append(self.cgnorm_history, self.cgnorm)
+        self.ifcnt_history = np.append(self.ifcnt_history, self.ifcnt)
+        if self.metrics_fn is None or self.mpi_rank != 0:
+            return
+
+        # the median is robust to the gaps of restarts
+        iter_time = np.median(np.diff(self.time_history[-self.j_num:])) if self.time_history.size > 1 else np.nan
+        iter_to_go = self.max_iter - self.iter0
+        recent = np.log(np.maximum(self.cgnorm_history[-self.j_num:], self.min_float))
+        if recent.size > 1:
+            rate = np.polyfit(np.arange(recent.size), recent, 1)[0]
+            if rate < 0:
+                iter_to_go = min(iter_to_go, int(np.ceil((np.log(self.eps) - recent[-1]) / rate)))
+        update_metrics(self.metrics_fn, "method",
+                       {"iter0": self.iter0,
+                        "j_val": np.squeeze(self.j_val),
+                        "j_best": np.squeeze(self.j_best),
+                        "cgnorm": self.cgnorm,
+                        "ifcnt": self.ifcnt,
+                        "igcnt": self.igcnt,
+                        "line_search_evaluations": int(np.diff(self.ifcnt_history[-2:]).sum()),
+                        "surrogate_skips": self.surrogate_skips,
+                        "surrogate_hits": self.surrogate_hits,
+                        "resumed_evaluations": self.resumed_evaluations,
+                        "j_horizons": self.j_horizons if self.j_horizons is not None else [],
+                        "iteration_time": iter_time,
+                        "iterations_to_go": max(iter_to_go, 0),
+                        "eta": max(iter_to_go, 0) * iter_time,
+                        "j_best_history": self.j_best_history})
+        return
+
+    def zeros_memory(self, num):
+        # memory of num vectors with the same layout as u_pert
+        if self.distributed:
+            return self.u_pert.zeros_batch(num)
+        return np.zeros((num,) + self.u_pert.shape)
+
+    def init_memory(self):
+        # method-specific attributes; they must be savable in the checkpoint (i.e., numbers or numpy arrays)
+        return
+
+    @abstractmethod
+    def search_direction(self):
+        # the search direction d at self.u_pert, such that u_pert + d is feasible and g.d < 0
+        return
+
+    @abstractmethod
+    def update_memory(self, s, y):
+        # update the memory with the accepted step s and the gradient change y; return the info to print
+        return
+
+    def evaluate_obj(self, process, u_pert, t1, meanwhile=None):
+        # the objective is computed on rank 0 only and broadcast to all ranks; the other ranks may run
+        # meanwhile(u_pert) with the full (restricted) perturbation until then
+        from utils import compute_obj
+
+        u_pert = self.restrict(process, u_pert)
+        if self.distributed:
+            u_pert = u_pert.gather() if meanwhile is None else u_pert.allgather()
+        if self.mpi_rank == 0:
+            j_val = compute_obj(process, u_pert, t1)
+            self.mpi_comm.Bcast(j_val, root=0)
+        else:
+            if meanwhile is not None:
+                meanwhile(u_pert)
+            j_val = np.empty(np.size(t1), dtype=float)
+            self.mpi_comm.Bcast(j_val, root=0)
+        self.ifcnt += 1
+        if self.horizon_weights is not None:
+            # the objectives of the horizons of the latest evaluation, which is the accepted point after line_search
+            self.j_horizons = np.array(j_val, dtype=float)
+            j_val = (self.horizon_weights * self.j_horizons).sum()
+        return j_val
+
+    def evaluate_grad(self, process, u_pert, t1):
+        from grad_defn import grad_defn
+        from grad_coloring import grad_colored, estimate_influence_radius
+
+        u_pert = self.restrict(process, u_pert)
+        if self.grad_coloring:
+            if self.influence_radius is None:
+                u_full = u_pert.gather() if isinstance(u_pert, DistVector) else u_pert
+                self.influence_radius = estimate_influence_radius(process, u_full, t1, self.grad_epsilon)
+            g = grad_colored(process, u_pert, t1, self.grad_epsilon, self.influence_radius,
+                             periodic=self.grad_periodic)
+        else:
+            g = grad_defn(process, u_pert, t1, self.grad_epsilon, iter0=self.iter0, storage_dtype=self.storage_dtype,
+                          metrics_fn=self.metrics_fn, runs_in_flight=self.runs_in_flight,
+                          pipelined=self.pipelined_runs)
+        if self.horizon_weights is not None:
+            g = np.tensordot(self.horizon_weights, g, axes=1)
+        g = self.restrict_adjoint(process, g)
+        self.igcnt += 1
+        return g
+
+    def next_grad(self, process, u_pert_new, j_new, s, t1):
+        # the gradient at the accepted point, estimated in the secant mode if the estimate passes the trust test
+        if self.secant_gradient and self.iter0 - self.secant_full_iter < self.secant_refresh:
+            g_new = self.secant_grad(process, u_pert_new, j_new, s, t1)
+            if g_new is not None and self.projected_gradient_norm(u_pert_new, g_new) > self.eps:
+                self.iscnt += 1
+                return g_new
+            # a stationary point is only accepted with the full gradient
+        self.secant_full_iter = self.iter0
+        return self.evaluate_grad(process, u_pert_new, t1)
+
+    def secant_grad(self, process, u_pert_new, j_new, s, t1):
+        """
+        Estimate the gradient at u_pert_new by the smallest correction of the current gradient which matches the
+        directional derivatives along the step s and along secant_probes random directions (a multi-secant Broyden
+        update). The derivative along the last random direction is first used as a trust test of the estimate from
+        the other directions. Each direction costs one solver run
+        :param process: the process object
+        :param u_pert_new: the accepted point
+        :param j_new: the objective value at u_pert_new
+        :param s: the step from the current point to u_pert_new
+        :param t1: the final time
+        :return: the estimated gradient, or None if the trust test fails
+        """
+        from grad_defn import grad_directional
+        from utils import restrict_field
+
+        def full(u):
+            # the probes are run with the full (restricted if multi-fidelity) perturbation on all ranks
+            u = u.allgather() if isinstance(u, DistVector) else u
+            if self.multi_fidelity and process.fidelity_factor() != 1:
+                u = restrict_field(u, process.fidelity_factor())
+            return u
+
+        # the directions have a maximum norm of 1, so that grad_epsilon is the largest change of a cell as in grad_defn
+        s_full = s.allgather() if self.distributed else s
+        directions = [s_full / np.max((abs(s_full).max(), self.min_float))]
+        rng = np.random.default_rng([self.secant_seed, self.iter0])
+        for _ in range(self.secant_probes):
+            v = rng.choice([-1., 1.], size=s_full.shape)
+            if self.pert_mask is not None:
+                v = v * self.pert_mask
+            directions.append(v)
+        derivatives = grad_directional(process, full(u_pert_new), [full(v) for v in directions], t1,
+                                       self.grad_epsilon, np.squeeze(j_new))
+        if self.distributed:
+            directions = [DistVector.from_global(self.mpi_comm, v) for v in directions]
+
+        g_new = self.secant_correction(self.g, directions[:-1], derivatives[:-1])
+        predicted = (g_new * directions[-1]).sum()
+        error = abs(predicted - derivatives[-1]) / np.max((abs(derivatives[-1]), self.min_float))
+        if self.mpi_rank == 0:
+            print("secant gradient: relative error of the held-out probe = ", error)
+        if error > self.secant_rtol:
+            return None
+        # the held-out direction is also a valid secant condition
+        return self.secant_correction(self.g, directions, derivatives)
+
+    @staticmethod
+    def secant_correction(g, directions, derivatives):
+        # the g_new closest to g with (g_new * v_i).sum() = derivatives[i], i.e., g + V (V^T V)^-1 (derivatives - V^T g)
+        gram = np.array([[(v_i * v_j).sum() for v_j in directions] for v_i in directions])
+        residual = np.asarray(derivatives) - np.array([(g * v_i).sum() for v_i in directions])
+        coeffs = np.linalg.lstsq(gram, residual, rcond=None)[0]
+        for coeff, v_i in zip(coeffs, directions):
+            g = g + coeff * v_i
+        return g
+
+    def restrict(self, process, u):
+        # restrict the perturbation to the current level of the multi-fidelity CNOP
+        from utils import restrict_field
+
+        if not self.multi_fidelity or process.fidelity_factor() == 1:
+            return u
+        if self.distributed:
+            return DistVector.from_global(self.mpi_comm, restrict_field(u.allgather(), process.fidelity_factor()))
+        return restrict_field(u, process.fidelity_factor())
+
+    def restrict_adjoint(self, process, g):
+        # the gradient at the current level w.r.t. the full-resolution perturbation, i.e., R^T g, where the
+        # restriction R averages blocks of cells
+        from utils import prolong_field
+
+        if not self.multi_fidelity or process.fidelity_factor() == 1:
+            return g
+        g_full = g.allgather() if self.distributed else g
+        g_full = prolong_field(g_full, self.u_pert.shape) * g_full.size / self.u_pert.size
+        if self.distributed:
+            return DistVector.from_global(self.mpi_comm, g_full)
+        return g_full
+
+    def update_fidelity(self, process, t1):
+        """
+        Multi-fidelity CNOP: once the projected gradient norm at a coarse level is reduced by fidelity_rtol, the
+        gradient of the finer level is computed at the current perturbation. The finer level is used from now on if
+        the two gradients do not agree (cosine < fidelity_agreement) or the coarse level has converged; otherwise
+        the coarse level is kept until the projected gradient norm is reduced by fidelity_rtol again.
+        :param process: the process object
+        :param t1: the final time
+        :return: None
+        """
+        if not self.multi_fidelity or self.fidelity_level == len(process.fidelity_ladder):
+            return
+        if self.cgnorm > self.eps and self.cgnorm > self.fidelity_cgnorm_target:
+            return
+
+        process.set_fidelity(self.fidelity_level + 1)
+        g_fine = self.evaluate_grad(process, self.u_pert, t1)
+        norms = np.sqrt((self.g ** 2.).sum() * (g_fine ** 2.).sum())
+        agreement = (self.g * g_fine).sum() / np.max((norms, self.min_float))
+        if self.mpi_rank == 0:
+            print("gradient agreement between level {} and {} = ".format(self.fidelity_level, self.fidelity_level + 1),
+                  agreement)
+        if self.cgnorm > self.eps and agreement >= self.fidelity_agreement:
+            # the coarse gradient is still good enough
+            process.set_fidelity(self.fidelity_level)
+            self.fidelity_cgnorm_target = self.fidelity_rtol * self.cgnorm
+            return
+
+        self.fidelity_level += 1
+        if self.mpi_rank == 0:
+            print("----------------------- switch to fidelity level", self.fidelity_level, "-----------------------")
+        self.g = g_fine
+        # the objective values of different levels are not comparable, so the line search memory and the best
+        # perturbation are reset
+        self.j_val = self.evaluate_obj(process, self.u_pert, t1)
+        self.j_values = -np.inf * np.ones(self.j_num)
+        self.j_values[np.mod(self.iter0, self.j_num)] = self.j_val
+        self.j_best = self.j_val
+        self.u_pert_best = self.u_pert.copy()
+        self.cgnorm = self.projected_gradient_norm()
+        if self.cgnorm != 0:
+            self.lambda_ = 1 / self.cgnorm
+        self.fidelity_cgnorm_target = self.fidelity_rtol * self.cgnorm
+        self.init_memory()
+        self.init_surrogate()
+        self.update_surrogate()
+        # the finer level may not be the full resolution yet
+        self.update_fidelity(process, t1)
+        return
+
+    def projected_gradient_norm(self, u_pert=None, g=None):
+        from utils import do_projection
+
+        if u_pert is None:
+            u_pert, g = self.u_pert, self.g
+        cg = u_pert - g
+        cg = do_projection(cg, self.pert_delta, self.pert_mask)
+        return abs(cg - u_pert).max()
+
+    def projected_gradient_direction(self):
+        # spectral projected gradient direction, d = P(u - lambda * g) - u
+        from utils import do_projection
+
+        d = self.u_pert - self.lambda_ * self.g
+        d = do_projection(d, self.pert_delta, self.pert_mask)
+        return d - self.u_pert
+
+    def line_search(self, process, t1, d, gtd):
+        # nonmonotone backtracking line search with safeguarded quadratic interpolation
+        from grad_defn import grad_speculative, store_speculative
+
+        j_max = self.j_values.max()
+        model = self.fit_surrogate()
+        if model is not None:
+            u_pert_new, j_new = self.surrogate_trial(process, t1, model, j_max, d)
+            if u_pert_new is not None:
+                return u_pert_new, j_new
+        alpha = self.surrogate_screen(model, d, 1, gtd, j_max)
+        u_pert_new = self.u_pert + alpha * d
+        # the full gradient at the accepted point is started during the first trial, unless it is estimated
+        speculate = self.speculative_grad and self.mpi_comm.Get_size() > 1 and (
+                not self.secant_gradient or self.iter0 - self.secant_full_iter >= self.secant_refresh)
+        speculation = []
+        if speculate:
+            process.share_unperturbed(t1)
+            j_new = self.evaluate_obj(process, u_pert_new, t1, meanwhile=lambda u: speculation.append(
+                grad_speculative(process, u, t1, self.grad_epsilon, n_runs=self.speculative_runs)))
+        else:
+            j_new = self.evaluate_obj(process, u_pert_new, t1)
+        self.update_trust_radius(model, u_pert_new, j_new)
+        if speculate:
+            if j_new <= j_max + self.gamma * alpha * gtd and len(speculation) > 0:
+                # the first trial is accepted, so the speculative runs are at the next point of the gradient
+                store_speculative(process, self.iter0, *speculation[0], np.squeeze(j_new), self.grad_epsilon,
+                                  storage_dtype=self.storage_dtype)
+            # the shards are complete before grad_defn reads them
+            self.mpi_comm.Barrier()
+
+        while j_new > j_max + self.gamma * alpha * gtd:
+            alpha = self.backtrack(alpha, j_new, gtd)
+            alpha = self.surrogate_screen(model, d, alpha, gtd, j_max)
+            u_pert_new = self.u_pert + alpha * d
+            j_new = self.evaluate_obj(process, u_pert_new, t1)
+            self.update_trust_radius(model, u_pert_new, j_new)
+        return u_pert_new, j_new
+
+    def backtrack(self, alpha, j_new, gtd):
+        # the next step length of the line search, by safeguarded quadratic interpolation
+        if alpha <= 0.1:
+            return alpha / 2.
+        atemp = - gtd * alpha ** 2 / (2 * (j_new - self.j_val - alpha * gtd))
+        if atemp < 0.1 or atemp > 0.9 * alpha:
+            atemp = alpha / 2.
+        return atemp
+
+    def init_surrogate(self):
+        # ring buffer of the accepted points with their objective values and gradients, the point k is stored at
+        # k % surrogate_num; the latest one is the current point
+        num = self.surrogate_num if self.surrogate else 0
+        self.surrogate_u = self.zeros_memory(num)
+        self.surrogate_g = self.zeros_memory(num)
+        self.surrogate_j = np.zeros(num)
+        self.surrogate_count = 0
+        self.surrogate_delta = self.pert_delta if self.surrogate_radius is None else self.surrogate_radius
+        return
+
+    def update_surrogate(self):
+        if not self.surrogate:
+            return
+        k = np.mod(self.surrogate_count, self.surrogate_num)
+        self.surrogate_u[k] = self.u_pert
+        self.surrogate_g[k] = self.g
+        self.surrogate_j[k] = np.squeeze(self.j_val)
+        self.surrogate_count += 1
+        return
+
+    def fit_surrogate(self):
+        """
+        Quadratic model of the objective around the current point u, m(u + s) = j + g.s + (sigma |s|^2 + z.E z) / 2,
+        where z are the coordinates of s in the subspace spanned by the steps to the previous points and the gradient,
+        sigma = 1 / lambda_ is the spectral curvature, and the symmetric correction E is fitted by least squares to the
+        gradients at the previous points. Only inner products of the full vectors are needed
+        :return: the model, or None if there is no previous point
+        """
+        m = min(self.surrogate_count, self.surrogate_num)
+        if not self.surrogate or m < 2:
+            return None
+        previous = [np.mod(self.surrogate_count - 1 - i, self.surrogate_num) for i in range(1, m)]
+        vectors = [self.surrogate_u[k] - self.u_pert for k in previous] + [self.g]
+        gram = np.array([[(v_i * v_j).sum() for v_j in vectors] for v_i in vectors])
+        # orthonormal basis of the subspace, the rows of coeffs are the combinations of the vectors
+        w, u = np.linalg.eigh(gram)
+        keep = w > 1e-12 * w.max()
+        coeffs = (u[:, keep] / np.sqrt(w[keep])).T
+        model = {"vectors": vectors, "coeffs": coeffs, "sigma": 1. / self.lambda_}
+
+        # E z_i = Q y_i - sigma z_i for each previous point, with E = E^T
+        rank = coeffs.shape[0]
+        pairs = [(a, b) for a in range(rank) for b in range(a, rank)]
+        rows = []
+        rhs = []
+        for i, k in enumerate(previous):
+            z = coeffs @ gram[:, i]
+            y = self.surrogate_coords(model, self.surrogate_g[k] - self.g)
+            for a in range(rank):
+                row = np.zeros(len(pairs))
+                for p, (b, c) in enumerate(pairs):
+                    if b == a:
+                        row[p] += z[c]
+                    if c == a and b != c:
+                        row[p] += z[b]
+                rows.append(row)
+                rhs.append(y[a] - model["sigma"] * z[a])
+        e = np.linalg.lstsq(np.array(rows), np.array(rhs), rcond=None)[0]
+        hessian = model["sigma"] * np.eye(rank)
+        for p, (b, c) in enumerate(pairs):
+            hessian[b, c] += e[p]
+            if b != c:
+                hessian[c, b] += e[p]
+        model["hessian"] = hessian
+        model["gradient"] = coeffs @ gram[:, -1]
+        return model
+
+    @staticmethod
+    def surrogate_coords(model, x):
+        # the coordinates of x in the subspace of the model
+        return model["coeffs"] @ np.array([(v * x).sum() for v in model["vectors"]])
+
+    def surrogate_predict(self, model, u_pert_new):
+        s = u_pert_new - self.u_pert
+        z = self.surrogate_coords(model, s)
+        return (np.squeeze(self.j_val) + (self.g * s).sum()
+                + (model["sigma"] * (s ** 2.).sum() + z @ (model["hessian"] - model["sigma"] * np.eye(z.size)) @ z) / 2)
+
+    def surrogate_rms(self, s):
+        # the norm of pert_delta, i.e., the root mean square over the cells of pert_mask, see do_projection
+        return np.sqrt((s ** 2.).sum() / self.free_size())
+
+    def free_size(self):
+        return self.pert_mask.sum() if self.pert_mask is not None else self.u_pert.size
+
+    def surrogate_trial(self, process, t1, model, j_max, d):
+        # run the solver at the minimizer of the model within the trust region if the model predicts it to be better
+        # than the first trial of the line search along d, and accept it if it passes the condition of the line search
+        from utils import do_projection
+
+        radius = self.surrogate_delta * np.sqrt(self.free_size())
+        z = self.trust_region_step(model["gradient"], model["hessian"], radius)
+        step = sum([c * v for c, v in zip(model["coeffs"].T @ z, model["vectors"])])
+        u_pert_new = do_projection(self.u_pert + step, self.pert_delta, self.pert_mask)
+        gts = (self.g * (u_pert_new - self.u_pert)).sum()
+        j_pred = self.surrogate_predict(model, u_pert_new)
+        if gts >= 0 or j_pred >= np.squeeze(self.j_val):
+            return None, None
+        if self.surrogate_rms(d) <= self.surrogate_delta and j_pred >= self.surrogate_predict(model, self.u_pert + d):
+            return None, None
+        j_new = self.evaluate_obj(process, u_pert_new, t1)
+        self.update_trust_radius(model, u_pert_new, j_new)
+        if j_new <= j_max + self.gamma * gts:
+            self.surrogate_hits += 1
+            if self.mpi_rank == 0:
+                print("surrogate step accepted, trust radius = ", self.surrogate_delta)
+            return u_pert_new, j_new
+        return None, None
+
+    @staticmethod
+    def trust_region_step(b, hessian, radius):
+        # minimize b.z + z.hessian z / 2 subject to |z| <= radius, by the eigen-decomposition of the small hessian
+        lam, w = np.linalg.eigh(hessian)
+        bw = w.T @ b
+        if lam.min() > 0 and np.linalg.norm(bw / lam) <= radius:
+            return -w @ (bw / lam)
+        # on the boundary, |z(mu)| = radius with z(mu) = -(hessian + mu I)^-1 b decreasing for mu > -lam.min()
+        lo = max(0., -lam.min())
+        hi = lo + np.linalg.norm(b) / radius
+        for _ in range(100):
+            mu = (lo + hi) / 2.
+            if np.linalg.norm(bw / np.maximum(lam + mu, 1e-300)) > radius:
+                lo = mu
+            else:
+                hi = mu
+        return -w @ (bw / np.maximum(lam + hi, 1e-300))
+
+    def surrogate_screen(self, model, d, alpha, gtd, j_max):
+        # backtrack over the trials within the trust region which the model predicts to fail, without running them
+        while model is not None and alpha > self.min_float:
+            if self.surrogate_rms(alpha * d) > self.surrogate_delta:
+                break
+            j_pred = self.surrogate_predict(model, self.u_pert + alpha * d)
+            if j_pred <= j_max + self.gamma * alpha * gtd:
+                break
+            self.surrogate_skips += 1
+            if self.mpi_rank == 0:
+                print("surrogate: trial with alpha = {} is skipped".format(alpha))
+            alpha = self.backtrack(alpha, j_pred, gtd)
+        return alpha
+
+    def update_trust_radius(self, model, u_pert_new, j_new):
+        # compare the reduction of the objective with the one predicted by the model within the trust region
+        if model is None or self.surrogate_rms(u_pert_new - self.u_pert) > self.surrogate_delta:
+            return
+        predicted = np.squeeze(self.j_val) - self.surrogate_predict(model, u_pert_new)
+        if predicted <= 0:
+            return
+        ratio = (np.squeeze(self.j_val) - np.squeeze(j_new)) / predicted
+        if ratio < 0.25:
+            self.surrogate_delta /= 2.
+        elif ratio > 0.75:
+            # the feasible set has a diameter of 2 * pert_delta
+            self.surrogate_delta = min(2. * self.surrogate_delta, 2. * self.pert_delta)
+        return
+
+    def update_spectral_step(self, sts, sty):
+        # Barzilai-Borwein step length, safeguarded in [min_float, max_float]
+        if sty <= 0:
+            self.lambda_ = self.max_float
+        else:
+            self.lambda_ = np.min((self.max_float, np.max((self.min_float, sts / sty))))
+        return
+
+
+class Spg2Defn(CnopMethod):
+    def __init__(self, process, u_pert, t1, pert_delta, pert_mask=None, grad_epsilon=1e-8, **kwargs):
+        """
+        Spectral projected gradient method (SPG2)
+        :param process: the process object
+        :param u_pert: the initial perturbation
+        :param t1: the final time
+        :param pert_delta: the perturbation bound
+        :param pert_mask: the pert_mask for the perturbation
+        :param grad_epsilon: for computing gradient
+        :param kwargs: other options passed to CnopMethod, e.g., max_iter, j_num
+        """
+        super().__init__(process, u_pert, t1, pert_delta, pert_mask=pert_mask, grad_epsilon=grad_epsilon, **kwargs)
+        return
+
+    def search_direction(self):
+        return self.projected_gradient_direction()
+
+    def update_memory(self, s, y):
+        sts = (s ** 2.).sum()
+        sty = (s * y).sum()
+        self.update_spectral_step(sts, sty)
+        return {"sts": sts, "sty": sty}
+
+
+class ProjLbfgsDefn(CnopMethod):
+    vector_names = CnopMethod.vector_names + ("s_hist", "y_hist")
+
+    def __init__(self, process, u_pert, t1, pert_delta, pert_mask=None, grad_epsilon=1e-8,
+                 lbfgs_num=5, curvature_eps=1e-10, **kwargs):
+        """
+        Projected limited-memory BFGS method. The quasi-Newton step is projected onto the feasible set by
+        do_projection; the spectral projected gradient step is used whenever this is not a descent direction.
+        :param process: the process object
+        :param u_pert: the initial perturbation
+        :param t1: the final time
+        :param pert_delta: the perturbation bound
+        :param pert_mask: the pert_mask for the perturbation
+        :param grad_epsilon: for computing gradient
+        :param lbfgs_num: the number of (s, y) pairs kept in the memory
+        :param curvature_eps: (s, y) is stored only if s.y > curvature_eps * s.s
+        :param kwargs: other options passed to CnopMethod, e.g., max_iter, j_num
+        """
+        self.lbfgs_num = lbfgs_num
+        self.curvature_eps = curvature_eps
+        super().__init__(process, u_pert, t1, pert_delta, pert_mask=pert_mask, grad_epsilon=grad_epsilon, **kwargs)
         return
+
+    def init_memory(self):
+        # ring buffer of the (s, y) pairs, the pair k is stored at k % lbfgs_num
+        self.s_hist = self.zeros_memory(self.lbfgs_num)
+        self.y_hist = self.zeros_memory(self.lbfgs_num)
+        self.hist_count = 0
+        return
+
+    def apply_inverse_hessian(self, g):
+        # L-BFGS two-loop recursion
+        m = min(self.hist_count, self.lbfgs_num)
+        # slots from the oldest to the most recent pair
+        slots = [np.mod(self.hist_count - m + i, self.lbfgs_num) for i in range(m)]
+        rho = 1. / np.array([(self.s_hist[k] * self.y_hist[k]).sum() for k in slots])
+        alpha = np.zeros(m)
+        q = g.copy()
+        for i in range(m - 1, -1, -1):
+            alpha[i] = rho[i] * (self.s_hist[slots[i]] * q).sum()
+            q = q - alpha[i] * self.y_hist[slots[i]]
+        r = (self.s_hist[slots[-1]] * self.y_hist[slots[-1]]).sum() / (self.y_hist[slots[-1]] ** 2.).sum() * q
+        for i in range(m):
+            beta = rho[i] * (self.y_hist[slots[i]] * r).sum()
+            r = r + (alpha[i] - beta) * self.s_hist[slots[i]]
+        return r
+
+    def search_direction(self):
+        from utils import do_projection
+
+        if self.hist_count == 0:
+            return self.projected_gradient_direction()
+        d = self.u_pert - self.apply_inverse_hessian(self.g)
+        d = do_projection(d, self.pert_delta, self.pert_mask)
+        d = d - self.u_pert
+        if (self.g * d).sum() >= 0:
+            # not a descent direction, restart the memory and fall back to the projected gradient
+            if self.mpi_rank == 0:
+                print("L-BFGS direction is not descent; memory is reset.")
+            self.hist_count = 0
+            return self.projected_gradient_direction()
+        return d
+
+    def update_memory(self, s, y):
+        sts = (s ** 2.).sum()
+        sty = (s * y).sum()
+        if sty > self.curvature_eps * sts:
+            self.s_hist[np.mod(self.hist_count, self.lbfgs_num)] = s
+            self.y_hist[np.mod(self.hist_count, self.lbfgs_num)] = y
+            self.hist_count += 1
+        # the spectral step is kept for the projected gradient fallback
+        self.update_spectral_step(sts, sty)
+        return {"sts": sts, "sty": sty, "hist_count": min(self.hist_count, self.lbfgs_num)}
+
+
+class ProjCgDefn(CnopMethod):
+    vector_names = CnopMethod.vector_names + ("d_prev",)
+
+    def __init__(self, process, u_pert, t1, pert_delta, pert_mask=None, grad_epsilon=1e-8,
+                 cg_restart=None, **kwargs):
+        """
+        Projected nonlinear conjugate-gradient method (Polak-Ribiere+). The conjugate direction is scaled by the
+        spectral step and projected by do_projection; it restarts with the projected gradient when it is not descent.
+        :param process: the process object
+        :param u_pert: the initial perturbation
+        :param t1: the final time
+        :param pert_delta: the perturbation bound
+        :param pert_mask: the pert_mask for the perturbation
+        :param grad_epsilon: for computing gradient
+        :param cg_restart: restart with the projected gradient every cg_restart iterations, default is u_pert.size
+        :param kwargs: other options passed to CnopMethod, e.g., max_iter, j_num
+        """
+        self.cg_restart = cg_restart
+        super().__init__(process, u_pert, t1, pert_delta, pert_mask=pert_mask, grad_epsilon=grad_epsilon, **kwargs)
+        return
+
+    def init_memory(self):
+        if self.cg_restart is None:
+            self.cg_restart = self.u_pert.size
+        self.d_prev = self.u_pert * 0.
+        self.beta = 0.
+        return
+
+    def search_direction(self):
+        from utils import do_projection
+
+        if self.beta == 0. or np.mod(self.iter0, self.cg_restart) == 0:
+            d_cg = - self.g
+        else:
+            d_cg = - self.g + self.beta * self.d_prev
+        d = self.u_pert + self.lambda_ * d_cg
+        d = do_projection(d, self.pert_delta, self.pert_mask)
+        d = d - self.u_pert
+        if (self.g * d).sum() >= 0:
+            # not a descent direction, restart with the projected gradient
+            d_cg = - self.g
+            d = self.projected_gradient_direction()
+        self.d_prev = d_cg
+        return d
+
+    def update_memory(self, s, y):
+        sts = (s ** 2.).sum()
+        sty = (s * y).sum()
+        g_old = self.g - y
+        self.beta = max(0., (self.g * y).sum() / (g_old ** 2.).sum())
+        self.update_spectral_step(sts, sty)
+        return {"sts": sts, "sty": sty, "beta": self.beta}
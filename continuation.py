@@ -0,0 +1,63 @@
+import numpy as np
+from multi_start import make_search_process
+from cnop_methods import Spg2Defn
+
+
+class ContinuationDefn:
+    def __init__(self, process, u_pert, t1, pert_deltas, method=Spg2Defn, results_fn="continuation_results.npz",
+                 **kwargs):
+        """
+        Continuation of the CNOP over a sequence of perturbation bounds: the search of each bound starts from the
+        u_pert_best of the previous one, rescaled to the new bound, which usually converges in a fraction of the
+        iterations of a cold start. The basic state u0 and the unperturbed reference run at t1 are computed once and
+        reused by all searches. Each search has its own checkpoints (search id = index of the bound), so a restart
+        resumes the sequence where it stopped, and the results are written to results_fn after each bound.
+        :param process: the process object
+        :param u_pert: the initial perturbation of the first bound, e.g., from generate_u_pert
+        :param t1: the final time
+        :param pert_deltas: the sequence of perturbation bounds, usually increasing from the (nearly linear) small ones
+        :param method: the CNOP method class, e.g., Spg2Defn, ProjLbfgsDefn
+        :param results_fn: the results file (npz) written by rank 0, with pert_deltas, j_bests, u_pert_bests and the
+            numbers of iterations, objective and gradient evaluations of each bound
+        :param kwargs: other options passed to the method, e.g., pert_mask, grad_epsilon, max_iter
+        """
+        mpi_rank = process.mpi_rank
+        pert_deltas = np.atleast_1d(np.array(pert_deltas, dtype=float))
+        n_deltas = pert_deltas.size
+
+        # the reference run is shared by all searches
+        process.share_unperturbed(t1)
+
+        self.j_bests = np.full(n_deltas, np.inf)
+        self.u_pert_bests = []
+        self.iterations = np.zeros(n_deltas, dtype=int)
+        self.ifcnts = np.zeros(n_deltas, dtype=int)
+        self.igcnts = np.zeros(n_deltas, dtype=int)
+        u_start = u_pert
+        for i, pert_delta in enumerate(pert_deltas):
+            if i > 0:
+                # warm start: the previous optimum scaled to the new bound (the constraint is a norm ball)
+                u_start = self.u_pert_bests[-1] * pert_delta / pert_deltas[i - 1]
+            search_process = make_search_process(process, process.mpi_comm, i, process.mpi_fork_offset)
+            if mpi_rank == 0:
+                print("Continuation step {}: pert_delta = {}".format(i, pert_delta))
+            # the scratch is kept for the next bounds, and removed at the end
+            search = method(search_process, np.array(u_start, dtype=float), t1, pert_delta,
+                            **dict(kwargs, cleanup_scratch=False))
+            self.j_bests[i] = np.squeeze(search.j_best)
+            self.u_pert_bests.append(search.u_pert_best)
+            self.iterations[i] = search.iter0
+            self.ifcnts[i] = search.ifcnt
+            self.igcnts[i] = search.igcnt
+            if mpi_rank == 0:
+                np.savez(results_fn, pert_deltas=pert_deltas[:i + 1], j_bests=self.j_bests[:i + 1],
+                         u_pert_bests=np.array(self.u_pert_bests), iterations=self.iterations[:i + 1],
+                         ifcnts=self.ifcnts[:i + 1], igcnts=self.igcnts[:i + 1])
+
+        self.u_pert_bests = np.array(self.u_pert_bests)
+        if hasattr(process, "cleanup_scratch"):
+            process.cleanup_scratch()
+        if mpi_rank == 0:
+            print("j_best of all bounds: ", self.j_bests)
+            print("Number of iterations of all bounds: ", self.iterations)
+        return
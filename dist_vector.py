@@ -0,0 +1,145 @@
+import numpy as np
+from serial_mpi import mpi_module
+
+
+def partition(n, nparts):
+    """
+    Split n items into nparts contiguous parts, in the same way as np.array_split
+    :param n: number of items
+    :param nparts: number of parts
+    :return: counts and displacements of the parts
+    """
+    counts = np.full(nparts, n // nparts, dtype=int)
+    counts[:n % nparts] += 1
+    displs = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return counts, displs
+
+
+class DistVector:
+    # numpy defers the operators with numpy scalars to the reflected methods below, e.g., np.float64 * DistVector
+    __array_ufunc__ = None
+
+    def __init__(self, comm, field_shape, local):
+        """
+        A field (or a batch of fields) distributed over the ranks of comm. Each rank owns a contiguous slice of
+        the flattened (C order) field, so that elementwise operations are local and reductions are small
+        collectives. It supports the arithmetic used by the CNOP methods, so the same code runs on numpy arrays.
+        :param comm: the MPI communicator
+        :param field_shape: the global shape of one field
+        :param local: the local slice, with shape batch_shape + (count,)
+        """
+        self.comm = comm
+        self.mpi = mpi_module(comm)
+        self.field_shape = tuple(field_shape)
+        self.counts, self.displs = partition(int(np.prod(self.field_shape)), comm.Get_size())
+        self.local = local
+        return
+
+    @classmethod
+    def from_global(cls, comm, array, batch_ndim=0):
+        # take the local slice of an array which is available on all ranks, no communication is needed
+        array = np.asarray(array)
+        field_shape = array.shape[batch_ndim:]
+        rank = comm.Get_rank()
+        counts, displs = partition(int(np.prod(field_shape)), comm.Get_size())
+        # the size is explicit, so that an empty batch (e.g., an unused memory) keeps its layout
+        flat = array.reshape(array.shape[:batch_ndim] + (int(np.prod(field_shape)),))
+        return cls(comm, field_shape, flat[..., displs[rank]:displs[rank] + counts[rank]].copy())
+
+    @property
+    def shape(self):
+        return self.local.shape[:-1] + self.field_shape
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def owned_indices(self):
+        # flat indices of the field owned by this rank
+        rank = self.comm.Get_rank()
+        return np.arange(self.displs[rank], self.displs[rank] + self.counts[rank])
+
+    def _new(self, local):
+        return DistVector(self.comm, self.field_shape, local)
+
+    @staticmethod
+    def _local(other):
+        return other.local if isinstance(other, DistVector) else other
+
+    def copy(self):
+        return self._new(self.local.copy())
+
+    def zeros_batch(self, num):
+        return self._new(np.zeros((num,) + self.local.shape))
+
+    def __getitem__(self, i):
+        # only the batch dimension can be indexed
+        return self._new(self.local[i])
+
+    def __setitem__(self, i, value):
+        self.local[i] = self._local(value)
+        return
+
+    def __add__(self, other):
+        return self._new(self.local + self._local(other))
+
+    def __radd__(self, other):
+        return self._new(self._local(other) + self.local)
+
+    def __sub__(self, other):
+        return self._new(self.local - self._local(other))
+
+    def __rsub__(self, other):
+        return self._new(self._local(other) - self.local)
+
+    def __mul__(self, other):
+        return self._new(self.local * self._local(other))
+
+    def __rmul__(self, other):
+        return self._new(self._local(other) * self.local)
+
+    def __truediv__(self, other):
+        return self._new(self.local / self._local(other))
+
+    def __pow__(self, power):
+        return self._new(self.local ** power)
+
+    def __neg__(self):
+        return self._new(- self.local)
+
+    def __abs__(self):
+        return self._new(np.abs(self.local))
+
+    def sum(self):
+        return self.comm.allreduce(self.local.sum(), op=self.mpi.SUM)
+
+    def max(self):
+        return self.comm.allreduce(np.max(self.local, initial=-np.inf), op=self.mpi.MAX)
+
+    def min(self):
+        return self.comm.allreduce(np.min(self.local, initial=np.inf), op=self.mpi.MIN)
+
+    def gather(self, root=0):
+        """
+        Gather the full array on rank root by Gatherv
+        :param root: the rank to gather on
+        :return: the full array on root, None on other ranks
+        """
+        local = np.ascontiguousarray(self.local, dtype=float).reshape(-1, self.local.shape[-1])
+        full = np.empty((local.shape[0], self.counts.sum())) if self.comm.Get_rank() == root else None
+        for i in range(local.shape[0]):
+            recv = [full[i], self.counts, self.displs, self.mpi.DOUBLE] if full is not None else None
+            self.comm.Gatherv(local[i], recv, root=root)
+        return full.reshape(self.shape) if full is not None else None
+
+    def allgather(self):
+        """
+        Gather the full array on all ranks by Allgatherv
+        :return: the full array
+        """
+        local = np.ascontiguousarray(self.local, dtype=float).reshape(-1, self.local.shape[-1])
+        full = np.empty((local.shape[0], self.counts.sum()))
+        for i in range(local.shape[0]):
+            self.comm.Allgatherv(local[i], [full[i], self.counts, self.displs, self.mpi.DOUBLE])
+        return full.reshape(self.shape)
@@ -0,0 +1,138 @@
+import logging
+import numpy as np
+from utils import obj_fork_id
+from mpi_shared import bcast_shared, free_shared
+from dist_vector import DistVector
+
+
+def color_periods(shape, radius, periodic=False):
+    """
+    Periods of the coloring along each axis: the cells with the same color are more than 2 * radius apart along
+    some axis, so that their neighborhoods of influence (within radius) do not overlap
+    :param shape: the shape of the grid
+    :param radius: the influence radius in cells
+    :param periodic: whether the domain is periodic, then the period must divide the size of the axis
+    :return: list of the periods
+    """
+    periods = []
+    for n in shape:
+        period = min(2 * radius + 1, n)
+        if periodic:
+            while n % period != 0:
+                period += 1
+        periods.append(period)
+    return periods
+
+
+def color_cells(shape, periods):
+    # the color of each cell, cells are colored by their indices modulo the periods
+    color = np.zeros(shape, dtype=int)
+    for axis, period in enumerate(periods):
+        index = np.arange(shape[axis]).reshape([-1 if i == axis else 1 for i in range(len(shape))])
+        color = color * period + index % period
+    return color
+
+
+def box_sum(w, radius, periodic=False):
+    # sum of w over the box of cells within radius (in each axis) around each cell, by cumulative sums
+    for axis in range(w.ndim):
+        n = w.shape[axis]
+        if periodic and 2 * radius + 1 >= n:
+            # the box covers the whole (periodic) axis
+            w = np.repeat(w.sum(axis=axis, keepdims=True), n, axis=axis)
+            continue
+        pad = [(0, 0)] * w.ndim
+        pad[axis] = (radius + 1, radius)
+        cum = np.cumsum(np.pad(w, pad, mode="wrap" if periodic else "constant"), axis=axis)
+        w = (np.take(cum, np.arange(2 * radius + 1, 2 * radius + 1 + n), axis=axis)
+             - np.take(cum, np.arange(n), axis=axis))
+    return w
+
+
+def estimate_influence_radius(process, u_pert, t, epsilon, probe_scale=1e3, rtol=1e-8, margin=1):
+    """
+    Estimate the influence radius by perturbing the center cell and measuring how far the solution changes by more
+    than rtol of the largest change; one solver run on rank 0. The probe is probe_scale times larger than epsilon, so
+    that the far, small changes are above the roundoff of the solution, and the changes below the roundoff are ignored
+    :param process: the process object
+    :param u_pert: the perturbation, the full array on rank 0
+    :param t: the final time
+    :param epsilon: the finite-difference step of the gradient
+    :param probe_scale: the perturbation of the center cell in units of epsilon
+    :param rtol: the relative threshold of the change
+    :param margin: the number of cells added to the measured radius, for the changes just below the threshold
+    :return: the radius in cells, on all ranks
+    """
+    radius = None
+    if process.mpi_rank == 0:
+        ut_pert = process.proceed(t, u_pert=u_pert, fork_id=obj_fork_id(process))
+        center = tuple(n // 2 for n in u_pert.shape)
+        u_pert_eps = u_pert.copy()
+        u_pert_eps[center] += probe_scale * epsilon
+        delta = np.abs(process.proceed(t, u_pert=u_pert_eps, fork_id=obj_fork_id(process)) - ut_pert)
+        if delta.size != u_pert.size:
+            raise ValueError("The solution is not on the grid of the perturbation, see solution_on_grid.")
+        noise = 100 * np.finfo(float).eps * np.abs(ut_pert).max()
+        affected = np.argwhere(delta.reshape(u_pert.shape) > max(rtol * delta.max(), noise))
+        radius = int(np.abs(affected - np.array(center)).max()) + margin if affected.size > 0 else margin
+        print("Estimated influence radius = ", radius)
+    return process.mpi_comm.bcast(radius, root=0)
+
+
+def grad_colored(process, u_pert, t, epsilon, radius, periodic=False):
+    """
+    Gradient of the objective by Jacobian compression: the cells more than 2 * radius apart are perturbed in the same
+    run, and the change of the solution within radius of each perturbed cell is attributed to it. This needs one run
+    per color, i.e., (2 * radius + 1) ** ndim runs instead of one per cell, and gives the same result as grad_defn when
+    a cell does not influence the solution beyond radius by t. The solution must be on the grid of the perturbation
+    (e.g., Burgers, or solution_on_grid of Simulation). The colors are spread over the ranks
+    :param process: the process object
+    :param u_pert: the perturbation, a numpy array on all ranks or a DistVector
+    :param t: the final time
+    :param epsilon: for computing gradient
+    :param radius: the influence radius in cells, e.g., from estimate_influence_radius
+    :param periodic: whether the domain is periodic
+    :return: the gradient, with the same layout as u_pert
+    """
+    mpi_comm = process.mpi_comm
+    mpi_rank = process.mpi_rank
+    distributed = isinstance(u_pert, DistVector)
+    if distributed:
+        u_pert_dist = u_pert
+        u_pert = bcast_shared(process, u_pert_dist.gather())
+
+    # the reference solutions without and with the current perturbation, stored once per node
+    if mpi_rank == 0:
+        ut = process.proceed(t)
+        ut_pert = process.proceed(t, u_pert=u_pert, fork_id=obj_fork_id(process))
+        if ut.size != u_pert.size:
+            raise ValueError("The solution is not on the grid of the perturbation, see solution_on_grid.")
+    else:
+        ut = ut_pert = None
+    ut = bcast_shared(process, ut)
+    ut_pert = bcast_shared(process, ut_pert)
+
+    periods = color_periods(u_pert.shape, radius, periodic=periodic)
+    color = color_cells(u_pert.shape, periods)
+    n_colors = int(np.prod(periods))
+    if mpi_rank == 0:
+        logging.debug("Computing colored gradient with {} colors...".format(n_colors))
+
+    g = np.zeros(u_pert.shape)
+    diff = (ut_pert - ut).reshape(u_pert.shape)
+    for c in np.array_split(np.arange(n_colors), process.mpi_size)[mpi_rank]:
+        cells = color == c
+        u_pert_eps = u_pert + epsilon * cells
+        delta = (process.proceed(t, u_pert=u_pert_eps, fork_id=process.mpi_fork_offset + mpi_rank)
+                 - ut_pert).reshape(u_pert.shape)
+        # the change of the objective -sum((ut_pert - ut) ** 2) restricted to the neighborhood of each cell
+        w = - (2 * diff * delta + delta ** 2) / epsilon
+        g[cells] = box_sum(w, radius, periodic=periodic)[cells]
+    mpi_comm.Allreduce(process.mpi.IN_PLACE, g, op=process.mpi.SUM)
+
+    free_shared(process, ut)
+    free_shared(process, ut_pert)
+    if distributed:
+        free_shared(process, u_pert)
+        return DistVector.from_global(mpi_comm, g)
+    return g
@@ -2,102 +2,177 @@ import numpy as np
 import logging
 import pathlib
 import time
-from utils import print_progress, wait_for_files
+from utils import print_progress, wait_for_files, obj_fork_id
+from mpi_shared import bcast_shared, free_shared
+from dist_vector import DistVector
+from grad_shards import GradShardWriter, load_grad_shards, remove_done_markers, remove_grad_shards, shard_done_fn, \
+    shard_counts, record_failure, failure_counts
+from metrics import update_metrics
+from async_launcher import run_concurrently
 
 
-def grad_defn(process, u_pert, t, epsilon, iter0=None, resume_flag_file="resume_needed.txt"):
+def grad_defn(process, u_pert, t, epsilon, iter0=None, resume_flag_file="resume_needed.txt", storage_dtype=None,
+              metrics_fn=None, metrics_interval=10., runs_in_flight=1, pipelined=False):
     mpi_comm = process.mpi_comm
     mpi_size = process.mpi_size
     mpi_rank = process.mpi_rank
-    mpi_root_dir = process.mpi_root_dir
+    tmp_dir = grad_tmp_dir(process)
 
     if mpi_rank == 0:
         logging.debug("Computing gradient...")
 
+    # with a list of horizons t, the gradients of all horizons are computed from the same runs (see proceed), and the
+    # gradient of each index has one value per horizon
+    value_shape = np.shape(t)
+    distributed = isinstance(u_pert, DistVector)
+    if distributed and len(value_shape) > 0:
+        raise ValueError("The gradient of several horizons is not supported for distributed vectors!")
+    if distributed:
+        # every run needs the full perturbation, which is gathered once and stored once per node
+        u_pert_dist = u_pert
+        u_pert = bcast_shared(process, u_pert_dist.gather())
+
     # compute the objective value
     if mpi_rank == 0:
         ut = process.proceed(t)
-        ut_pert = process.proceed(t, u_pert=u_pert)
-        j_val = - ((ut_pert - ut) ** 2).sum()
+        ut_pert = process.proceed(t, u_pert=u_pert, fork_id=obj_fork_id(process))
+        j_val = - ((ut_pert - ut) ** 2).sum(axis=-1)
 
         mpi_comm.Bcast(j_val, root=0)
+    else:
+        ut = None
+        j_val = np.empty(value_shape if value_shape else 1, dtype=float)
+        mpi_comm.Bcast(j_val, root=0)
 
-        ut_size = np.array([ut.size], dtype=int)
-        mpi_comm.Bcast(ut_size, root=0)
+    # the reference ut is read-only, so it is stored once per node
+    ut = bcast_shared(process, ut)
 
-        mpi_comm.Bcast(ut, root=0)
+    shape = u_pert.shape
+    if distributed:
+        # owner-computes: each rank computes (or loads) the gradient of the indices it owns
+        owned_indices = u_pert_dist.owned_indices
     else:
-        j_val = np.empty(1, dtype=float)
-        mpi_comm.Bcast(j_val, root=0)
+        owned_indices = np.arange(u_pert.size)
+    g_local = np.zeros((owned_indices.size,) + value_shape)
+    index_offset = owned_indices[0] if owned_indices.size > 0 else 0
 
-        ut_size = np.empty(1, dtype=int)
-        mpi_comm.Bcast(ut_size, root=0)
+    # record the indices that have been computed in the last iteration and prepare to compute the rest; the shards
+    # are read by rank 0 only, and the completed-index bitmap is broadcasted in packed form
+    done_packed = np.empty((u_pert.size + 7) // 8, dtype=np.uint8)
+    if mpi_rank == 0:
+        done, g_loaded = load_grad_shards(tmp_dir, iter0, u_pert.size, storage_dtype=storage_dtype,
+                                          value_shape=value_shape)
+        remove_done_markers(tmp_dir, iter0)
+        done_packed[:] = np.packbits(done)
+    mpi_comm.Bcast(done_packed, root=0)
+    done = np.unpackbits(done_packed, count=u_pert.size).astype(bool)
 
-        ut = np.empty(ut_size[0], dtype=float)
-        mpi_comm.Bcast(ut, root=0)
+    if distributed:
+        counts, displs = u_pert_dist.counts, u_pert_dist.displs
+        mpi_comm.Scatterv([g_loaded, counts, displs, process.mpi.DOUBLE] if mpi_rank == 0 else None, g_local,
+                          root=0)
+    elif mpi_rank == 0:
+        # without distribution, loading is done by rank 0 only to avoid duplicated counting,
+        # and then broadcasted to all ranks by Allreduce at the end
+        g_local[:] = g_loaded
 
-    shape = u_pert.shape
-    g_local = np.zeros(shape)
-
-    indices_to_be_computed = list(np.ndindex(shape))
-
-    # record the indices that have been computed in the last iteration and prepare to compute the rest
-    for index in indices_to_be_computed.copy():
-        tmp_fn = "{}/tmp/tmp_grad_defn_iter_{}_index_{}_{}_{}.npy".format(mpi_root_dir, iter0, index[0], index[1], index[2])
-        if pathlib.Path(tmp_fn).exists():
-            if mpi_rank == 0:
-                # loading is done by rank 0 only to avoid duplicated counting,
-                # and then broadcasted to all ranks by Allreduce at the end
-                g_local[tuple(index)] = np.load(tmp_fn)
-                logging.debug("Rank {}: Loaded gradient for index {}".format(mpi_rank, index))
-            indices_to_be_computed.remove(index)
-    if mpi_rank == 0 and (g_local.size - len(indices_to_be_computed)) > 0:
-        print(f"Rank {mpi_rank}: {g_local.size - len(indices_to_be_computed)} indices already computed and loaded; "
-              f"{len(indices_to_be_computed)} indices to be computed")
+    indices_to_be_computed = owned_indices[~done[owned_indices]]
+    if mpi_rank == 0 and (owned_indices.size - indices_to_be_computed.size) > 0:
+        print(f"Rank {mpi_rank}: {owned_indices.size - indices_to_be_computed.size} indices already computed and "
+              f"loaded; {indices_to_be_computed.size} indices to be computed")
 
     # create tmp directory if it does not exist
-    if mpi_rank == 0 and not pathlib.Path(f"{mpi_root_dir}/tmp").exists():
-        pathlib.Path(f"{mpi_root_dir}/tmp").mkdir()
+    if mpi_rank == 0 and not pathlib.Path(tmp_dir).exists():
+        pathlib.Path(tmp_dir).mkdir(parents=True)
 
     mpi_comm.Barrier()
 
-    indices_per_process = np.array_split(indices_to_be_computed, mpi_size)
-    my_indices = indices_per_process[mpi_rank]
+    if distributed:
+        my_indices = indices_to_be_computed
+    else:
+        my_indices = np.array_split(indices_to_be_computed, mpi_size)[mpi_rank]
+    if len(my_indices) > 0:
+        # create the tmp shard for grad_defn restart
+        shard = GradShardWriter(tmp_dir, iter0, mpi_rank, storage_dtype=storage_dtype, value_shape=value_shape)
+    n_jobs_all = np.array(mpi_comm.allgather(len(my_indices)))
+
+    if metrics_fn is not None and mpi_rank == 0:
+        # the progress of all ranks is followed by the sizes of their shards, without communication
+        metrics_start = {"time": time.time(),
+                         "shard_counts": shard_counts(tmp_dir, iter0, mpi_size, storage_dtype, value_shape),
+                         "n_loaded": int(done.sum()),
+                         "resumed": pathlib.Path(f"{process.mpi_root_dir}/{resume_flag_file}").exists()}
 
     time_elapsed = np.empty(len(my_indices), dtype=float)
-    for i, index in enumerate(my_indices):
-        logging.debug(
-            "Rank {}: Computing gradient [{}/{}] for index {}".format(mpi_rank, i + 1, len(my_indices), index))
-        time_start = time.time()
+    time_start = {}
 
-        # create tmp files for grad_defn restart
-        tmp_fn = "{}/tmp/tmp_grad_defn_iter_{}_index_{}_{}_{}.npy".format(mpi_root_dir, iter0, index[0], index[1], index[2])
-        g_local[tuple(index)] = compute_g(mpi_rank, index, u_pert, epsilon, t, ut, j_val, process)
-        np.save(tmp_fn, g_local[tuple(index)])
+    def jobs():
+        for i, flat_index in enumerate(my_indices):
+            logging.debug("Rank {}: Computing gradient [{}/{}] for index {}".format(
+                mpi_rank, i + 1, len(my_indices), np.unravel_index(flat_index, shape)))
+            time_start[flat_index] = time.time()
+            u_pert_eps = u_pert.copy()
+            u_pert_eps.flat[flat_index] += epsilon
+            yield flat_index, u_pert_eps
 
-        time_end = time.time()
-        logging.debug("Rank {}: Gradient [{}/{}] for index {} is {}".format(mpi_rank, i + 1, len(my_indices), index,
-                                                                            g_local[tuple(index)]))
-        time_elapsed[i] = time_end - time_start
+    def on_result(flat_index, ut_pert_eps):
+        # the runs may finish in another order than they started if runs_in_flight > 1, so i counts the finished runs
+        i = n_finished[0]
+        n_finished[0] += 1
+        j_pert = -((ut_pert_eps - ut) ** 2).sum(axis=-1)
+        g_local[flat_index - index_offset] = (j_pert - j_val) / epsilon
+        # the shard may be stored in reduced precision, e.g., storage_dtype="float32"
+        shard.append(flat_index, g_local[flat_index - index_offset])
+
+        time_elapsed[i] = time.time() - time_start.pop(flat_index)
+        logging.debug("Rank {}: Gradient [{}/{}] for index {} is {}".format(mpi_rank, i + 1, len(my_indices),
+                                                                            np.unravel_index(flat_index, shape),
+                                                                            g_local[flat_index - index_offset]))
 
         if mpi_rank == 0:
             print_progress(f"Finished [{i + 1}/{len(my_indices)}] at rank {mpi_rank} in {time_elapsed[i]:.2f} s, "
                            f"min: {time_elapsed[:i+1].min():.2f} s, max: {time_elapsed[:i+1].max():.2f} s")
+            if metrics_fn is not None:
+                update_metrics(metrics_fn, "gradient",
+                               grad_metrics(tmp_dir, iter0, storage_dtype, value_shape, u_pert.size, n_jobs_all,
+                                            metrics_start),
+                               min_interval=metrics_interval)
+
+    n_finished = [0]
+    try:
+        run_concurrently(process, t, jobs(), on_result, runs_in_flight=runs_in_flight, pipelined=pipelined)
+    except Exception:
+        # e.g., the run did not start or finish within the timeouts of Simulation; it is counted for the metrics
+        # before the job fails
+        record_failure(tmp_dir, iter0, mpi_rank, "failed")
+        if metrics_fn is not None and mpi_rank == 0:
+            update_metrics(metrics_fn, "gradient",
+                           grad_metrics(tmp_dir, iter0, storage_dtype, value_shape, u_pert.size, n_jobs_all,
+                                        metrics_start))
+        raise
 
-    # get the list of last tmp file name for each rank to check if all ranks have finished computing gradient
-    tmp_fns_last = []
-    for each_rank in range(mpi_size):
-        if len(indices_per_process[each_rank]) > 0:  # if there are indices to be computed by this rank
-            tmp_fns_last.append("{}/tmp/tmp_grad_defn_iter_{}_index_{}_{}_{}.npy".
-                                format(mpi_root_dir, iter0, *indices_per_process[each_rank][-1]))
+    if len(my_indices) > 0:
+        shard.close()
+
+    # get the done markers of the ranks with indices to check if all ranks have finished computing gradient
+    done_fns = [shard_done_fn(tmp_dir, iter0, rank) for rank in np.flatnonzero(n_jobs_all > 0)]
 
-    max_jobs_per_process = max([len(indices) for indices in indices_per_process])
+    max_jobs_per_process = n_jobs_all.max()
     # only check if all ranks have finished computing gradient when the ranks have the same/max number of jobs
     # to avoid premature abort due to the rank with fewer jobs finishing earlier
     # TODO: this might still cause freeze if all (maybe few) ranks having the same/max number of jobs are stuck
     if len(my_indices) == max_jobs_per_process:
-        if not wait_for_files(tmp_fns_last, timeout=60, poll_interval=1):
+        if not wait_for_files(done_fns, timeout=60, poll_interval=1):
             logging.error("Rank {}: Not all ranks finished computing gradient".format(mpi_rank))
+            # the first of the waiting ranks counts the unfinished ranks, so that they are counted once
+            if mpi_rank == np.flatnonzero(n_jobs_all == max_jobs_per_process)[0]:
+                for fn in done_fns:
+                    if not pathlib.Path(fn).exists():
+                        record_failure(tmp_dir, iter0, mpi_rank, "timed_out")
+                if metrics_fn is not None and mpi_rank == 0:
+                    update_metrics(metrics_fn, "gradient",
+                                   grad_metrics(tmp_dir, iter0, storage_dtype, value_shape, u_pert.size, n_jobs_all,
+                                                metrics_start))
             # if not all ranks have finished computing gradient, generate a resume flag file for the job submission
             # script
             if not pathlib.Path(f"{process.mpi_root_dir}/{resume_flag_file}").exists():
@@ -128,30 +203,147 @@ def grad_defn(process, u_pert, t, epsilon, iter0=None, resume_flag_file="resume_
               "Single run: min = {}, max = {}, \n"
               "Total  run: min = {}, max = {}".format(time_min[0], time_max[0], time_min[1], time_max[1]))
 
-    # gather all the gradients
-    g_global = np.zeros(shape)
-    logging.debug("Rank {}: Gathering gradients...".format(mpi_rank))
-    mpi_comm.Allreduce(g_local, g_global, op=process.mpi.SUM)
-    logging.debug("Rank {}: Gradients gathered".format(mpi_rank))
+    if distributed:
+        # the gradient stays distributed, no assembly is needed
+        g_global = DistVector(mpi_comm, shape, g_local)
+        # make sure no rank is still waiting for the done markers before deleting them
+        mpi_comm.Barrier()
+    else:
+        # gather all the gradients
+        g_global = np.zeros(g_local.shape)
+        logging.debug("Rank {}: Gathering gradients...".format(mpi_rank))
+        mpi_comm.Allreduce(g_local, g_global, op=process.mpi.SUM)
+        # one gradient per horizon, if any
+        g_global = np.moveaxis(g_global, 0, -1).reshape(value_shape + shape)
+        logging.debug("Rank {}: Gradients gathered".format(mpi_rank))
 
-    # At these stage, all ranks have computed/loaded the gradients, so we can delete the tmp files for iter0
+    # At these stage, all ranks have computed/loaded the gradients, so we can delete the shards for iter0
     if mpi_rank == 0:
-        for index in list(np.ndindex(shape)):
-            tmp_fn = "{}/tmp/tmp_grad_defn_iter_{}_index_{}_{}_{}.npy".format(mpi_root_dir, iter0,
-                                                                          index[0], index[1], index[2])
-            if pathlib.Path(tmp_fn).exists():
-                pathlib.Path(tmp_fn).unlink()
+        if metrics_fn is not None:
+            update_metrics(metrics_fn, "gradient",
+                           grad_metrics(tmp_dir, iter0, storage_dtype, value_shape, u_pert.size, n_jobs_all,
+                                            metrics_start))
+        remove_grad_shards(tmp_dir, iter0)
 
+    if mpi_rank == 0:
         # no need to resume the simulation since the gradients are successfully computed
         if pathlib.Path(f"{process.mpi_root_dir}/{resume_flag_file}").exists():
             pathlib.Path(f"{process.mpi_root_dir}/{resume_flag_file}").unlink()
 
+    free_shared(process, ut)
+    if distributed:
+        free_shared(process, u_pert)
+
     return g_global
 
 
-def compute_g(fork_id, index, u_pert, epsilon, t, ut, j_val, process):
-    u_pert_eps = u_pert.copy()
-    u_pert_eps[tuple(index)] += epsilon
-    ut_pert_eps = process.proceed(t, u_pert=u_pert_eps, fork_id=fork_id)
-    j_pert = -((ut_pert_eps - ut) ** 2).sum()
-    return (j_pert - j_val) / epsilon
+def grad_directional(process, u_pert, directions, t, epsilon, j_val):
+    """
+    Finite-difference directional derivatives of the objective at u_pert, one solver run per direction; the
+    directions are spread over the ranks
+    :param process: the process object
+    :param u_pert: the perturbation, available on all ranks
+    :param directions: list of the directions, available on all ranks
+    :param t: the final time
+    :param epsilon: the finite-difference step along each direction
+    :param j_val: the objective value at u_pert
+    :return: array of the directional derivatives, on all ranks
+    """
+    mpi_comm = process.mpi_comm
+    mpi_rank = process.mpi_rank
+    ut = process.proceed(t) if mpi_rank == 0 else None
+    ut = bcast_shared(process, ut)
+
+    derivatives = np.zeros(len(directions))
+    for i in np.array_split(np.arange(len(directions)), process.mpi_size)[mpi_rank]:
+        ut_pert_eps = process.proceed(t, u_pert=u_pert + epsilon * directions[i],
+                                      fork_id=process.mpi_fork_offset + mpi_rank)
+        j_pert = -((ut_pert_eps - ut) ** 2).sum()
+        derivatives[i] = (j_pert - j_val) / epsilon
+    mpi_comm.Allreduce(process.mpi.IN_PLACE, derivatives, op=process.mpi.SUM)
+
+    free_shared(process, ut)
+    return derivatives
+
+
+def grad_speculative(process, u_pert, t, epsilon, n_runs=1):
+    """
+    Start the gradient at u_pert on a rank other than rank 0, while rank 0 is evaluating the objective at u_pert
+    (see CnopMethod.line_search). The rank runs n_runs indices of its own (rank r takes the indices from
+    (r - 1) * n_runs) and keeps the perturbed objectives, since the objective at u_pert is not known yet.
+    No collective is used
+    :param process: the process object
+    :param u_pert: the perturbation, the full array
+    :param t: the final time
+    :param epsilon: for computing gradient
+    :param n_runs: the number of indices of this rank
+    :return: the flat indices and their perturbed objective values
+    """
+    mpi_rank = process.mpi_rank
+    indices = np.arange((mpi_rank - 1) * n_runs, min(mpi_rank * n_runs, u_pert.size))
+    j_perts = np.zeros(indices.size)
+    if indices.size == 0:
+        return indices, j_perts
+    # the unperturbed solution is shared beforehand, so it is not recomputed here
+    ut = process.proceed(t)
+    for i, flat_index in enumerate(indices):
+        u_pert_eps = u_pert.copy()
+        u_pert_eps.flat[flat_index] += epsilon
+        ut_pert_eps = process.proceed(t, u_pert=u_pert_eps, fork_id=process.mpi_fork_offset + mpi_rank)
+        j_perts[i] = -((ut_pert_eps - ut) ** 2).sum()
+    return indices, j_perts
+
+
+def store_speculative(process, iter0, indices, j_perts, j_val, epsilon, storage_dtype=None):
+    # the speculative gradient is kept in the shard of the rank, where grad_defn at the same point and iter0 loads it
+    if len(indices) == 0:
+        return
+    tmp_dir = grad_tmp_dir(process)
+    pathlib.Path(tmp_dir).mkdir(parents=True, exist_ok=True)
+    shard = GradShardWriter(tmp_dir, iter0, process.mpi_rank, storage_dtype=storage_dtype)
+    for flat_index, j_pert in zip(indices, j_perts):
+        shard.append(flat_index, (j_pert - j_val) / epsilon)
+    shard.close()
+    return
+
+
+def grad_tmp_dir(process):
+    # concurrent searches (see multi_start.py) and fidelity levels keep their temporary gradient files apart
+    tmp_dir = f"{process.mpi_root_dir}/tmp"
+    if process.mpi_search_id is not None:
+        tmp_dir += f"/search_{process.mpi_search_id}"
+    if process.fidelity_ladder:
+        tmp_dir += f"/level_{process.fidelity_level}"
+    return tmp_dir
+
+
+def grad_metrics(tmp_dir, iter0, storage_dtype, value_shape, size, n_jobs_all, metrics_start):
+    # progress, per-rank throughput and ETA of the gradient, from the records added to the shards since the start, and
+    # the failed and unfinished runs of all the attempts of the gradient
+    elapsed = time.time() - metrics_start["time"]
+    completed = np.minimum(shard_counts(tmp_dir, iter0, n_jobs_all.size, storage_dtype, value_shape)
+                           - metrics_start["shard_counts"], n_jobs_all)
+    throughput = completed / max(elapsed, 1e-10)
+    queue_depth = n_jobs_all - completed
+    # the ranks which have not finished any index yet are assumed to be as fast as the others on average, and the
+    # gradient is finished when the slowest rank has finished its queue
+    if np.any(completed > 0):
+        rate = np.where(completed > 0, throughput, throughput[completed > 0].mean())
+        eta = np.max(queue_depth / rate)
+    else:
+        eta = np.inf
+    failures = failure_counts(tmp_dir, iter0)
+    return {"iter0": iter0,
+            "n_indices": size,
+            "n_loaded": metrics_start["n_loaded"],
+            "completion": (metrics_start["n_loaded"] + completed.sum()) / size,
+            "resumed": metrics_start["resumed"],
+            "failed_runs": failures["failed"],
+            "timed_out_runs": failures["timed_out"],
+            "elapsed": elapsed,
+            "throughput": throughput.sum(),
+            "eta": eta,
+            "queue_depth": queue_depth.sum(),
+            "rank_throughput": throughput,
+            "rank_queue_depth": queue_depth}
+
@@ -0,0 +1,133 @@
+import glob
+import os
+import pathlib
+import numpy as np
+
+
+def shard_dtype(storage_dtype=None, value_shape=()):
+    # one record per computed index: the flat index and the gradient (one value per horizon if value_shape is not
+    # empty), which may be stored in reduced precision
+    return np.dtype([("index", "<i8"), ("value", np.dtype(storage_dtype or float).newbyteorder("<"), value_shape)])
+
+
+def shard_fn(tmp_dir, iter0, rank):
+    return "{}/tmp_grad_defn_iter_{}_rank_{}.bin".format(tmp_dir, iter0, rank)
+
+
+def shard_done_fn(tmp_dir, iter0, rank):
+    return "{}/tmp_grad_defn_iter_{}_rank_{}.done".format(tmp_dir, iter0, rank)
+
+
+def shard_failures_fn(tmp_dir, iter0, rank):
+    return "{}/tmp_grad_defn_iter_{}_rank_{}.failures".format(tmp_dir, iter0, rank)
+
+
+class GradShardWriter:
+    def __init__(self, tmp_dir, iter0, rank, storage_dtype=None, fsync_batch=16, value_shape=()):
+        """
+        Append-only shard of the gradient of one rank, which replaces one tmp file per index. Every record is flushed
+        to the OS once it is written, and the shard is fsynced every fsync_batch records so that at most the last batch
+        is lost if the node goes down. A done marker is written when the rank has finished all its indices.
+        :param tmp_dir: the tmp directory of the gradient
+        :param iter0: the iteration of the gradient
+        :param rank: the rank writing the shard
+        :param storage_dtype: the dtype of the stored gradient, e.g., "float32"; float by default
+        :param fsync_batch: number of records between two fsyncs
+        :param value_shape: the shape of the gradient of one index, e.g., (number of horizons,)
+        """
+        self.dtype = shard_dtype(storage_dtype, value_shape)
+        self.fn = shard_fn(tmp_dir, iter0, rank)
+        self.done_fn = shard_done_fn(tmp_dir, iter0, rank)
+        self.fsync_batch = fsync_batch
+        self.n_unsynced = 0
+        # in case of resume, the records of the previous run are kept and the new ones appended; a record which was
+        # partially written when the run was killed is cut off first, so that the new records stay aligned
+        if os.path.exists(self.fn):
+            size = os.path.getsize(self.fn)
+            os.truncate(self.fn, size // self.dtype.itemsize * self.dtype.itemsize)
+        self.file = open(self.fn, "ab")
+        return
+
+    def append(self, index, value):
+        record = np.array((index, value), dtype=self.dtype)
+        self.file.write(record.tobytes())
+        self.file.flush()
+        self.n_unsynced += 1
+        if self.n_unsynced >= self.fsync_batch:
+            self.sync()
+        return
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.n_unsynced = 0
+        return
+
+    def close(self):
+        self.sync()
+        self.file.close()
+        pathlib.Path(self.done_fn).touch()
+        return
+
+
+def load_grad_shards(tmp_dir, iter0, size, storage_dtype=None, value_shape=()):
+    """
+    Load the shards of all ranks (of this or a previous run, which may have had another number of ranks)
+    :param tmp_dir: the tmp directory of the gradient
+    :param iter0: the iteration of the gradient
+    :param size: the number of indices of the gradient
+    :param storage_dtype: the dtype of the stored gradient
+    :param value_shape: the shape of the gradient of one index
+    :return: the completed-index bitmap (bool array) and the gradient (zero where not completed)
+    """
+    dtype = shard_dtype(storage_dtype, value_shape)
+    done = np.zeros(size, dtype=bool)
+    values = np.zeros((size,) + tuple(value_shape), dtype=float)
+    for fn in glob.glob(shard_fn(tmp_dir, iter0, "*")):
+        data = pathlib.Path(fn).read_bytes()
+        # a record which was partially written when the run was killed is dropped
+        records = np.frombuffer(data[:len(data) - len(data) % dtype.itemsize], dtype=dtype)
+        done[records["index"]] = True
+        values[records["index"]] = records["value"]
+    return done, values
+
+
+def shard_counts(tmp_dir, iter0, n_ranks, storage_dtype=None, value_shape=()):
+    # number of records in the shard of each rank, from the file sizes only
+    itemsize = shard_dtype(storage_dtype, value_shape).itemsize
+    counts = np.zeros(n_ranks, dtype=int)
+    for rank in range(n_ranks):
+        if os.path.exists(shard_fn(tmp_dir, iter0, rank)):
+            counts[rank] = os.path.getsize(shard_fn(tmp_dir, iter0, rank)) // itemsize
+    return counts
+
+
+def record_failure(tmp_dir, iter0, rank, kind):
+    # one line per failed ("failed") or unfinished ("timed_out") solver run; the file is kept over the job restarts
+    # of the gradient, so that it counts the failures of all its attempts
+    pathlib.Path(tmp_dir).mkdir(parents=True, exist_ok=True)
+    with open(shard_failures_fn(tmp_dir, iter0, rank), "a") as f:
+        f.write(kind + "\n")
+    return
+
+
+def failure_counts(tmp_dir, iter0):
+    # number of the failures of each kind recorded by all ranks
+    counts = {"failed": 0, "timed_out": 0}
+    for fn in glob.glob(shard_failures_fn(tmp_dir, iter0, "*")):
+        for kind in pathlib.Path(fn).read_text().split():
+            counts[kind] = counts.get(kind, 0) + 1
+    return counts
+
+
+def remove_done_markers(tmp_dir, iter0):
+    # the markers of a previous run would be mistaken for finished ranks
+    for fn in glob.glob(shard_done_fn(tmp_dir, iter0, "*")):
+        pathlib.Path(fn).unlink()
+    return
+
+
+def remove_grad_shards(tmp_dir, iter0):
+    for fn in glob.glob(shard_fn(tmp_dir, iter0, "*")) + glob.glob(shard_done_fn(tmp_dir, iter0, "*")) + \
+            glob.glob(shard_failures_fn(tmp_dir, iter0, "*")):
+        pathlib.Path(fn).unlink()
+    return
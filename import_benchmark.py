@@ -0,0 +1,56 @@
+import json
+import subprocess
+import sys
+import numpy as np
+
+# the modules whose import dominates the start of the ranks
+HEAVY_MODULES = ("mpi4py.MPI", "h5py", "yt", "matplotlib")
+
+MEASURE = """
+import json, sys, time
+time_start = time.perf_counter()
+import {module}
+time_import = time.perf_counter() - time_start
+print(json.dumps({{"time": time_import, "heavy": [m for m in {heavy} if m in sys.modules]}}))
+"""
+
+
+def time_import(module, repeat=5, python=sys.executable):
+    """
+    Time the import of a module in fresh interpreters, as every rank of a job does on start
+    :param module: the module name, e.g., "cnop_methods"
+    :param repeat: the number of interpreters; the first one also measures the cold file-system cache
+    :param python: the Python executable
+    :return: the import times (s), and the heavy modules loaded by the import
+    """
+    times = []
+    heavy = []
+    for _ in range(repeat):
+        result = subprocess.run([python, "-c", MEASURE.format(module=module, heavy=HEAVY_MODULES)],
+                                capture_output=True, text=True, check=True)
+        info = json.loads(result.stdout.strip().splitlines()[-1])
+        times.append(info["time"])
+        heavy = info["heavy"]
+    return np.array(times), heavy
+
+
+def benchmark_imports(modules, repeat=5):
+    # print a table of the import times of the modules
+    print("{:<24s} {:>10s} {:>10s} {:>10s}  {}".format("module", "first (s)", "median (s)", "min (s)", "heavy imports"))
+    results = {}
+    for module in modules:
+        try:
+            times, heavy = time_import(module, repeat=repeat)
+        except subprocess.CalledProcessError as e:
+            print("{:<24s} failed: {}".format(module, e.stderr.strip().splitlines()[-1]))
+            continue
+        results[module] = times
+        print("{:<24s} {:>10.3f} {:>10.3f} {:>10.3f}  {}".format(module, times[0], np.median(times), times.min(),
+                                                                  ", ".join(heavy) if heavy else "-"))
+    return results
+
+
+if __name__ == "__main__":
+    # e.g., python import_benchmark.py cnop_methods solvers.burgers; run from the repository root
+    default_modules = ["numpy", "cnop_methods", "grad_defn", "sim_controller", "solvers.burgers", "solvers.flash"]
+    benchmark_imports(sys.argv[1:] if len(sys.argv) > 1 else default_modules)
@@ -0,0 +1,130 @@
+import time
+import warnings
+import numpy as np
+
+
+def fit_scaling_model(wrapper_nprocs, times):
+    """
+    Fit the wall time of one solver run with w children by T(w) = a + b / w + c * w, i.e., the start-up and serial
+    part a, the perfectly parallel part b, and the communication overhead c; all coefficients are non-negative and the
+    terms which would be negative are dropped
+    :param wrapper_nprocs: the measured numbers of children
+    :param times: the measured wall times
+    :return: the coefficients (a, b, c)
+    """
+    w = np.asarray(wrapper_nprocs, dtype=float)
+    times = np.asarray(times, dtype=float)
+    basis = np.array([np.ones_like(w), 1. / w, w]).T
+    # the overhead term cannot be determined with less than three distinct values
+    active = [0, 1, 2] if np.unique(w).size >= 3 else [0, 1]
+    while True:
+        coeffs, _, _, _ = np.linalg.lstsq(basis[:, active], times, rcond=None)
+        if np.all(coeffs >= 0) or len(active) == 1:
+            break
+        active.pop(int(np.argmin(coeffs)))
+    model = np.zeros(3)
+    model[active] = np.maximum(coeffs, 0.)
+    return model
+
+
+def predict_time(model, wrapper_nproc):
+    a, b, c = model
+    return a + b / wrapper_nproc + c * wrapper_nproc
+
+
+def recommend_layout(model, cores_per_node, n_nodes, n_indices, candidates):
+    """
+    Find the layout maximizing the gradient throughput of the allocation. The parent ranks are not counted since they
+    are idle while their children run (see job_example.mpi), so each node holds cores_per_node // w parents
+    :param model: the coefficients of fit_scaling_model
+    :param cores_per_node: the number of cores per node
+    :param n_nodes: the number of nodes
+    :param n_indices: the number of solver runs per gradient, e.g., u_pert.size
+    :param candidates: the numbers of children to consider, e.g., those supported by the solver decomposition
+    :return: list of (wrapper_nproc, parents per node, predicted time per gradient), the best first
+    """
+    layouts = []
+    for w in candidates:
+        parents_per_node = cores_per_node // w
+        if parents_per_node == 0:
+            continue
+        # the runs are done in waves of (parents per node * n_nodes) runs
+        n_waves = int(np.ceil(n_indices / (parents_per_node * n_nodes)))
+        layouts.append((int(w), parents_per_node, float(n_waves * predict_time(model, w))))
+    layouts.sort(key=lambda layout: layout[2])
+    return layouts
+
+
+class LayoutTuner:
+    def __init__(self, process, u_pert, t, wrapper_nprocs, cores_per_node, n_nodes,
+                 candidates=None, n_indices=None, n_repeat=1, apply=False):
+        """
+        Calibrate the split of the nodes between parent ranks and wrapper_nproc children per solver run. Short runs from
+        the basic state are timed on rank 0 at several wrapper_nproc, the scaling model of fit_scaling_model is fitted,
+        and the layout maximizing the gradient throughput is recommended (and optionally applied).
+        :param process: the Simulation object, e.g., Flash
+        :param u_pert: a perturbation to inject, e.g., from generate_u_pert
+        :param t: the final time of the short runs, a few steps after t0 is enough
+        :param wrapper_nprocs: the numbers of children to time, at least two distinct values
+        :param cores_per_node: the number of cores per node
+        :param n_nodes: the number of nodes of the allocation
+        :param candidates: the numbers of children to consider for the recommendation, wrapper_nprocs by default.
+            Note the model is extrapolated outside the measured range
+        :param n_indices: the number of solver runs per gradient, u_pert.size by default
+        :param n_repeat: the number of timed runs per value, the minimum is taken
+        :param apply: if True, set process.wrapper_nproc to the fastest value that fits the current parent ranks
+        """
+        if not hasattr(process, "wrapper_nproc"):
+            raise ValueError("The process does not spawn the solver with wrapper_nproc children!")
+        if np.unique(wrapper_nprocs).size < 2:
+            raise ValueError("At least two distinct wrapper_nprocs are needed to fit the scaling model!")
+        self.wrapper_nprocs = np.asarray(wrapper_nprocs, dtype=int)
+        if candidates is None:
+            candidates = self.wrapper_nprocs
+        if n_indices is None:
+            n_indices = u_pert.size
+
+        self.times = np.zeros(self.wrapper_nprocs.size)
+        if process.mpi_rank == 0:
+            wrapper_nproc_orig = process.wrapper_nproc
+            # the run goes to the own fork directory of rank 0, so the unperturbed solution is not touched
+            fork_id = process.mpi_fork_offset + process.mpi_rank
+            for i, w in enumerate(self.wrapper_nprocs):
+                process.wrapper_nproc = int(w)
+                elapsed = []
+                for _ in range(n_repeat):
+                    time_start = time.time()
+                    process.proceed(t, u_pert=u_pert, fork_id=fork_id)
+                    elapsed.append(time.time() - time_start)
+                self.times[i] = min(elapsed)
+                print("Layout tuner: wrapper_nproc = {}, run time = {:.2f} s".format(w, self.times[i]))
+            process.wrapper_nproc = wrapper_nproc_orig
+        process.mpi_comm.Bcast(self.times, root=0)
+
+        self.model = fit_scaling_model(self.wrapper_nprocs, self.times)
+        self.layouts = recommend_layout(self.model, cores_per_node, n_nodes, n_indices, candidates)
+        if len(self.layouts) == 0:
+            raise ValueError("No candidate wrapper_nproc fits into cores_per_node!")
+        self.wrapper_nproc, self.parents_per_node, self.time_per_gradient = self.layouts[0]
+
+        if process.mpi_rank == 0:
+            print("Layout tuner: T(w) = {:.3g} + {:.3g} / w + {:.3g} * w s".format(*self.model))
+            for w, parents_per_node, time_per_gradient in self.layouts:
+                print("  wrapper_nproc = {:4d}, parents/node = {:4d}, time per gradient = {:.1f} s".format(
+                    w, parents_per_node, time_per_gradient))
+            print("Recommended: mpirun --oversubscribe --map-by ppr:{}:node -np {} python3 <script>, "
+                  "with wrapper_nproc = {}".format(self.parents_per_node, self.parents_per_node * n_nodes,
+                                                   self.wrapper_nproc))
+
+        if apply:
+            # the number of parent ranks is fixed by mpirun, so only wrapper_nproc can be changed
+            parents_per_node = int(np.ceil(process.mpi_size / n_nodes))
+            fitting = [layout for layout in self.layouts if layout[0] * parents_per_node <= cores_per_node]
+            if len(fitting) == 0:
+                warnings.warn("No candidate wrapper_nproc fits the current {} parent ranks per node, wrapper_nproc "
+                              "is not changed.".format(parents_per_node))
+            else:
+                process.wrapper_nproc = min(fitting, key=lambda layout: predict_time(self.model, layout[0]))[0]
+                if process.mpi_rank == 0:
+                    print("Layout tuner: wrapper_nproc is set to {}".format(process.wrapper_nproc))
+        return
@@ -0,0 +1,68 @@
+import json
+import os
+import time
+import numpy as np
+
+# the latest values of each section (e.g., "gradient" and "method") and the time of the last write, per metrics file
+_sections = {}
+_last_write = {}
+
+
+def update_metrics(metrics_fn, section, values, min_interval=0.):
+    """
+    Update a section of the live metrics file, which is rewritten atomically so that it can be polled at any time.
+    The format is JSON, or the Prometheus text format (e.g., for the textfile collector of node_exporter) if
+    metrics_fn ends with ".prom". Only rank 0 should call it.
+    :param metrics_fn: the metrics file, e.g., "metrics.json"
+    :param section: name of the section, e.g., "gradient"
+    :param values: dictionary of numbers, or lists of numbers (e.g., one per rank)
+    :param min_interval: the file is not rewritten if the last write is more recent than min_interval seconds
+    :return: None
+    """
+    sections = _sections.setdefault(metrics_fn, {})
+    sections[section] = dict(values, updated=time.time())
+    if time.time() - _last_write.get(metrics_fn, -np.inf) < min_interval:
+        return
+    _last_write[metrics_fn] = time.time()
+
+    if metrics_fn.endswith(".prom"):
+        contents = prometheus_text(sections)
+    else:
+        contents = json.dumps(to_builtin(sections), indent=1, allow_nan=False)
+    tmp_fn = metrics_fn + ".tmp"
+    with open(tmp_fn, "w") as f:
+        f.write(contents)
+    os.replace(tmp_fn, metrics_fn)
+    return
+
+
+def to_builtin(value):
+    # numpy numbers and arrays are not JSON serializable, and JSON has no inf or NaN (e.g., the ETA before the first
+    # iteration), which are written as null
+    if isinstance(value, dict):
+        return {key: to_builtin(item) for key, item in value.items()}
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [to_builtin(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+def prometheus_text(sections):
+    lines = []
+    for section, values in sections.items():
+        for key, value in values.items():
+            name = "cnop_{}_{}".format(section, key)
+            if key.endswith("_history"):
+                # the history is kept by Prometheus itself
+                continue
+            if np.ndim(value) == 0:
+                lines.append("{} {}".format(name, float(value)))
+            else:
+                for i, item in enumerate(value):
+                    lines.append('{}{{index="{}"}} {}'.format(name, i, float(item)))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,94 @@
+import numpy as np
+
+
+def get_node_comms(process):
+    """
+    Split the communicator of the process into the node-local communicator (ranks sharing memory) and the
+    communicator of the node leaders (node-local rank 0). Rank 0 of the process is the leader of leaders.
+    :param process: the process object
+    :return: node_comm, leader_comm (leader_comm is None on non-leader ranks)
+    """
+    comm = process.mpi_comm
+    # cached on the process, and recomputed if the communicator is replaced (e.g., by multi_start.py)
+    if process.mpi_node_comms is None or process.mpi_node_comms[0] is not comm:
+        node_comm = comm.Split_type(process.mpi.COMM_TYPE_SHARED, key=comm.Get_rank())
+        is_leader = node_comm.Get_rank() == 0
+        leader_comm = comm.Split(color=0 if is_leader else process.mpi.UNDEFINED, key=comm.Get_rank())
+        if not is_leader:
+            leader_comm = None
+        process.mpi_node_comms = (comm, node_comm, leader_comm)
+    return process.mpi_node_comms[1:]
+
+
+def shared_empty(process, shape, dtype=float):
+    """
+    Allocate an array which is stored once per node in an MPI shared-memory window
+    :param process: the process object
+    :param shape: shape of the array
+    :param dtype: data type of the array
+    :return: the array (a view of the node-shared memory)
+    """
+    node_comm, _ = get_node_comms(process)
+    itemsize = np.dtype(dtype).itemsize
+    # only the node leader allocates the memory, the other ranks on the node map it
+    nbytes = int(np.prod(shape)) * itemsize if node_comm.Get_rank() == 0 else 0
+    win = process.mpi.Win.Allocate_shared(nbytes, itemsize, comm=node_comm)
+    buf, _ = win.Shared_query(0)
+    array = np.ndarray(buffer=buf, dtype=dtype, shape=shape)
+    # keep the window alive as long as the array is needed, see free_shared
+    process.mpi_shared_windows[id(array)] = win
+    return array
+
+
+def bcast_shared(process, array):
+    """
+    Broadcast a read-only array from rank 0 to all ranks. The data is stored once per node and sent
+    between nodes by buffer-based Bcast among the node leaders instead of pickle-based bcast.
+    :param process: the process object
+    :param array: the array on rank 0, ignored on other ranks
+    :return: the read-only array on all ranks
+    """
+    node_comm, leader_comm = get_node_comms(process)
+    if process.mpi_rank == 0:
+        array = np.ascontiguousarray(array)
+        meta = (array.shape, array.dtype.str)
+    else:
+        meta = None
+    shape, dtype = process.mpi_comm.bcast(meta, root=0)
+
+    shared = shared_empty(process, shape, dtype=dtype)
+    if process.mpi_rank == 0:
+        # rank 0 is the leader of the first node and rank 0 of leader_comm
+        shared[...] = array
+    if leader_comm is not None:
+        leader_comm.Bcast(shared, root=0)
+    node_comm.Barrier()
+    shared.flags.writeable = False
+    return shared
+
+
+def bcast_array(process, array):
+    """
+    Broadcast an array from rank 0 to all ranks as bcast_shared, but return a private (writable) copy on each rank
+    and free the shared-memory window at once, for the arrays which are owned by the caller and may outlive the
+    search, e.g., the initial perturbation
+    :param process: the process object
+    :param array: the array on rank 0, ignored on other ranks
+    :return: the array on all ranks
+    """
+    shared = bcast_shared(process, array)
+    array = np.array(shared)
+    free_shared(process, shared)
+    return array
+
+
+def free_shared(process, array):
+    """
+    Free the shared-memory window of an array created by shared_empty or bcast_shared; collective on the process
+    :param process: the process object
+    :param array: the array to be freed, which must not be used afterwards
+    :return: None
+    """
+    win = process.mpi_shared_windows.pop(id(array))
+    win.Free()
+    return
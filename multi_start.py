@@ -0,0 +1,94 @@
+import copy
+import numpy as np
+from sim_controller import find_latest_checkpoint, checkpoint_prefix
+from cnop_methods import Spg2Defn
+
+
+class MultiStartDefn:
+    def __init__(self, process, u_perts, t1, pert_delta, n_groups, method=Spg2Defn, **kwargs):
+        """
+        Run several independent CNOP searches concurrently. COMM_WORLD of the process is split into n_groups
+        sub-communicators, each running its share of the starts (round-robin) with the given method. The basic
+        state u0 and the unperturbed reference run at t1 are computed once and shared by all searches.
+        :param process: the process object, initialized on the world communicator
+        :param u_perts: list of the initial perturbations, one per start (e.g., from generate_u_pert with
+            different seeds); must be generated on the world communicator beforehand
+        :param t1: the final time
+        :param pert_delta: the perturbation bound, either a number or a list with one value per start
+        :param n_groups: the number of concurrent searches, must not exceed the number of ranks
+        :param method: the CNOP method class, e.g., Spg2Defn, ProjLbfgsDefn
+        :param kwargs: other options passed to the method, e.g., pert_mask, grad_epsilon, max_iter
+        """
+        world_comm = process.mpi_comm
+        world_rank = process.mpi_rank
+        world_size = process.mpi_size
+
+        n_starts = len(u_perts)
+        if np.ndim(pert_delta) == 0:
+            pert_delta = [pert_delta] * n_starts
+        if len(pert_delta) != n_starts:
+            raise ValueError("pert_delta must be a number or a list with the same length as u_perts!")
+        if n_groups > world_size:
+            raise ValueError("The number of groups cannot exceed the number of MPI ranks!")
+        n_groups = min(n_groups, n_starts)
+
+        # the reference run is shared by all searches, so it is done once before splitting
+        process.share_unperturbed(t1)
+
+        # contiguous groups so that the fork_id (mpi_fork_offset + group rank) is the world rank
+        self.group_id = world_rank * n_groups // world_size
+        group_comm = world_comm.Split(color=self.group_id, key=world_rank)
+        fork_offset = group_comm.bcast(world_rank, root=0)
+
+        self.j_bests = np.full(n_starts, np.inf)
+        u_pert_bests = {}
+        for start_id in range(self.group_id, n_starts, n_groups):
+            search_process = make_search_process(process, group_comm, start_id, fork_offset)
+            if search_process.mpi_rank == 0:
+                print("Group {}: start {} with pert_delta = {}".format(self.group_id, start_id, pert_delta[start_id]))
+            # the scratch is shared by the searches of the node, so it is removed at the end
+            search = method(search_process, u_perts[start_id].copy(), t1, pert_delta[start_id],
+                            **dict(kwargs, cleanup_scratch=False))
+            self.j_bests[start_id] = np.squeeze(search.j_best)
+            u_pert_bests[start_id] = search.u_pert_best
+
+        # find the global best across all starts, and send its perturbation to all ranks
+        world_comm.Allreduce(process.mpi.IN_PLACE, self.j_bests, op=process.mpi.MIN)
+        self.best_start = int(np.argmin(self.j_bests))
+        self.j_best = self.j_bests[self.best_start]
+        group_roots = sorted(set(world_comm.allgather(fork_offset)))
+        best_root = group_roots[self.best_start % n_groups]
+        self.u_pert_best = world_comm.bcast(u_pert_bests.get(self.best_start), root=best_root)
+
+        group_comm.Free()
+        if hasattr(process, "cleanup_scratch"):
+            process.cleanup_scratch()
+        if world_rank == 0:
+            print("j_best of all starts: ", self.j_bests)
+            print("global best: start {} with j_best = {}".format(self.best_start, self.j_best))
+        return
+
+
+def make_search_process(process, comm, search_id, fork_offset):
+    """
+    Make a shallow copy of the process to run one search on a sub-communicator
+    :param process: the process object
+    :param comm: the sub-communicator of the search
+    :param search_id: the id of the search, used to name its checkpoint and temporary files
+    :param fork_offset: the fork_id offset of the search, so that fork dirs of concurrent searches do not overlap
+    :return: the process object of the search
+    """
+    search_process = copy.copy(process)
+    search_process.mpi_comm = comm
+    search_process.mpi_rank = comm.Get_rank()
+    search_process.mpi_size = comm.Get_size()
+    search_process.mpi_fork_offset = fork_offset
+    search_process.mpi_search_id = search_id
+    try:
+        last_checkpoint_fn = find_latest_checkpoint(process.base_dir, checkpoint_prefix(search_process))
+    except FileNotFoundError:
+        search_process.restart = False
+    else:
+        search_process.restart = True
+        search_process.restart_checkpoint_fn = last_checkpoint_fn
+    return search_process
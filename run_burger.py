@@ -1,5 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
 from solvers.burgers import Burgers
 from cnop_methods import Spg2Defn
 
@@ -23,6 +22,9 @@ u_pert = process.generate_u_pert()
 spg2 = Spg2Defn(process, u_pert, t1, 8e-6)
 
 if process.mpi_rank == 0:
+    # matplotlib is only needed by rank 0 for the figure
+    import matplotlib.pyplot as plt
+
     plt.subplot(211)
     plt.plot(x, process.u0, label=r"$u_0 (t_0)$")
     plt.plot(x, process.ut1_unperturbed, label=r"$u(u_0, t_0 + \Delta t)$")
@@ -0,0 +1,25 @@
+import sys
+import numpy as np
+from solvers.burgers_nd import BurgersNd
+from cnop_methods import Spg2Defn
+
+# parameters, e.g., "python run_burgers_nd.py 128 2" for 128^2 degrees of freedom, "... 100 3" for 10^6
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+ndim = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+t0 = 1.
+t1 = 3.
+delta_x = 1.0
+
+# a smooth initial condition with one bump per axis
+x = np.arange(n) * delta_x
+u_init = np.ones((n,) * ndim)
+for axis in range(ndim):
+    u_init = u_init * np.sin(np.pi * x / (n - 1)).reshape([-1 if i == axis else 1 for i in range(ndim)])
+
+process = BurgersNd(u_init, t0, vis=0.5, delta_t=0.1, delta_x=delta_x)
+u_pert = process.generate_u_pert(1e-3 * np.sqrt(u_init.size), seed=0)
+# the vectors are distributed over the ranks, as in the large FLASH runs
+spg2 = Spg2Defn(process, u_pert, t1, 1e-3, grad_epsilon=1e-6, max_iter=20, distributed=True)
+
+if process.mpi_rank == 0:
+    np.savez("burgers_nd_u_pert_best.npz", u_pert_best=spg2.u_pert_best, j_best=spg2.j_best)
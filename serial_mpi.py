@@ -0,0 +1,142 @@
+import os
+import sys
+import numpy as np
+
+# environment variables set by the common MPI launchers (Open MPI, MPICH/Hydra, Intel MPI, PMIx)
+MPI_LAUNCHER_VARIABLES = ("OMPI_COMM_WORLD_SIZE", "PMI_SIZE", "PMI_RANK", "PMIX_RANK", "MPI_LOCALNRANKS")
+
+
+def launched_by_mpi():
+    # whether this process is one rank of an MPI launcher (mpirun, mpiexec, srun with PMI)
+    return any(var in os.environ for var in MPI_LAUNCHER_VARIABLES)
+
+
+def get_mpi(serial=None):
+    """
+    The MPI module of a process: mpi4py.MPI, or SerialMPI which provides the (single-rank) subset of it used by the
+    CNOP methods, so that a serial run does not import (and initialize) MPI at all
+    :param serial: whether to run without MPI; by default, serial unless the process is launched by an MPI
+        launcher or mpi4py is already imported
+    :return: the MPI module
+    """
+    if serial is None:
+        serial = not launched_by_mpi() and "mpi4py.MPI" not in sys.modules
+    if serial:
+        return SerialMPI
+    from mpi4py import MPI
+    return MPI
+
+
+def mpi_module(comm):
+    # the MPI module of a communicator, for the constants (e.g., SUM, DOUBLE) used with it
+    if isinstance(comm, SerialComm):
+        return SerialMPI
+    from mpi4py import MPI
+    return MPI
+
+
+def copy_into(recvbuf, sendbuf):
+    # recvbuf is either an array or a buffer specification [array, counts, displs, datatype]
+    if isinstance(recvbuf, (list, tuple)):
+        array, counts, displs = recvbuf[:3]
+        array.reshape(-1)[displs[0]:displs[0] + counts[0]] = np.asarray(sendbuf).reshape(-1)
+    else:
+        recvbuf[...] = np.asarray(sendbuf).reshape(recvbuf.shape)
+    return
+
+
+class SerialComm:
+    # a communicator of a single rank, where the collectives are copies (or nothing)
+    def Get_rank(self):
+        return 0
+
+    def Get_size(self):
+        return 1
+
+    def bcast(self, obj, root=0):
+        return obj
+
+    def allgather(self, obj):
+        return [obj]
+
+    def gather(self, obj, root=0):
+        return [obj]
+
+    def allreduce(self, obj, op=None):
+        return obj
+
+    def Bcast(self, buf, root=0):
+        return
+
+    def Allreduce(self, sendbuf, recvbuf, op=None):
+        if sendbuf is not SerialMPI.IN_PLACE:
+            copy_into(recvbuf, sendbuf)
+        return
+
+    def Reduce(self, sendbuf, recvbuf, op=None, root=0):
+        self.Allreduce(sendbuf, recvbuf, op=op)
+        return
+
+    def Scatterv(self, sendbuf, recvbuf, root=0):
+        array, counts, displs = sendbuf[:3]
+        copy_into(recvbuf, np.asarray(array).reshape(-1)[displs[0]:displs[0] + counts[0]])
+        return
+
+    def Gatherv(self, sendbuf, recvbuf, root=0):
+        copy_into(recvbuf, sendbuf)
+        return
+
+    def Allgatherv(self, sendbuf, recvbuf):
+        copy_into(recvbuf, sendbuf)
+        return
+
+    def Barrier(self):
+        return
+
+    def Split(self, color=0, key=0):
+        return SerialComm()
+
+    def Split_type(self, split_type, key=0):
+        return SerialComm()
+
+    def Free(self):
+        return
+
+    def Abort(self, errorcode=1):
+        sys.exit(errorcode)
+
+
+class SerialWin:
+    # a "shared-memory" window of a single rank is plain memory
+    def __init__(self, nbytes, itemsize):
+        self.buffer = bytearray(nbytes)
+        self.itemsize = itemsize
+        return
+
+    @classmethod
+    def Allocate_shared(cls, nbytes, itemsize, comm=None):
+        return cls(nbytes, itemsize)
+
+    def Shared_query(self, rank):
+        return memoryview(self.buffer), self.itemsize
+
+    def Free(self):
+        return
+
+
+class SerialMPI:
+    # the subset of mpi4py.MPI used by the processes and the CNOP methods
+    COMM_WORLD = SerialComm()
+    COMM_SELF = SerialComm()
+    IN_PLACE = object()
+    SUM = "sum"
+    MAX = "max"
+    MIN = "min"
+    DOUBLE = "double"
+    COMM_TYPE_SHARED = 0
+    UNDEFINED = -32766
+    Win = SerialWin
+
+    @staticmethod
+    def Finalize():
+        return
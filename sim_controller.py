@@ -1,6 +1,5 @@
 import os
 import glob
-import h5py
 import warnings
 
 
@@ -35,15 +34,43 @@ def update_parameter(file_path, params, new_file_path=None):
     # print(f"Updated file saved as {new_file_path}")
 
 
-def save_checkpoint(process, method):
+def checkpoint_prefix(process):
+    """
+    Prefix of the checkpoint files of the process, e.g., "Flash_checkpoint" or "Flash_checkpoint_search_2" when
+    the process runs one of several concurrent searches (see multi_start.py)
+    :param process: the process object
+    :return: prefix of the checkpoint file
+    """
+    prefix = process.__class__.__name__ + "_checkpoint"
+    if process.mpi_search_id is not None:
+        prefix += "_search_%d" % process.mpi_search_id
+    return prefix
+
+
+def save_checkpoint(process, method, field_names=(), field_dtype=None, **field_filters):
+    """
+    Save the attributes of the process and method for restart
+    :param process: the process object
+    :param method: the method object
+    :param field_names: names of the method attributes which are fields (e.g., u_pert, g), only these are stored
+        with field_dtype and field_filters; all other attributes are stored as they are
+    :param field_dtype: storage precision of the fields, e.g., "float32"; None keeps the precision in memory
+    :param field_filters: HDF5 filters of the fields passed to h5py create_dataset, e.g., compression="gzip" and
+        shuffle=True for lossless compression, or scaleoffset=6 to keep 6 decimal digits (error-bounded)
+    :return: None
+    """
+    import h5py
+
     iter0 = method.iter0
-    checkpoint_fn = "%s_checkpoint_%04d.h5" % (process.__class__.__name__, iter0)
+    checkpoint_fn = "%s_%04d.h5" % (checkpoint_prefix(process), iter0)
     with h5py.File(process.base_dir + "/" + checkpoint_fn, 'w') as f:
         process_group = f.create_group('process')
         for k, v in process.__dict__.items():
             # Don't save flags related to restart controller, otherwise the restart loop won't work
-            # Do not save mpi or yt_derived_field function as well
-            if k.startswith("restart") or k.startswith("mpi") or k == "yt_derived_fields":
+            # Do not save mpi, yt_derived_field function, fidelity_ladder or plotfile_params (given to the constructor),
+            # nor the references of the other fidelity levels, which are recomputed if needed
+            if k.startswith("restart") or k.startswith("mpi") or k in ["yt_derived_fields", "fidelity_ladder",
+                                                                           "plotfile_params", "fidelity_references"]:
                 continue
             try:
                 if v is None:
@@ -62,6 +89,9 @@ def save_checkpoint(process, method):
                 # If the value is None, use a placeholder string
                 if v is None:
                     method_group.create_dataset(k, data="None")
+                elif k in field_names:
+                    method_group.create_dataset(k, data=v if field_dtype is None else v.astype(field_dtype),
+                                                **field_filters)
                 else:
                     method_group.create_dataset(k, data=v)
             except TypeError:
@@ -77,8 +107,9 @@ def find_latest_checkpoint(base_dir, prefix):
     :return: latest checkpoint file path
     """
 
-    # Find all checkpoint files
-    chk_files = glob.glob(os.path.join(base_dir, prefix + "_*"))
+    # Find all checkpoint files; the iteration number must follow the prefix, so that the checkpoints of the
+    # concurrent searches ("<prefix>_search_<k>_NNNN.h5") are not taken for the ones of prefix
+    chk_files = glob.glob(os.path.join(base_dir, prefix + "_[0-9]*.h5"))
     if len(chk_files) == 0:
         raise FileNotFoundError("No checkpoint file found.")
     # Find the latest checkpoint file
@@ -97,6 +128,9 @@ def load_checkpoint(file_path, group_name, handle):
 
 
 def load_h5_data(file_path):
+    # h5py is imported when needed, so that importing this module is cheap for every rank
+    import h5py
+
     with h5py.File(file_path, 'r') as hf:
         data_dict = {}
         for key in hf.keys():
@@ -114,27 +148,33 @@ def load_h5_data(file_path):
 
 
 def load_h5_data_from_group(group):
+    import h5py
+
     data_dict = {}
     for key in group.keys():
         if isinstance(group[key], h5py.Group):
             # If it's a Group type, recursively load data from the group
             data_dict[key] = load_h5_data_from_group(group[key])
         elif isinstance(group[key], h5py.Dataset):
-            # Check if the data is an object type (dtype 'O')
-            if group[key].dtype.kind == 'O':
-                # If it's an object type, check if it's a single string or a list
-                if group[key].shape == ():
-                    if group[key][()].decode('utf-8') == "None":
-                        data_dict[key] = None
-                    else:
-                        data_dict[key] = group[key][()].decode('utf-8')
-                else:
-                    # If it's a list of bytes, decode each item
-                    data_dict[key] = [item.decode('utf-8') for item in group[key][()]]
-            elif group[key].dtype.kind in ['S', 'U']:
-                # If it's a byte or unicode string, decode it to a Unicode string
-                data_dict[key] = group[key][()].decode('utf-8')
-            else:
-                # For other data types, load the data directly
-                data_dict[key] = group[key][()]
+            data_dict[key] = read_h5_dataset(group[key])
     return data_dict
+
+
+def read_h5_dataset(dataset):
+    # Check if the data is an object type (dtype 'O')
+    if dataset.dtype.kind == 'O':
+        # If it's an object type, check if it's a single string or a list
+        if dataset.shape == ():
+            if dataset[()].decode('utf-8') == "None":
+                return None
+            else:
+                return dataset[()].decode('utf-8')
+        else:
+            # If it's a list of bytes, decode each item
+            return [item.decode('utf-8') for item in dataset[()]]
+    elif dataset.dtype.kind in ['S', 'U']:
+        # If it's a byte or unicode string, decode it to a Unicode string
+        return dataset[()].decode('utf-8')
+    else:
+        # For other data types, load the data directly
+        return dataset[()]
@@ -0,0 +1,155 @@
+import numpy as np
+from mpi_shared import bcast_shared, free_shared
+from grad_coloring import color_periods, color_cells, box_sum
+
+
+class SingularVectorDefn:
+    def __init__(self, process, u_pert, t1, n_modes, epsilon=1e-8, oversampling=5, power_iterations=1,
+                 influence_radius=None, periodic=False, pert_mask=None, pert_delta=None, seed_vectors=None, seed=0):
+        """
+        Leading singular vectors of the tangent linear propagator (the finite-difference Jacobian J of the solver
+        from the basic state u0 to t1), i.e., the fastest-growing perturbations and their growth rates, by randomized
+        SVD with subspace iterations (Halko, Martinsson and Tropp 2011): the range of J is sampled by a block of
+        directions, refined by power_iterations products with J^T and J, and J is projected on it.
+        A product with J costs one solver run per direction. The solver has no adjoint, so a product of a block with
+        J^T is computed from the finite-difference columns J e_i, i.e., one run per cell of pert_mask as grad_defn, or
+        (2 * influence_radius + 1) ** ndim runs as grad_colored if the influence of a cell is local. All the runs are
+        spread over the ranks. Seed vectors, e.g., CNOPs from Spg2Defn, are added to the first block.
+        :param process: the process object
+        :param u_pert: a perturbation of the right shape (e.g., from generate_u_pert), the first probe direction
+        :param t1: the final time
+        :param n_modes: the number of leading modes
+        :param epsilon: the finite-difference step, the largest change of a cell as grad_epsilon of grad_defn
+        :param oversampling: the number of directions per block in addition to n_modes, rounded up to a multiple of
+            the number of ranks
+        :param power_iterations: the number of subspace iterations, each costs one product with J^T and one with J
+        :param influence_radius: the influence radius in cells for the colored products with J^T (see grad_colored);
+            one run per cell if None
+        :param periodic: whether the domain is periodic, for influence_radius
+        :param pert_mask: the pert_mask for the perturbation, the directions are zero outside of it
+        :param pert_delta: if given, the nonlinear growth rate of each mode is also computed, with the mode scaled to
+            the perturbation bound
+        :param seed_vectors: list of perturbations added to the first block
+        :param seed: the seed of the random directions
+        """
+        if power_iterations < 0:
+            raise ValueError("power_iterations must not be negative!")
+        mpi_comm = process.mpi_comm
+        mpi_rank = process.mpi_rank
+        mpi_size = process.mpi_size
+        self.shape = u_pert.shape
+        self.mask = np.ones(self.shape, dtype=bool) if pert_mask is None else np.asarray(pert_mask, dtype=bool)
+        block_size = min(int(np.ceil((n_modes + oversampling) / mpi_size)) * mpi_size, int(self.mask.sum()))
+        if block_size == 0:
+            raise ValueError("No probe direction is left, check pert_mask!")
+
+        # the unperturbed solution is read once and stored once per node
+        ut = process.proceed(t1) if mpi_rank == 0 else None
+        ut = bcast_shared(process, ut)
+        self.n_runs = 0
+
+        # the first block of directions (rows), orthonormal within pert_mask
+        seeds = [u_pert] + (list(seed_vectors) if seed_vectors is not None else [])
+        directions = np.concatenate((np.array(seeds, dtype=float).reshape((-1,) + self.shape),
+                                     np.random.default_rng(seed).standard_normal((block_size,) + self.shape)))
+        directions = orthonormal_rows((directions[:block_size] * self.mask).reshape(block_size, -1))
+        images = self.apply_block(process, directions, t1, ut, epsilon)
+        for iteration in range(power_iterations):
+            # V <- orth(J^T orth(J V))
+            directions = orthonormal_rows(self.apply_transpose(process, orthonormal_rows(images), t1, ut, epsilon,
+                                                               influence_radius, periodic))
+            images = self.apply_block(process, directions, t1, ut, epsilon)
+            if mpi_rank == 0:
+                print("Subspace iteration {}: {} solver runs".format(iteration + 1, self.n_runs))
+
+        # J ~ Q^T (Q J), where the rows of Q are an orthonormal basis of the sampled range, and Q J = (J^T Q^T)^T
+        q = orthonormal_rows(images)
+        _, s, vt = np.linalg.svd(self.apply_transpose(process, q, t1, ut, epsilon, influence_radius, periodic),
+                                 full_matrices=False)
+        self.growth_rates = s[:n_modes]
+        self.modes = vt[:n_modes].reshape((-1,) + self.shape)
+
+        # the nonlinear growth of the modes at the perturbation bound
+        self.nonlinear_growth_rates = None
+        if pert_delta is not None:
+            self.nonlinear_growth_rates = np.zeros(self.modes.shape[0])
+            for i in np.array_split(np.arange(self.modes.shape[0]), mpi_size)[mpi_rank]:
+                # on the boundary of the constraint of the CNOP, see do_projection
+                u_mode = self.modes[i] * pert_delta / np.sqrt((self.modes[i] ** 2.).mean())
+                ut_pert = process.proceed(t1, u_pert=u_mode, fork_id=process.mpi_fork_offset + mpi_rank)
+                self.nonlinear_growth_rates[i] = np.sqrt(((ut_pert - ut) ** 2).sum() / (u_mode ** 2).sum())
+            mpi_comm.Allreduce(process.mpi.IN_PLACE, self.nonlinear_growth_rates, op=process.mpi.SUM)
+            self.n_runs += self.modes.shape[0]
+
+        if mpi_rank == 0:
+            print("Linear growth rates = ", self.growth_rates)
+            if self.nonlinear_growth_rates is not None:
+                print("Nonlinear growth rates = ", self.nonlinear_growth_rates)
+            print("Number of solver runs = ", self.n_runs)
+        free_shared(process, ut)
+        return
+
+    @staticmethod
+    def apply_jacobian(process, v, t1, ut, epsilon):
+        # J v by finite difference, the change of each cell is at most epsilon
+        scale = np.abs(v).max()
+        ut_pert = process.proceed(t1, u_pert=epsilon / scale * v, fork_id=process.mpi_fork_offset + process.mpi_rank)
+        return (ut_pert - ut) * scale / epsilon
+
+    def apply_block(self, process, directions, t1, ut, epsilon):
+        # J v of each direction (row), spread over the ranks
+        images = np.zeros((directions.shape[0], ut.size))
+        for i in np.array_split(np.arange(directions.shape[0]), process.mpi_size)[process.mpi_rank]:
+            images[i] = self.apply_jacobian(process, directions[i].reshape(self.shape), t1, ut, epsilon)
+        process.mpi_comm.Allreduce(process.mpi.IN_PLACE, images, op=process.mpi.SUM)
+        self.n_runs += directions.shape[0]
+        return images
+
+    def apply_transpose(self, process, w, t1, ut, epsilon, influence_radius=None, periodic=False):
+        """
+        J^T w of each row of w, from the finite-difference columns J e_i of the cells of pert_mask, without storing J
+        :param process: the process object
+        :param w: the block of vectors (rows) of the size of the solution
+        :param t1: the final time
+        :param ut: the unperturbed solution at t1
+        :param epsilon: the finite-difference step
+        :param influence_radius: if given, the cells more than 2 * influence_radius apart are perturbed in the same
+            run, and the change within influence_radius of each cell is attributed to it (see grad_colored)
+        :param periodic: whether the domain is periodic, for influence_radius
+        :return: the block of J^T w (rows), on all ranks
+        """
+        fork_id = process.mpi_fork_offset + process.mpi_rank
+        z = np.zeros((w.shape[0], self.mask.size))
+        if influence_radius is None:
+            cells = np.flatnonzero(self.mask)
+            for i in np.array_split(cells, process.mpi_size)[process.mpi_rank]:
+                u_pert_eps = np.zeros(self.shape)
+                u_pert_eps.flat[i] = epsilon
+                column = (process.proceed(t1, u_pert=u_pert_eps, fork_id=fork_id) - ut) / epsilon
+                z[:, i] = w @ column
+            n_runs = cells.size
+        else:
+            if ut.size != self.mask.size:
+                raise ValueError("The solution is not on the grid of the perturbation, see solution_on_grid.")
+            periods = color_periods(self.shape, influence_radius, periodic=periodic)
+            color = color_cells(self.shape, periods)
+            n_runs = int(np.prod(periods))
+            for c in np.array_split(np.arange(n_runs), process.mpi_size)[process.mpi_rank]:
+                cells = (color == c) & self.mask
+                if not cells.any():
+                    continue
+                delta = ((process.proceed(t1, u_pert=epsilon * cells, fork_id=fork_id) - ut) / epsilon).reshape(
+                    self.shape)
+                for j in range(w.shape[0]):
+                    z[j, cells.reshape(-1)] = box_sum(delta * w[j].reshape(self.shape), influence_radius,
+                                                      periodic=periodic)[cells]
+        process.mpi_comm.Allreduce(process.mpi.IN_PLACE, z, op=process.mpi.SUM)
+        self.n_runs += n_runs
+        return z
+
+
+def orthonormal_rows(a):
+    # an orthonormal basis (rows) of the span of the rows of a, without the (numerically) dependent ones
+    q, r = np.linalg.qr(a.T)
+    diag = np.abs(np.diag(r))
+    return q.T[diag > 1e-10 * diag.max()] if diag.size > 0 and diag.max() > 0 else q.T[:0]
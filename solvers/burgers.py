@@ -1,21 +1,36 @@
 import numpy as np
-from sim_controller import find_latest_checkpoint, load_checkpoint
+import os
+import tempfile
+from sim_controller import find_latest_checkpoint, load_checkpoint, checkpoint_prefix
 from utils import usphere_sample
-from mpi4py import MPI
+from state_cache import StateCache, hash_items, hash_file
+from serial_mpi import get_mpi
+from mpi_shared import bcast_shared
 
 
 class Burgers:
     def __init__(self, u_init, t0, **kwargs):
-        self.mpi = MPI
+        # serial=True runs without MPI (mpi4py is not even imported); by default, MPI is used only if launched by an
+        # MPI launcher, see get_mpi
+        self.mpi = get_mpi(kwargs.get('serial'))
         self.mpi_comm = self.mpi.COMM_WORLD
         self.mpi_comm_self = self.mpi.COMM_SELF
         self.mpi_rank = self.mpi_comm.Get_rank()
         self.mpi_size = self.mpi_comm.Get_size()
+        # fork_id of the gradient runs is mpi_fork_offset + mpi_rank; mpi_search_id tags concurrent searches
+        self.mpi_fork_offset = 0
+        self.mpi_search_id = None
+        # node-shared memory windows and communicators, see mpi_shared.py
+        self.mpi_shared_windows = {}
+        self.mpi_node_comms = None
+        self.mpi_root_dir = os.getcwd()
+        # no coarse levels for the multi-fidelity CNOP, see Simulation
+        self.fidelity_ladder = []
+        self.fidelity_level = 0
 
         # check if there is a checkpoint file in the base_dir
         try:
-            last_checkpoint_fn = find_latest_checkpoint(kwargs.get('base_dir', './'),
-                                                        self.__class__.__name__ + "_checkpoint")
+            last_checkpoint_fn = find_latest_checkpoint(kwargs.get('base_dir', './'), checkpoint_prefix(self))
         except FileNotFoundError:
             self.restart = False
         else:
@@ -23,12 +38,13 @@ class Burgers:
             self.restart_checkpoint_fn = last_checkpoint_fn
 
         # load the solver no matter if there is a checkpoint file
-        import importlib
-        self.solve = getattr(importlib.import_module("solvers.burgers_lib"), "solve_burgers")
+        self.load_solver()
 
         if self.restart:
             # if there is a checkpoint file, load process attributes from it
             load_checkpoint(self.restart_checkpoint_fn, "process", self)
+            # the basic state is stored once per node, as in a fresh start
+            self.u0 = bcast_shared(self, self.u0)
             # now print that the class is initialized with detailed information
             if self.mpi_rank == 0:
                 print("The class is initialized with the checkpoint file {}.".format(self.restart_checkpoint_fn))
@@ -36,7 +52,7 @@ class Burgers:
         else:
             # for given initial condition u_init, evolve it to time t0 as the basic state u0
             if not isinstance(u_init, np.ndarray):
-                raise ValueError("The u_init must be a numpy array in Burgers class.")
+                raise ValueError("The u_init must be a numpy array in {} class.".format(self.__class__.__name__))
             self.u_init = u_init
             self.t0 = t0
             self.vis = kwargs.get('vis', 0.5)
@@ -47,16 +63,39 @@ class Burgers:
             self.basename = kwargs.get('basename', 'burgers')
             self.t1 = None
             self.ut1_unperturbed = None
+            # the unperturbed solutions of the horizons of proceed_horizons, by number of time steps
+            self.horizon_nts = []
+            self.horizon_uts = []
+            # content-addressed cache of u0 and the unperturbed solution at t1, see state_cache.py
+            self.cache_dir = kwargs.get('cache_dir', None)
+            self.cache_max_bytes = kwargs.get('cache_max_bytes', np.inf)
             nt0 = int(self.t0 / self.delta_t + 1)
             # now evolve the initial condition to t0, to obtain u0 which is the basic state
-            self.u0 = self.solve(u_init, nt0, self.vis, self.delta_t, self.delta_x)
+            self.u0_key = self.state_key(self.u_init.tobytes(), nt0)
+            # the basic state is kept on the grid of u_init, since the perturbations are added to it; it is evolved on
+            # rank 0 and stored once per node (read-only) for the lifetime of the process
+            if self.mpi_rank == 0:
+                u0 = self.solve_cached(self.u0_key, self.u_init, nt0).reshape(self.u_init.shape)
+            else:
+                u0 = None
+            self.u0 = bcast_shared(self, u0)
             # now print that the class is initialized with detailed information
             if self.mpi_rank == 0:
                 print("The basic state is evolved from the initial condition to time {}.".format(self.t0))
             return
 
+    def load_solver(self):
+        # the Fortran solver (see burgers.F90) and the file of its content hash (see state_key)
+        import importlib
+        solver_module = importlib.import_module("solvers.burgers_lib")
+        self.solve = getattr(solver_module, "solve_burgers")
+        self.solve_fn = solver_module.__file__
+        return
+
     def proceed(self, t1, u_pert=None, fork_id=None):
         # fork_id is not used in this class since there is no need to create fork folders
+        if np.ndim(t1) > 0:
+            return self.proceed_horizons(t1, u_pert=u_pert)
         nt = int(t1 / self.delta_t + 1)
         if u_pert is None:
             if self.ut1_unperturbed is not None and self.t1 == t1:
@@ -64,7 +103,7 @@ class Burgers:
                 return self.ut1_unperturbed
             else:
                 # otherwise, compute the unperturbed solution at t1 and return it
-                ut = self.solve(self.u0, nt, self.vis, self.delta_t, self.delta_x)
+                ut = self.solve_cached(self.state_key(self.u0_key, nt), self.u0, nt)
                 self.ut1_unperturbed = ut
                 self.t1 = t1
                 return ut
@@ -73,6 +112,87 @@ class Burgers:
             ut = self.solve(self.u0 + u_pert, nt, self.vis, self.delta_t, self.delta_x)
             return ut
 
+    async def proceed_async(self, t1, u_pert, fork_id=None):
+        # the solver runs in this process, so there is nothing to overlap; see run_concurrently
+        return self.proceed(t1, u_pert=u_pert, fork_id=fork_id)
+
+    def proceed_horizons(self, horizons, u_pert=None):
+        """
+        Evolve the basic state (with perturbation u_pert) to all the horizons with one integration
+        :param horizons: list of the final times
+        :param u_pert: the perturbation, or None for the unperturbed solutions, which are kept per horizon
+        :return: array of the solutions, one row per horizon
+        """
+        nts = [int(t / self.delta_t + 1) for t in horizons]
+        if u_pert is not None:
+            return self.solve_snapshots(self.u0 + u_pert, nts)
+
+        horizon_nts = list(self.horizon_nts)
+        uts = {nt: self.horizon_uts[horizon_nts.index(nt)] for nt in set(nts) if nt in horizon_nts}
+        if self.cache_dir is not None:
+            cache = StateCache(self.cache_dir, max_bytes=self.cache_max_bytes)
+            for nt in set(nts) - set(uts):
+                # the same entries as proceed(t1) for a single horizon
+                entry = cache.lookup(self.state_key(self.u0_key, nt))
+                if entry is not None:
+                    uts[nt] = np.load(entry)
+        missing = sorted(set(nts) - set(uts))
+        if len(missing) > 0:
+            for nt, ut in zip(missing, self.solve_snapshots(self.u0, missing)):
+                uts[nt] = ut
+                if self.cache_dir is not None:
+                    self.store_cached(self.state_key(self.u0_key, nt), ut)
+        new_nts = sorted(set(uts) - set(horizon_nts))
+        self.horizon_nts = horizon_nts + new_nts
+        self.horizon_uts = list(self.horizon_uts) + [uts[nt] for nt in new_nts]
+        return np.array([uts[nt] for nt in nts])
+
+    def solve_snapshots(self, u_start, nts):
+        # the solutions after each of nts time steps, from one integration
+        import importlib
+        solver_module = importlib.import_module("solvers.burgers_lib")
+        if not hasattr(solver_module, "solve_burgers_snapshots"):
+            # burgers_lib is built from an older burgers.F90, so one integration per horizon
+            return np.array([self.solve(u_start, nt, self.vis, self.delta_t, self.delta_x) for nt in nts])
+        uts = solver_module.solve_burgers_snapshots(u_start, max(nts), self.vis, self.delta_t, self.delta_x, nts)
+        return uts.T
+
+    def state_key(self, *items):
+        # content hash of the compiled solver, the solver parameters and the given items
+        return hash_items(hash_file(self.solve_fn), self.vis, self.delta_t, self.delta_x, *items)
+
+    def solve_cached(self, key, u_start, nt):
+        # evolve u_start over nt steps, or load the solution from the cache
+        if self.cache_dir is None:
+            return self.solve(u_start, nt, self.vis, self.delta_t, self.delta_x)
+        cache = StateCache(self.cache_dir, max_bytes=self.cache_max_bytes)
+        entry = cache.lookup(key)
+        if entry is not None:
+            return np.load(entry)
+        ut = self.solve(u_start, nt, self.vis, self.delta_t, self.delta_x)
+        self.store_cached(key, ut)
+        return ut
+
+    def store_cached(self, key, ut):
+        cache = StateCache(self.cache_dir, max_bytes=self.cache_max_bytes)
+        # a unique name, since the ranks of several nodes may share base_dir
+        fd, tmp_fn = tempfile.mkstemp(dir=self.base_dir, prefix=key + ".", suffix=".npy")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, ut)
+        cache.store(key, tmp_fn)
+        os.remove(tmp_fn)
+        return
+
+    def share_unperturbed(self, t1):
+        # evolve (or reuse) the unperturbed solution at t1 on rank 0 and share it with all ranks
+        if all(self.mpi_comm.allgather(self.t1 == t1 and self.ut1_unperturbed is not None)):
+            # already shared
+            return
+        if self.mpi_rank == 0:
+            self.proceed(t1)
+        self.t1, self.ut1_unperturbed = self.mpi_comm.bcast((self.t1, self.ut1_unperturbed), root=0)
+        return
+
     def generate_u_pert(self, pert_mag=1.):
         # generate a random perturbation
         if self.mpi_rank == 0:
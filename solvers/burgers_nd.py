@@ -0,0 +1,115 @@
+import numpy as np
+from mpi_shared import bcast_array
+from solvers.burgers import Burgers
+
+
+def interior(ndim, axis=None, offset=0):
+    # the slice of the interior cells of the last ndim axes, shifted by offset along axis
+    index = [slice(1, -1)] * ndim
+    if axis is not None:
+        index[axis] = slice(1 + offset, -1 + offset if offset < 1 else None)
+    return (Ellipsis,) + tuple(index)
+
+
+def tendencies(u, ndim):
+    # the central differences of u ** 2 (advection) and the sum of the neighbors (diffusion) at the interior cells
+    advection = 0.
+    neighbors = 0.
+    for axis in range(ndim):
+        u_plus = u[interior(ndim, axis, 1)]
+        u_minus = u[interior(ndim, axis, -1)]
+        advection = advection + u_plus * u_plus - u_minus * u_minus
+        neighbors = neighbors + u_plus + u_minus
+    return advection, neighbors
+
+
+def solve_burgers_nd(u_start, ndim, nts, vis, dt, dx):
+    """
+    Viscous Burgers equation u_t + sum_d (u ** 2 / 2)_d = vis * laplacian(u) on a grid of ndim dimensions, with the
+    scheme of burgers.F90 along each axis (forward step, then leapfrog) and zero boundaries, except that the diffusion
+    of the leapfrog steps is DuFort-Frankel: the leapfrog diffusion of burgers.F90 amplifies the grid-scale noise, which
+    is fatal on fine 2-D/3-D grids. It is vectorized over the grid and over the leading (batch) axes of u_start, and
+    keeps two time levels only
+    :param u_start: the initial conditions, with shape batch_shape + grid_shape
+    :param ndim: the number of dimensions of the grid, i.e., the last ndim axes of u_start
+    :param nts: list of the numbers of time levels (the initial conditions are level 1, as nt of solve_burgers)
+    :param vis: the diffusion coefficient
+    :param dt: the time increment
+    :param dx: the space increment, the same along all axes
+    :return: list of the solutions at the levels nts
+    """
+    c0 = dt / dx
+    c1 = vis * dt / dx ** 2
+    inner = interior(ndim)
+    u_old = np.zeros(np.shape(u_start))
+    u_old[inner] = np.asarray(u_start)[inner]
+    snapshots = {1: u_old.copy()} if 1 in nts else {}
+    if max(nts) >= 2:
+        u = u_old.copy()
+        advection, neighbors = tendencies(u_old, ndim)
+        u[inner] += - 0.25 * c0 * advection + c1 * (neighbors - 2. * ndim * u_old[inner])
+        if 2 in nts:
+            snapshots[2] = u.copy()
+        for level in range(3, max(nts) + 1):
+            # the new level overwrites the one before the last
+            advection, neighbors = tendencies(u, ndim)
+            u_old[inner] = ((1. - 2. * ndim * c1) * u_old[inner] - 0.5 * c0 * advection + 2. * c1 * neighbors) / (
+                1. + 2. * ndim * c1)
+            u_old, u = u, u_old
+            if level in nts:
+                snapshots[level] = u.copy()
+    return [snapshots[nt] for nt in nts]
+
+
+class BurgersNd(Burgers):
+    def __init__(self, u_init, t0, **kwargs):
+        """
+        The viscous Burgers equation on a 2-D or 3-D grid (see solve_burgers_nd), a larger workload than Burgers for
+        the scaling tests of the CNOP methods at 10^4 - 10^6 degrees of freedom, with the same interface. The
+        perturbation has the shape of the grid, and the solution is flattened as the one of Simulation. A batch of
+        perturbations (with the grid as the last axes) is evolved by one call of proceed
+        :param u_init: the initial condition on the grid
+        :param t0: the time of the basic state
+        :param kwargs: vis, delta_t, delta_x, base_dir, basename, cache_dir, cache_max_bytes and serial as Burgers
+        """
+        kwargs.setdefault('basename', 'burgers_nd')
+        super().__init__(u_init, t0, **kwargs)
+        return
+
+    def load_solver(self):
+        # the solver is solve_burgers_nd (see solve), so the content hash of the solver is the one of this module
+        self.solve_fn = __file__
+        return
+
+    def solve(self, u_start, nt, vis, dt, dx):
+        # the flattened solution after nt time levels, one row per batch member
+        ut = solve_burgers_nd(u_start, self.u_init.ndim, [nt], vis, dt, dx)[0]
+        return ut.reshape(ut.shape[:ut.ndim - self.u_init.ndim] + (-1,))
+
+    def solve_snapshots(self, u_start, nts):
+        # the flattened solutions after each of nts time levels, with the horizons after the batch axes
+        uts = solve_burgers_nd(u_start, self.u_init.ndim, nts, self.vis, self.delta_t, self.delta_x)
+        uts = [ut.reshape(ut.shape[:ut.ndim - self.u_init.ndim] + (-1,)) for ut in uts]
+        return np.stack(uts, axis=-2)
+
+    def generate_u_pert(self, pert_mag=1., pert_mask=None, seed=None):
+        """
+        Generate a random perturbation of the interior cells (within pert_mask if given) with a norm of pert_mag as
+        Burgers, created on rank 0 and broadcast by bcast_array
+        :param pert_mag: the norm of the perturbation
+        :param pert_mask: the cells which may be perturbed
+        :param seed: the seed of the random numbers
+        :return: the perturbation on the grid
+        """
+        if self.mpi_rank == 0:
+            mask = np.zeros(self.u_init.shape, dtype=bool)
+            mask[interior(self.u_init.ndim)] = True
+            if pert_mask is not None:
+                mask &= pert_mask
+            u_pert = np.zeros(self.u_init.shape)
+            values = np.random.default_rng(seed).standard_normal(int(mask.sum()))
+            u_pert[mask] = values * pert_mag / np.sqrt((values ** 2.).sum())
+        else:
+            u_pert = None
+        u_pert = bcast_array(self, u_pert)
+        return u_pert
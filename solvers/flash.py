@@ -12,7 +12,21 @@ class Flash(Simulation):
                  wrapper_finish_check_timeout=np.inf,
 
                  yt_derived_fields=None,
-                 link_list=None, copy_list=None):
+                 link_list=None, copy_list=None, fidelity_ladder=None,
+                 cache_dir=None, cache_max_bytes=np.inf, scratch_dir=None, solution_on_grid=False,
+                 output_mode="checkpoint", plot_vars=None, plot_single_precision=False, plotfile_params=None):
+        """
+        :param output_mode: "checkpoint" reads the solution of every run from the final checkpoint; "plotfile" lets the
+            perturbed runs write a plotfile with plot_vars only, which is much smaller than the checkpoint. The
+            unperturbed run always keeps its checkpoint (see proceed)
+        :param plot_vars: the variables in the plotfile, i.e., grow_var and the variables needed by yt_derived_fields;
+            [grow_var] by default. plot_var_1, ..., plot_var_N and plotfileGridQuantityDP must be in flash.par
+        :param plot_single_precision: write the plotfile in single precision. Note the rounding error enters the
+            finite difference of the gradient, so grad_epsilon should be large enough
+        :param plotfile_params: other parameters of the perturbed runs in the plotfile mode, e.g., a switch of the
+            setup to skip the final checkpoint
+        The other parameters are the same as Simulation
+        """
         # TODO: add a warning of wrapper_nproc != iprocs * jprocs * kprocs
         init_params = {
             "restart": ".false.",
@@ -47,10 +61,50 @@ class Flash(Simulation):
                          wrapper_check_poll_interval, wrapper_successful_check_fn,
                          init_params, "flash.par", u0_fn,
                          pert_var, grow_var, yt_derived_fields=yt_derived_fields,
-                         link_list=link_list, copy_list=copy_list)
+                         link_list=link_list, copy_list=copy_list, fidelity_ladder=fidelity_ladder,
+                         cache_dir=cache_dir, cache_max_bytes=cache_max_bytes, scratch_dir=scratch_dir,
+                         solution_on_grid=solution_on_grid)
+
+        # the output options are given to the constructor, also when restarting
+        if output_mode not in ["checkpoint", "plotfile"]:
+            raise ValueError("output_mode must be either 'checkpoint' or 'plotfile'!")
+        self.output_mode = output_mode
+        self.plot_vars = plot_vars if plot_vars is not None else [grow_var]
+        self.plot_single_precision = plot_single_precision
+        self.plotfile_params = plotfile_params if plotfile_params is not None else {}
+        # the start time of the outputs of several horizons, see horizon_interval
+        self.t0 = t0
         return
 
     def proceed(self, t1, u_pert=None, u_pert_fn="u_pert.h5", fork_id=None):
+        if np.ndim(t1) > 0:
+            # one run to the largest horizon with outputs at all horizons, one row of ut per horizon
+            horizons = list(t1)
+            ut = super().proceed_simulation_horizons(horizons=horizons, u_pert=u_pert, fork_id=fork_id,
+                                                     **self.proceed_args(max(horizons), u_pert, u_pert_fn,
+                                                                         horizons=horizons))
+            return ut
+        ut = super().proceed_simulation(t1=t1, u_pert=u_pert, fork_id=fork_id,
+                                        **self.proceed_args(t1, u_pert, u_pert_fn))
+        return ut
+
+    async def proceed_async(self, t1, u_pert, u_pert_fn="u_pert.h5", fork_id=None):
+        # a perturbed run which lets the other runs of the rank proceed meanwhile, see run_concurrently
+        if np.ndim(t1) > 0:
+            raise ValueError("Several horizons are not supported by proceed_async!")
+        ut = await super().proceed_simulation_async(t1=t1, u_pert=u_pert, fork_id=fork_id,
+                                                    **self.proceed_args(t1, u_pert, u_pert_fn))
+        return ut
+
+    def proceed_launch(self, t1, u_pert, u_pert_fn="u_pert.h5", fork_id=None):
+        # start a perturbed run and return wait(), see launch_simulation and run_pipelined
+        if np.ndim(t1) > 0:
+            raise ValueError("Several horizons are not supported by proceed_launch!")
+        return super().launch_simulation(t1=t1, u_pert=u_pert, fork_id=fork_id,
+                                         **self.proceed_args(t1, u_pert, u_pert_fn))
+
+    def proceed_args(self, t1, u_pert, u_pert_fn, horizons=None):
+        # the parameters and file names of a run from the basic state to t1, with outputs at the horizons if any
         if u_pert is None:
             cnop_do_inject = ".false."
             u_pert_fn = None
@@ -73,11 +127,43 @@ class Flash(Simulation):
         }
         # since we restart from "_chk_0001", new file should be named as "_chk_0002"
         ut_fn = "%s_hdf5_chk_0002" % self.basename  # based on FLash dataset naming format, say "cnop1d_hdf5_chk_0000"
+        wrapper_successful_check_fn = ut_fn
+        if u_pert is not None and self.output_mode == "plotfile":
+            # the unperturbed run keeps the checkpoint, which is reused (and cached) as the reference solution
+            params.update(self.plotfile_params)
+            params["plotfileGridQuantityDP"] = ".false." if self.plot_single_precision else ".true."
+            for i, plot_var in enumerate(self.plot_vars):
+                params["plot_var_%d" % (i + 1)] = plot_var
+            # the number of the final plotfile depends on whether an initial plotfile is written on restart, so the
+            # latest one is read, e.g., "cnop1d_hdf5_plt_cnt_0001"
+            ut_fn = "%s_hdf5_plt_cnt_*" % self.basename
+            wrapper_successful_check_fn = None
+
+        if horizons is not None:
+            interval = self.horizon_interval(horizons)
+            if u_pert is not None and self.output_mode == "plotfile":
+                params["plotFileIntervalTime"] = interval
+            else:
+                params["checkpointFileIntervalTime"] = interval
+                ut_fn = "%s_hdf5_chk_*" % self.basename
+            # the outputs are checked by proceed_simulation_horizons
+            wrapper_successful_check_fn = None
 
         # Delete FLASH log and .dat files which will not be overwritten and will increase in size if not deleted
         delete_fn = ["flash.dat", self.basename + ".log"]
 
-        ut = super().proceed_simulation(params, t1,
-                                        u_pert=u_pert, u_pert_fn=u_pert_fn, ut_fn=ut_fn, delete_fn=delete_fn,
-                                        fork_id=fork_id, wrapper_successful_check_fn=ut_fn)
-        return ut
+        return {"params": params, "u_pert_fn": u_pert_fn, "ut_fn": ut_fn, "delete_fn": delete_fn,
+                "wrapper_successful_check_fn": wrapper_successful_check_fn}
+
+    def horizon_interval(self, horizons, max_outputs=1000):
+        # the largest output interval from t0 of which all the horizons are multiples
+        spans = np.sort(np.array(horizons, dtype=float)) - self.t0
+        if spans[0] <= 0:
+            raise ValueError("The horizons must be later than t0 = {}!".format(self.t0))
+        # k outputs up to the first horizon, and at most max_outputs up to the last one
+        for k in range(1, int(max_outputs * spans[0] / spans[-1]) + 1):
+            multiples = spans * k / spans[0]
+            if np.allclose(multiples, np.round(multiples), rtol=0., atol=1e-6 * multiples[-1]):
+                return spans[0] / k
+        raise ValueError("The horizons need more than {} outputs, choose them on a regular interval!".format(
+            max_outputs))
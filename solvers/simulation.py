@@ -1,16 +1,33 @@
-from sim_controller import update_parameter, find_latest_checkpoint, load_checkpoint
-from utils import generate_shell_wrapper, wait_for_file, wait_for_last_line
-import subprocess
+from sim_controller import update_parameter, find_latest_checkpoint, load_checkpoint, checkpoint_prefix
+from utils import generate_shell_wrapper, wait_for_file, wait_for_last_line, wait_for_file_async, \
+    wait_for_last_line_async
+from mpi_shared import bcast_array, get_node_comms
+from state_cache import StateCache, hash_items, hash_file
 import os
+import shutil
 import warnings
-import yt
 import numpy as np
-import h5py
 import pathlib
-from mpi4py import MPI
+import glob
 import logging
+from serial_mpi import get_mpi
 
-yt.set_log_level("error")
+
+def copy_path(src, dst_dir):
+    # copy a file or a directory (recursively, as cp -r) into dst_dir; a failure raises OSError
+    dst = os.path.join(dst_dir, os.path.basename(src))
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, dirs_exist_ok=True)
+    else:
+        shutil.copy2(src, dst)
+    return
+
+
+def import_yt():
+    # yt is imported by the first reader of a dataset, so that starting the ranks does not wait for it
+    import yt
+    yt.set_log_level("error")
+    return yt
 
 
 class Simulation:
@@ -21,7 +38,9 @@ class Simulation:
                  wrapper_check_poll_interval: float, wrapper_successful_check_fn: str,
                  init_params: dict, param_fn: str, u0_fn: str,
                  pert_var: str, grow_var: str, yt_derived_fields: callable = None,
-                 link_list: list = None, copy_list: list = None):
+                 link_list: list = None, copy_list: list = None, fidelity_ladder: list = None,
+                 cache_dir: str = None, cache_max_bytes: float = np.inf, scratch_dir: str = None,
+                 solution_on_grid: bool = False):
         """
         :param u_init_fn: Initial condition file name. If None, then the initial condition is generated by the solver
             (e.g., Flash, Athena). Otherwise, the initial condition is read from the file (e.g., Gizmo)
@@ -44,17 +63,38 @@ class Simulation:
         :param yt_derived_fields: The function to compute derived fields from the yt dataset, usually to compute grow_var
         :param link_list: The list of files to be linked to the fork_dir, for parallelism
         :param copy_list: The list of files to be copied to the fork_dir, for parallelism
+        :param fidelity_ladder: The coarse levels for multi-fidelity CNOP, from the coarsest to the finest, e.g.,
+            [{"factor": 4, "params": {"lrefine_max": 2, "cfl": 0.8}}, {"factor": 2, "params": {"lrefine_max": 3}}].
+            "params" overrides the parameter file when proceeding (restarting) from the basic state u0, and the
+            perturbation of the level is restricted by averaging blocks of "factor" cells. The full resolution is the
+            level len(fidelity_ladder), without overrides. Note the solver must accept the coarser perturbation
+        :param cache_dir: The directory of the content-addressed cache of the basic state u0 and the unperturbed
+            solution at t1, keyed by the solver binary and the parameter file contents (see state_cache.py).
+            If None, no cache is used
+        :param cache_max_bytes: The maximum size of the cache, the least recently used states are evicted
+        :param scratch_dir: The node-local scratch directory (e.g., "/dev/shm" or a local NVMe) for the fork
+            directories. The files of link_list and copy_list (including the basic state) are staged once per node, and
+            only the grow_var array of each run is read back. If None, the fork directories are in base_dir
+        :param solution_on_grid: read the solution on the covering grid of level 0 (the grid of the perturbation, in C
+            order) instead of the cells of the dataset, which is needed by the colored gradient (see grad_colored)
         """
 
-        self.mpi = MPI
+        # the solver runs are spawned, which needs MPI
+        self.mpi = get_mpi(serial=False)
         self.mpi_comm = self.mpi.COMM_WORLD
         self.mpi_comm_self = self.mpi.COMM_SELF
         self.mpi_rank = self.mpi_comm.Get_rank()
         self.mpi_size = self.mpi_comm.Get_size()
+        # fork_id of the gradient runs is mpi_fork_offset + mpi_rank; mpi_search_id tags concurrent searches
+        self.mpi_fork_offset = 0
+        self.mpi_search_id = None
+        # node-shared memory windows and communicators, see mpi_shared.py
+        self.mpi_shared_windows = {}
+        self.mpi_node_comms = None
 
         self.mpi_root_dir = os.getcwd()
         try:
-            last_checkpoint_fn = find_latest_checkpoint(base_dir, self.__class__.__name__ + "_checkpoint")
+            last_checkpoint_fn = find_latest_checkpoint(base_dir, checkpoint_prefix(self))
         except FileNotFoundError:
             self.restart = False
         else:
@@ -64,8 +104,13 @@ class Simulation:
         if self.restart:
             # if there is a checkpoint file, load process attributes from it
             load_checkpoint(self.restart_checkpoint_fn, "process", self)
-            # derived_field function is not saved in the checkpoint file, so we need to reassign it
+            # derived_field function and fidelity_ladder are not saved in the checkpoint file, so we need to reassign
             self.yt_derived_fields = yt_derived_fields
+            self.fidelity_ladder = fidelity_ladder if fidelity_ladder is not None else []
+            self.fidelity_references = {}
+            # the scratch directory may differ between jobs, and the staged files are on the nodes of the last job
+            self.scratch_dir = scratch_dir
+            self.stage_scratch()
             # now print that the class is initialized with detailed information
             if self.mpi_rank == 0:
                 print("The class is initialized with the checkpoint file {}.".format(self.restart_checkpoint_fn))
@@ -74,7 +119,7 @@ class Simulation:
             if u_init_fn is not None:
                 if not pathlib.Path(base_dir + "/" + u_init_fn).exists():
                     raise ValueError("The initial condition file does not exist!")
-                self.u_init_fn = u_init_fn
+            self.u_init_fn = u_init_fn
             self.base_dir = base_dir
             if "./" not in exec_command:
                 raise ValueError("'./' must be included before the executable!")
@@ -93,9 +138,22 @@ class Simulation:
             self.pert_var = pert_var
             self.grow_var = grow_var
             self.yt_derived_fields = yt_derived_fields
+            self.solution_on_grid = solution_on_grid
 
             self.t1 = None
             self.ut1_unperturbed_fn = None
+            # the unperturbed solutions of the horizons of proceed_simulation_horizons
+            self.horizon_t1s = []
+            self.horizon_ut_fns = []
+
+            self.fidelity_ladder = fidelity_ladder if fidelity_ladder is not None else []
+            self.fidelity_level = len(self.fidelity_ladder)
+            # the unperturbed references of the levels other than the current one, see set_fidelity
+            self.fidelity_references = {}
+
+            self.cache_dir = cache_dir
+            self.cache_max_bytes = cache_max_bytes
+            self.u0_key = None
 
             if link_list is None:
                 link_list = []
@@ -121,15 +179,64 @@ class Simulation:
                 # Now evolve the initial condition to t0, to obtain u0 which is the basic state
                 update_parameter(self.base_dir + "/" + self.param_fn, init_params)
 
-                self.run_simulation_with_shell_wrapper()
+                if self.cache_dir is not None:
+                    self.u0_key = self.state_key()
+                if self.cache_dir is not None and self.get_state_cache().fetch(self.u0_key,
+                                                                               self.base_dir + "/" + self.u0_fn):
+                    logging.debug("The basic state u0 is found in the cache {}.".format(self.cache_dir))
+                else:
+                    self.run_simulation_with_shell_wrapper()
+                    if self.cache_dir is not None:
+                        self.get_state_cache().store(self.u0_key, self.base_dir + "/" + self.u0_fn)
 
-                logging.debug("The basic state u0 is evolved from the initial condition u_init "
-                              "and saved as {}.".format(self.u0_fn))
+                    logging.debug("The basic state u0 is evolved from the initial condition u_init "
+                                  "and saved as {}.".format(self.u0_fn))
+            self.u0_key = self.mpi_comm.bcast(self.u0_key, root=0)
             # set a barrier to make sure the basic state is generated before proceeding
             self.mpi_comm.Barrier()
+            self.scratch_dir = scratch_dir
+            self.stage_scratch()
             return
 
     def run_simulation_with_shell_wrapper(self):
+        child_comm, ending_remark = self.spawn_shell_wrapper()
+        self.wait_shell_wrapper(self.base_dir, ending_remark)
+        self.finish_shell_wrapper(child_comm)
+        return
+
+    def wait_shell_wrapper(self, run_dir, ending_remark):
+        # wait for the simulation in run_dir to start and then to finish
+        if not wait_for_file(f"{run_dir}/{self.wrapper_output}",
+                             timeout=self.wrapper_running_check_timeout,
+                             poll_interval=self.wrapper_check_poll_interval):
+            raise RuntimeError("The simulation is not running since "
+                               f"{run_dir}/{self.wrapper_output} is not generated!")
+
+        if not wait_for_last_line(f"{run_dir}/{self.wrapper_output}", ending_remark,
+                                  timeout=self.wrapper_finish_check_timeout,
+                                  poll_interval=self.wrapper_check_poll_interval):
+            raise RuntimeError(
+                f"The simulation is not finished within {self.wrapper_finish_check_timeout} seconds!")
+        return
+
+    async def wait_shell_wrapper_async(self, run_dir, ending_remark):
+        # wait for the simulation in run_dir as run_simulation_with_shell_wrapper, but the other runs of the rank (see
+        # run_concurrently) proceed meanwhile
+        if not await wait_for_file_async(f"{run_dir}/{self.wrapper_output}",
+                                         timeout=self.wrapper_running_check_timeout,
+                                         poll_interval=self.wrapper_check_poll_interval):
+            raise RuntimeError("The simulation is not running since "
+                               f"{run_dir}/{self.wrapper_output} is not generated!")
+
+        if not await wait_for_last_line_async(f"{run_dir}/{self.wrapper_output}", ending_remark,
+                                              timeout=self.wrapper_finish_check_timeout,
+                                              poll_interval=self.wrapper_check_poll_interval):
+            raise RuntimeError(
+                f"The simulation is not finished within {self.wrapper_finish_check_timeout} seconds!")
+        return
+
+    def spawn_shell_wrapper(self):
+        # start the simulation in base_dir without waiting for it, return the child communicator and ending remark
         # First, delete the wrapper output to avoid confusion from wait_for_file and wait_for_last_line
         if os.path.exists(f"{self.base_dir}/{self.wrapper_output}"):
             os.remove(f"{self.base_dir}/{self.wrapper_output}")
@@ -148,7 +255,7 @@ class Simulation:
 
         # Spawn might not honor os.chdir, so we pass in mpi.info to change the working directory
         # Use absolute path since some mpi version can get confused
-        info.Set("wdir", f"{self.mpi_root_dir}/{self.base_dir}")
+        info.Set("wdir", os.path.join(self.mpi_root_dir, self.base_dir))
 
         # Make child process on the same node with the parent process, avoid crossing-node failure/deffiency
         # See: https://stackoverflow.com/questions/47743425/controlling-node-mapping-of-mpi-comm-spawn
@@ -158,45 +265,118 @@ class Simulation:
         child_comm = self.mpi_comm_self.Spawn(command='bash', args=[self.wrapper_name] + self.wrapper_args.split(),
                                               maxprocs=self.wrapper_nproc, info=info)
         info.Free()
-        if not wait_for_file(f"{self.base_dir}/{self.wrapper_output}",
-                             timeout=self.wrapper_running_check_timeout,
-                             poll_interval=self.wrapper_check_poll_interval):
-            raise RuntimeError("The simulation is not running since "
-                               f"{self.base_dir}/{self.wrapper_output} is not generated!")
+        return child_comm, ending_remark
 
-        if not wait_for_last_line(f"{self.base_dir}/{self.wrapper_output}", ending_remark,
-                                  timeout=self.wrapper_finish_check_timeout,
-                                  poll_interval=self.wrapper_check_poll_interval):
-            raise RuntimeError(
-                f"The simulation is not finished within {self.wrapper_finish_check_timeout} seconds!")
+    def finish_shell_wrapper(self, child_comm, run_dir=None):
+        # release the finished children and check the simulation in run_dir (base_dir by default) is successful
         child_comm.Free()
 
+        run_dir = self.base_dir if run_dir is None else run_dir
         if self.wrapper_successful_check_fn is not None:
-            if not pathlib.Path(self.base_dir + "/" + self.wrapper_successful_check_fn).exists():
-                raise ValueError(f"The finish check file {self.base_dir}/{self.wrapper_successful_check_fn} is not "
+            if not pathlib.Path(run_dir + "/" + self.wrapper_successful_check_fn).exists():
+                raise ValueError(f"The finish check file {run_dir}/{self.wrapper_successful_check_fn} is not "
                                  f"generated!\n"
-                                 f"You should check the simulation output {self.base_dir}/{self.wrapper_output} or "
+                                 f"You should check the simulation output {run_dir}/{self.wrapper_output} or "
                                  f"simulation log file for more information.")
 
         return
 
+    def stage_scratch(self):
+        # copy the inputs of the fork directories to the node-local scratch, once per node (collective)
+        if self.scratch_dir is None:
+            self.scratch_base_dir = None
+            return
+        # one directory per experiment, so that several experiments can share the scratch
+        self.scratch_base_dir = self.scratch_dir + "/cnop_" + hash_items(os.path.abspath(self.base_dir))[:16]
+        node_comm, _ = get_node_comms(self)
+        if node_comm.Get_rank() == 0:
+            pathlib.Path(self.scratch_base_dir).mkdir(parents=True, exist_ok=True)
+            for fn in self.link_list + self.copy_list:
+                copy_path(os.path.join(self.base_dir, fn), self.scratch_base_dir)
+        node_comm.Barrier()
+        return
+
+    def cleanup_scratch(self):
+        # remove the staged files from the node-local scratch at the end of the job (collective)
+        if self.scratch_base_dir is None:
+            return
+        node_comm, _ = get_node_comms(self)
+        node_comm.Barrier()
+        if node_comm.Get_rank() == 0 and os.path.exists(self.scratch_base_dir):
+            shutil.rmtree(self.scratch_base_dir)
+        # the runs after the cleanup (if any) are forked from base_dir
+        self.scratch_base_dir = None
+        return
+
+    def fork_root_dir(self):
+        # the fork directories are next to the staged inputs, on the node-local scratch if available
+        return self.scratch_base_dir if self.scratch_base_dir is not None else self.base_dir
+
+    def get_state_cache(self):
+        return StateCache(self.cache_dir, max_bytes=self.cache_max_bytes)
+
+    def state_key(self, *items):
+        # content hash of the solver binary, the current parameter file in base_dir, the initial condition file (if
+        # any) and the given items
+        binary_fn = self.base_dir + "/" + self.exec_command.split()[0]
+        with open(self.base_dir + "/" + self.param_fn, 'rb') as f:
+            param_contents = f.read()
+        u_init_hash = hash_file(self.base_dir + "/" + self.u_init_fn) if self.u_init_fn is not None else None
+        return hash_items(hash_file(binary_fn), param_contents, u_init_hash, *items)
+
+    def set_fidelity(self, level):
+        # switch to a level of fidelity_ladder, where level = len(fidelity_ladder) is the full resolution
+        if level < 0 or level > len(self.fidelity_ladder):
+            raise ValueError("The fidelity level {} is not in the fidelity_ladder!".format(level))
+        if level != self.fidelity_level:
+            # the unperturbed references are kept per level (in files of their own, see unperturbed_suffix), so that
+            # checking the agreement with the finer level and switching back does not rerun them
+            self.fidelity_references[self.fidelity_level] = (self.t1, self.ut1_unperturbed_fn, list(self.horizon_t1s),
+                                                             list(self.horizon_ut_fns))
+            self.fidelity_level = level
+            self.t1, self.ut1_unperturbed_fn, self.horizon_t1s, self.horizon_ut_fns = self.fidelity_references.get(
+                level, (None, None, [], []))
+        return
+
+    def unperturbed_suffix(self):
+        # the suffix of the kept unperturbed solutions, which also names the coarse level if any
+        if self.fidelity_level == len(self.fidelity_ladder):
+            return "_unperturbed"
+        return "_level_{}_unperturbed".format(self.fidelity_level)
+
+    def fidelity_factor(self):
+        # the coarsening factor of the perturbation at the current level
+        if self.fidelity_level == len(self.fidelity_ladder):
+            return 1
+        return self.fidelity_ladder[self.fidelity_level]["factor"]
+
+    def share_unperturbed(self, t1):
+        # evolve (or reuse) the unperturbed solution at t1 on rank 0 and let all ranks know about the file
+        if all(self.mpi_comm.allgather(self.t1 == t1 and self.ut1_unperturbed_fn is not None)):
+            # already shared
+            return
+        if self.mpi_rank == 0:
+            self.proceed(t1)
+        self.t1, self.ut1_unperturbed_fn = self.mpi_comm.bcast((self.t1, self.ut1_unperturbed_fn), root=0)
+        return
+
     def get_covering_grid(self, variable):
+        # the values are read on rank 0 and broadcast by bcast_array
         if self.mpi_rank == 0:
-            ds = yt.load(self.base_dir + "/" + self.u0_fn)
+            ds = import_yt().load(self.base_dir + "/" + self.u0_fn)
             dims = ds.domain_dimensions
             values = ds.covering_grid(level=0, left_edge=ds.domain_left_edge, dims=dims)[variable].v
             del ds
-            self.mpi_comm.bcast(values, root=0)
         else:
             values = None
-            values = self.mpi_comm.bcast(values, root=0)
+        values = bcast_array(self, values)
         return values
 
     def generate_u_pert(self, pert_delta, pert_mask=None, seed=19900227):
         # generate a perturbation file with magnitude pert_delta
-        # This should be created on one processor and broadcast to all processors
+        # This should be created on one processor and broadcast to all processors (see bcast_array)
         if self.mpi_rank == 0:
-            ds = yt.load(self.base_dir + "/" + self.u0_fn)
+            ds = import_yt().load(self.base_dir + "/" + self.u0_fn)
             if pert_mask is not None:
                 # if shape does not match
                 if not np.array_equal(pert_mask.shape, ds.domain_dimensions):
@@ -207,10 +387,9 @@ class Simulation:
             u_pert = np.zeros(ds.domain_dimensions)
             u_pert[pert_mask] = np.random.uniform(-pert_delta, pert_delta, u_pert[pert_mask].shape)
             del ds
-            self.mpi_comm.bcast(u_pert, root=0)
         else:
             u_pert = None
-            u_pert = self.mpi_comm.bcast(u_pert, root=0)
+        u_pert = bcast_array(self, u_pert)
         return u_pert
 
     def proceed_simulation(self, params, t1,
@@ -225,11 +404,14 @@ class Simulation:
         # Note that only when we actually run the simulation, we need save u_pert into a file
         if t1 not in params.values():
             raise ValueError("The final time is not included in the input parameter!")
+        if self.fidelity_level < len(self.fidelity_ladder):
+            # coarse level of the multi-fidelity CNOP
+            params = {**params, **self.fidelity_ladder[self.fidelity_level]["params"]}
 
         old_base_dir = self.base_dir
         if fork_id is not None:
             # create a separate run in a sub folder
-            fork_dir = self.base_dir + "/fork_%d" % fork_id
+            fork_dir = self.fork_root_dir() + "/fork_%d" % fork_id
             self.make_fork_dir(fork_dir)
             self.base_dir = fork_dir
 
@@ -258,16 +440,7 @@ class Simulation:
 
         # Now save the perturbation into a file for the simulation to read in
         if u_pert is not None:
-            if u_pert_fn is None:
-                raise ValueError("The perturbation file name is not specified!")
-            if pathlib.Path(self.base_dir + "/" + u_pert_fn).exists():
-                # warnings.warn("The perturbation file already exists! Overwriting it.")
-                os.remove(self.base_dir + "/" + u_pert_fn)
-            with h5py.File(self.base_dir + "/" + u_pert_fn, 'w') as f:
-                f.create_dataset('u_pert', data=u_pert)
-            # Check whether the input parameter includes the perturbation file name
-            if u_pert_fn not in params.values():
-                raise ValueError("The perturbation file name is not included in the input parameter!")
+            self.write_perturbation(params, u_pert, u_pert_fn)
         else:
             if u_pert_fn is not None:
                 raise ValueError("The perturbation file name is specified, but the perturbation is not!")
@@ -276,7 +449,7 @@ class Simulation:
                 t1_infile = self.yt_read_parameter(self.base_dir, self.ut1_unperturbed_fn, 'current_time')
                 if np.isclose(t1, t1_infile, atol=np.min((t1, t1_infile)) * 1e-2):  # allow 1% tolerance due to timestep
                     ut = self.yt_read_solution(self.base_dir, self.ut1_unperturbed_fn, self.grow_var,
-                                               self.yt_derived_fields)
+                                               self.yt_derived_fields, on_grid=self.solution_on_grid)
                     return ut
                 else:
                     warnings.warn("The unperturbed solution at t1 = %f is already computed, but the time does not "
@@ -288,16 +461,182 @@ class Simulation:
 
         # Now update the parameter file
         update_parameter(self.base_dir + "/" + self.param_fn, params)
-        if pathlib.Path(self.base_dir + "/" + ut_fn).exists():
+        if u_pert is None and self.ut1_unperturbed_fn is None and fork_id is None and self.cache_dir is not None:
+            # the unperturbed solution from the same basic state and parameters may be in the cache
+            if self.get_state_cache().fetch(self.state_key(self.u0_key), self.base_dir + "/" + ut_fn + self.unperturbed_suffix()):
+                logging.debug("The unperturbed solution at t1 = {} is found in the cache {}.".format(t1,
+                                                                                                   self.cache_dir))
+                self.ut1_unperturbed_fn = ut_fn + self.unperturbed_suffix()
+                self.t1 = t1
+                ut = self.yt_read_solution(self.base_dir, self.ut1_unperturbed_fn, self.grow_var,
+                                           self.yt_derived_fields, on_grid=self.solution_on_grid)
+                self.base_dir = old_base_dir
+                return ut
+        for fn in glob.glob(self.base_dir + "/" + ut_fn):
             # warnings.warn("The evolving state file already exists! Deleting it now for safety.")
-            os.remove(self.base_dir + "/" + ut_fn)
+            os.remove(fn)
 
         # Now start the simulation
         self.run_simulation_with_shell_wrapper()
+        ut = self.collect_output(t1, u_pert, u_pert_fn, ut_fn, delete_fn, fork_id)
 
-        # Delete the perturbation file
+        # Change back to the original base_dir
+        self.base_dir = old_base_dir
+        return ut
+
+    async def proceed_simulation_async(self, params, t1, u_pert, u_pert_fn, ut_fn, delete_fn=None, fork_id=None,
+                                       wrapper_successful_check_fn=None):
+        # same as proceed_simulation for a perturbed run in a fork_dir, but the other runs of the rank (see
+        # run_concurrently) proceed while this one is running. The unperturbed run is done by proceed_simulation
+        fork_dir, child_comm, ending_remark = self.launch_in_fork(params, t1, u_pert, u_pert_fn, ut_fn, fork_id,
+                                                                  wrapper_successful_check_fn)
+
+        await self.wait_shell_wrapper_async(fork_dir, ending_remark)
+
+        self.wrapper_successful_check_fn = wrapper_successful_check_fn
+        self.finish_shell_wrapper(child_comm, run_dir=fork_dir)
+        ut = self.collect_output(t1, u_pert, u_pert_fn, ut_fn, delete_fn, fork_id, run_dir=fork_dir)
+        return ut
+
+    def launch_simulation(self, params, t1, u_pert, u_pert_fn, ut_fn, delete_fn=None, fork_id=None,
+                          wrapper_successful_check_fn=None):
+        """
+        Start a perturbed run in a fork_dir as proceed_simulation_async, for the pipelined runs of run_pipelined
+        :return: wait(), which blocks until the run is finished and returns collect(); collect() reads the solution
+            and cleans up the fork_dir, and may be called from another thread while the next run is going
+        """
+        fork_dir, child_comm, ending_remark = self.launch_in_fork(params, t1, u_pert, u_pert_fn, ut_fn, fork_id,
+                                                                  wrapper_successful_check_fn)
+
+        def wait():
+            self.wait_shell_wrapper(fork_dir, ending_remark)
+            self.wrapper_successful_check_fn = wrapper_successful_check_fn
+            self.finish_shell_wrapper(child_comm, run_dir=fork_dir)
+            return lambda: self.collect_output(t1, u_pert, u_pert_fn, ut_fn, delete_fn, fork_id, run_dir=fork_dir)
+
+        return wait
+
+    def launch_in_fork(self, params, t1, u_pert, u_pert_fn, ut_fn, fork_id, wrapper_successful_check_fn):
+        # prepare the fork_dir of a perturbed run and spawn the simulation without waiting for it
+        if u_pert is None or fork_id is None:
+            raise ValueError("Only the perturbed runs in a fork_dir can proceed concurrently!")
+        if t1 not in params.values():
+            raise ValueError("The final time is not included in the input parameter!")
+        if self.fidelity_level < len(self.fidelity_ladder):
+            params = {**params, **self.fidelity_ladder[self.fidelity_level]["params"]}
+
+        # base_dir is switched to the fork_dir only until the simulation is spawned, so that other runs of the rank
+        # (see run_concurrently) always find the original base_dir
+        old_base_dir = self.base_dir
+        fork_dir = self.fork_root_dir() + "/fork_%d" % fork_id
+        self.make_fork_dir(fork_dir)
+        self.base_dir = fork_dir
+        try:
+            self.wrapper_successful_check_fn = wrapper_successful_check_fn
+            self.write_perturbation(params, u_pert, u_pert_fn)
+            update_parameter(self.base_dir + "/" + self.param_fn, params)
+            for fn in glob.glob(self.base_dir + "/" + ut_fn):
+                os.remove(fn)
+            child_comm, ending_remark = self.spawn_shell_wrapper()
+        finally:
+            self.base_dir = old_base_dir
+        return fork_dir, child_comm, ending_remark
+
+    def proceed_simulation_horizons(self, params, horizons, u_pert=None, u_pert_fn=None, ut_fn=None, delete_fn=None,
+                                    fork_id=None, wrapper_successful_check_fn=None):
+        """
+        Same as proceed_simulation, but to several horizons with one run: params must let the solver write an output at
+        (about) each of the horizons, e.g., by an output interval, and ut_fn is the glob pattern of these outputs. The
+        output closest in time is taken for each horizon. The unperturbed solutions are kept per horizon
+        :param params: the parameters of the run, with the largest horizon as the final time
+        :param horizons: list of the final times
+        :return: array of the solutions, one row per horizon
+        """
+        if max(horizons) not in params.values():
+            raise ValueError("The largest horizon is not included in the input parameter!")
+        if self.fidelity_level < len(self.fidelity_ladder):
+            params = {**params, **self.fidelity_ladder[self.fidelity_level]["params"]}
+        horizon_t1s = list(self.horizon_t1s)
+        if u_pert is None and all([t1 in horizon_t1s for t1 in horizons]):
+            return np.array([self.yt_read_solution(self.base_dir, self.horizon_ut_fns[horizon_t1s.index(t1)],
+                                                   self.grow_var, self.yt_derived_fields,
+                                                   on_grid=self.solution_on_grid) for t1 in horizons])
+
+        old_base_dir = self.base_dir
+        if fork_id is not None:
+            fork_dir = self.fork_root_dir() + "/fork_%d" % fork_id
+            self.make_fork_dir(fork_dir)
+            self.base_dir = fork_dir
+        self.wrapper_successful_check_fn = wrapper_successful_check_fn
+        if u_pert is not None:
+            self.write_perturbation(params, u_pert, u_pert_fn)
+        update_parameter(self.base_dir + "/" + self.param_fn, params)
+        for fn in self.find_outputs(ut_fn):
+            os.remove(self.base_dir + "/" + fn)
+
+        self.run_simulation_with_shell_wrapper()
+
+        outputs = self.find_outputs(ut_fn)
+        if len(outputs) == 0:
+            raise ValueError(f"The output files {self.base_dir}/{ut_fn} are not generated!")
+        output_t1s = np.array([self.yt_read_parameter(self.base_dir, fn, 'current_time') for fn in outputs])
+        ut_fns = []
+        for t1 in horizons:
+            i = np.argmin(np.abs(output_t1s - t1))
+            if not np.isclose(t1, output_t1s[i], atol=np.min((t1, output_t1s[i])) * 1e-2):
+                warnings.warn("The closest output to the horizon t1 = %f is at t = %f!" % (t1, output_t1s[i]))
+            ut_fns.append(outputs[i])
         if u_pert_fn is not None:
             os.remove(self.base_dir + "/" + u_pert_fn)
+        if delete_fn is not None:
+            for fn in [delete_fn] if isinstance(delete_fn, str) else delete_fn:
+                os.remove(self.base_dir + "/" + fn)
+
+        ut = np.array([self.yt_read_solution(self.base_dir, fn, self.grow_var, self.yt_derived_fields,
+                                             on_grid=self.solution_on_grid) for fn in ut_fns])
+        if u_pert is None and fork_id is None:
+            # keep the unperturbed solution of each horizon, the outputs are overwritten by the next run
+            for t1, fn in zip(horizons, ut_fns):
+                if t1 not in horizon_t1s:
+                    horizon_t1s.append(t1)
+                    self.horizon_ut_fns = list(self.horizon_ut_fns) + ["horizon_%g" % t1 + self.unperturbed_suffix()]
+                    shutil.copy2(self.base_dir + "/" + fn, self.base_dir + "/" + self.horizon_ut_fns[-1])
+            self.horizon_t1s = horizon_t1s
+        if fork_id is not None:
+            self.cleanup_fork_dir(self.base_dir)
+        self.base_dir = old_base_dir
+        return ut
+
+    def find_outputs(self, ut_fn):
+        # the outputs matching the glob pattern ut_fn in sorted order, except the basic state and the kept solutions
+        return [os.path.basename(fn) for fn in sorted(glob.glob(self.base_dir + "/" + ut_fn))
+                if os.path.basename(fn) != self.u0_fn and not fn.endswith("_unperturbed")]
+
+    def write_perturbation(self, params, u_pert, u_pert_fn):
+        # save the perturbation into a file in base_dir for the simulation to read in
+        import h5py
+
+        if u_pert_fn is None:
+            raise ValueError("The perturbation file name is not specified!")
+        if pathlib.Path(self.base_dir + "/" + u_pert_fn).exists():
+            # warnings.warn("The perturbation file already exists! Overwriting it.")
+            os.remove(self.base_dir + "/" + u_pert_fn)
+        with h5py.File(self.base_dir + "/" + u_pert_fn, 'w') as f:
+            f.create_dataset('u_pert', data=u_pert)
+        # Check whether the input parameter includes the perturbation file name
+        if u_pert_fn not in params.values():
+            raise ValueError("The perturbation file name is not included in the input parameter!")
+        return
+
+    def collect_output(self, t1, u_pert, u_pert_fn, ut_fn, delete_fn, fork_id, run_dir=None):
+        # read the solution of the finished run in run_dir (base_dir by default) and clean up after it. Given run_dir,
+        # base_dir is not used, so that a perturbed run can be collected in another thread (see launch_simulation)
+        run_dir = self.base_dir if run_dir is None else run_dir
+        ut_fn = self.find_output(ut_fn, run_dir=run_dir)
+
+        # Delete the perturbation file
+        if u_pert_fn is not None:
+            os.remove(run_dir + "/" + u_pert_fn)
 
         # Delete the file specified by delete_fn for each run, in case some log file grows too large
         if delete_fn is not None:
@@ -305,38 +644,56 @@ class Simulation:
             if isinstance(delete_fn, str):
                 delete_fn = [delete_fn]
             for fn in delete_fn:
-                os.remove(self.base_dir + "/" + fn)
+                os.remove(run_dir + "/" + fn)
 
         if u_pert is None and self.ut1_unperturbed_fn is None:
             # if the unperturbed solution at t1 is not saved, then save the current state as the unperturbed solution
-            self.ut1_unperturbed_fn = ut_fn + "_unperturbed"
+            self.ut1_unperturbed_fn = ut_fn + self.unperturbed_suffix()
             self.t1 = t1
-            os.system("cp " + self.base_dir + "/" + ut_fn + " " + self.base_dir + "/" + self.ut1_unperturbed_fn)
+            shutil.copy2(run_dir + "/" + ut_fn, run_dir + "/" + self.ut1_unperturbed_fn)
+            if fork_id is None and self.cache_dir is not None:
+                self.get_state_cache().store(self.state_key(self.u0_key),
+                                             run_dir + "/" + self.ut1_unperturbed_fn)
 
         # Return the evolving state ut
-        ut = self.yt_read_solution(self.base_dir, ut_fn, self.grow_var, self.yt_derived_fields)
+        ut = self.yt_read_solution(run_dir, ut_fn, self.grow_var, self.yt_derived_fields,
+                                   on_grid=self.solution_on_grid)
 
-        # Clean up all the files in the fork_dir, which is now self.base_dir
+        # Clean up all the files in the fork_dir, which is now run_dir
         if fork_id is not None:
-            self.cleanup_fork_dir(self.base_dir)
+            self.cleanup_fork_dir(run_dir)
 
-        # Change back to the original base_dir
-        self.base_dir = old_base_dir
         return ut
 
+    def find_output(self, ut_fn, run_dir=None):
+        # ut_fn may be a glob pattern, e.g., when the number of the output file is not known beforehand, then the last
+        # file in sorted order is taken
+        run_dir = self.base_dir if run_dir is None else run_dir
+        matches = sorted(glob.glob(run_dir + "/" + ut_fn))
+        if len(matches) == 0:
+            raise ValueError(f"The output file {run_dir}/{ut_fn} is not generated!\n"
+                             f"You should check the simulation output {run_dir}/{self.wrapper_output} or "
+                             f"simulation log file for more information.")
+        return os.path.basename(matches[-1])
+
     @staticmethod
-    def yt_read_solution(base_dir, fn, grow_var, derived_fields=None):
-        # Return the evolving state ut as one-dimensional array, since its spatial info is not needed
-        ds = yt.load(base_dir + "/" + fn)
+    def yt_read_solution(base_dir, fn, grow_var, derived_fields=None, on_grid=False):
+        # Return the evolving state ut as one-dimensional array, since its spatial info is not needed, unless on_grid
+        ds = import_yt().load(base_dir + "/" + fn)
         if derived_fields is not None:
             derived_fields(ds)
-        solution = ds.all_data()[grow_var].v
+        if on_grid:
+            data = ds.covering_grid(level=0, left_edge=ds.domain_left_edge, dims=ds.domain_dimensions)
+        else:
+            data = ds.all_data()
+        # plotfiles may be in single precision
+        solution = data[grow_var].v.astype(float)
         del ds
         return solution
 
     @staticmethod
     def yt_read_parameter(base_dir, fn, param_name):
-        ds = yt.load(base_dir + "/" + fn)
+        ds = import_yt().load(base_dir + "/" + fn)
         if param_name == "current_time":
             param = ds.current_time.v
         else:
@@ -345,17 +702,20 @@ class Simulation:
         return param
 
     def make_fork_dir(self, fork_dir: str):
-        # copy all the files in the base_dir to the fork_id, but excluding folders
+        # copy all the files in the base_dir (or the staged copies on the scratch) to the fork_id, but excluding folders
         if pathlib.Path(fork_dir).exists():
-            # Clean up all the files in the fork_dir
-            self.cleanup_fork_dir(fork_dir)
+            # Clean up all the files in the fork_dir; the run must not start with the files of the previous one
+            if not self.cleanup_fork_dir(fork_dir):
+                raise RuntimeError(f"The fork directory {fork_dir} cannot be cleaned up!")
         else:
             os.mkdir(fork_dir)
 
-        # subprocess is needed to enter the fork_dir and create symbolic links
+        # the links are relative to the fork_dir, so that they point to the (staged) inputs next to it
         for fn in self.link_list:
-            subprocess.run(["ln", "-s", "../" + fn, "."], cwd=fork_dir)
-        os.system("cp -r " + self.base_dir + "/" + (" " + self.base_dir + "/").join(self.copy_list) + " " + fork_dir)
+            os.symlink("../" + fn, os.path.join(fork_dir, os.path.basename(fn)))
+        source_dir = self.fork_root_dir()
+        for fn in self.copy_list:
+            copy_path(os.path.join(source_dir, fn), fork_dir)
         return
 
     @staticmethod
@@ -363,7 +723,11 @@ class Simulation:
         if not pathlib.Path(fork_dir).exists():
             return True
         try:
-            os.system(f"rm -rf {fork_dir}/*")
+            for entry in os.scandir(fork_dir):
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
         except OSError:
             warnings.warn(f"The fork directory {fork_dir} cannot not deleted!")
             return False
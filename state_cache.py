@@ -0,0 +1,123 @@
+import hashlib
+import os
+import pathlib
+import shutil
+import tempfile
+import numpy as np
+
+
+def hash_items(*items):
+    """
+    Content hash of the given items
+    :param items: bytes, or anything else hashed by its repr (e.g., times, dictionary of parameters)
+    :return: hex digest
+    """
+    sha = hashlib.sha256()
+    for item in items:
+        if not isinstance(item, bytes):
+            item = repr(item).encode("utf-8")
+        # length prefix so that the item boundaries are part of the hash
+        sha.update(len(item).to_bytes(8, "little"))
+        sha.update(item)
+    return sha.hexdigest()
+
+
+def hash_file(file_path):
+    """
+    Content hash of a file, read in chunks
+    :param file_path: path of the file
+    :return: hex digest
+    """
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 24), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class StateCache:
+    def __init__(self, cache_dir, max_bytes=np.inf):
+        """
+        Content-addressed cache of solver states (e.g., the basic state u0 and the unperturbed run at t1), shared by
+        experiments with the same solver binary, parameters and times. Files are handed out by hardlink when possible,
+        and the least recently used entries are evicted when the cache exceeds max_bytes.
+        :param cache_dir: the cache directory, e.g., on the same filesystem as base_dir so that hardlinks work
+        :param max_bytes: the maximum total size of the cache in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        pathlib.Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+        return
+
+    def lookup(self, key):
+        """
+        Find the entry of the key
+        :param key: the content hash
+        :return: path of the entry, or None if not cached
+        """
+        entry = os.path.join(self.cache_dir, key)
+        if not os.path.exists(entry):
+            return None
+        # mark the entry as recently used
+        os.utime(entry)
+        return entry
+
+    def fetch(self, key, dest):
+        """
+        Hardlink (or copy, across filesystems) the entry of the key to dest
+        :param key: the content hash
+        :param dest: path of the destination file, overwritten if it exists
+        :return: True if the entry is found, False otherwise
+        """
+        entry = self.lookup(key)
+        if entry is None:
+            return False
+        link_or_copy(entry, dest)
+        return True
+
+    def store(self, key, src):
+        """
+        Store the file src as the entry of the key, and evict old entries if needed
+        :param key: the content hash
+        :param src: path of the file
+        :return: None
+        """
+        link_or_copy(src, os.path.join(self.cache_dir, key))
+        self.evict()
+        return
+
+    def evict(self):
+        # remove the least recently used entries until the cache fits into max_bytes
+        entries = [entry for entry in pathlib.Path(self.cache_dir).iterdir() if ".tmp." not in entry.name]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        total_bytes = sum([entry.stat().st_size for entry in entries])
+        while total_bytes > self.max_bytes and len(entries) > 0:
+            entry = entries.pop(0)
+            total_bytes -= entry.stat().st_size
+            entry.unlink()
+        return
+
+
+def link_or_copy(src, dest):
+    """
+    Hardlink (or copy, e.g., across filesystems) src to dest, which is replaced atomically, so that a partially
+    written dest is never visible, e.g., as a cache entry. The temporary name is unique also across the nodes sharing
+    the directory. A failed copy raises OSError
+    :param src: path of the file
+    :param dest: path of the destination file, overwritten if it exists
+    :return: None
+    """
+    fd, tmp_dest = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dest)), prefix=os.path.basename(dest) + ".tmp.")
+    os.close(fd)
+    try:
+        os.remove(tmp_dest)
+        try:
+            os.link(src, tmp_dest)
+        except OSError:
+            shutil.copy2(src, tmp_dest)
+        os.replace(tmp_dest, dest)
+    except OSError:
+        if os.path.exists(tmp_dest):
+            os.remove(tmp_dest)
+        raise
+    return
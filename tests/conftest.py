@@ -0,0 +1,42 @@
+import os
+import sys
+
+# the modules are at the top level of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import pytest
+from serial_mpi import SerialMPI
+
+
+class ToyProcess:
+    # a serial process whose solver is a few steps of a nonlinear 1-D diffusion, so that each cell influences the
+    # cells within n_steps of it only
+    def __init__(self, root_dir, n=32, n_steps=3):
+        self.mpi = SerialMPI
+        self.mpi_comm = SerialMPI.COMM_WORLD
+        self.mpi_comm_self = SerialMPI.COMM_SELF
+        self.mpi_rank = 0
+        self.mpi_size = 1
+        self.mpi_fork_offset = 0
+        self.mpi_search_id = None
+        self.mpi_shared_windows = {}
+        self.mpi_node_comms = None
+        self.mpi_root_dir = root_dir
+        self.fidelity_ladder = []
+        self.u0 = np.sin(np.linspace(0., np.pi, n))
+        self.n_steps = n_steps
+        self.n_runs = 0
+
+    def proceed(self, t1, u_pert=None, fork_id=None):
+        self.n_runs += 1
+        u = self.u0.copy() if u_pert is None else self.u0 + u_pert
+        for _ in range(self.n_steps):
+            u_left = np.concatenate(([0.], u[:-1]))
+            u_right = np.concatenate((u[1:], [0.]))
+            u = u + 0.2 * (1. + u ** 2) * (u_left - 2. * u + u_right)
+        return u
+
+
+@pytest.fixture
+def toy_process(tmp_path):
+    return ToyProcess(str(tmp_path))
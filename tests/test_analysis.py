@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip("h5py")
+import analysis
+from analysis import CheckpointSeries
+
+
+def test_scalars_open_each_file_once(tmp_path, monkeypatch):
+    for iter0 in range(3):
+        with h5py.File(tmp_path / "Flash_checkpoint_{:04d}.h5".format(iter0), "w") as f:
+            f.create_dataset("method/j_val", data=-float(iter0))
+            if iter0 > 0:
+                f.create_dataset("method/cgnorm", data=1. / iter0)
+    opened = []
+    h5py_file = h5py.File
+
+    def counting_file(fn, *args, **kwargs):
+        opened.append(fn)
+        return h5py_file(fn, *args, **kwargs)
+
+    monkeypatch.setattr(analysis.h5py, "File", counting_file)
+    series = CheckpointSeries(str(tmp_path))
+    table = series.scalars(names=("j_val", "cgnorm"))
+    assert len(opened) == 3
+    np.testing.assert_array_equal(table["iter0"], [0, 1, 2])
+    np.testing.assert_array_equal(table["j_val"], [0., -1., -2.])
+    np.testing.assert_array_equal(table["cgnorm"], [np.nan, 1., 0.5])
+
+    # the cached names are not read again
+    series.scalars(names=("j_val",))
+    assert len(opened) == 3
+
+
+def test_field_is_memory_mapped(tmp_path):
+    u_pert_best = np.arange(24.).reshape(2, 3, 4)
+    for iter0, compression in [(3, None), (5, "gzip")]:
+        with h5py.File(tmp_path / "Flash_checkpoint_search_0_{:04d}.h5".format(iter0), "w") as f:
+            f.create_dataset("method/u_pert_best", data=u_pert_best * iter0, compression=compression)
+    series = CheckpointSeries(str(tmp_path), prefix="Flash_checkpoint_search_0")
+    np.testing.assert_array_equal(series.iterations, [3, 5])
+    field = series.field(3)
+    assert isinstance(field, np.memmap)
+    np.testing.assert_array_equal(field, 3 * u_pert_best)
+    # a compressed field is read instead
+    np.testing.assert_array_equal(series.field(5), 5 * u_pert_best)
+    with pytest.raises(KeyError):
+        series.field(4)
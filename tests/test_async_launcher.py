@@ -0,0 +1,118 @@
+import asyncio
+import numpy as np
+import pytest
+from async_launcher import run_concurrently
+from cnop_methods import Spg2Defn
+from conftest import ToyProcess
+from grad_defn import grad_defn
+
+
+class ConcurrentToyProcess(ToyProcess):
+    # a process whose perturbed runs take a time which depends on the perturbation, and which records the runs in
+    # flight and the events of the pipelined runs
+    def __init__(self, root_dir, **kwargs):
+        super().__init__(root_dir, **kwargs)
+        self.in_flight = set()
+        self.max_in_flight = 0
+        self.events = []
+
+    async def proceed_async(self, t1, u_pert, fork_id=None):
+        assert fork_id not in self.in_flight
+        self.in_flight.add(fork_id)
+        self.max_in_flight = max(self.max_in_flight, len(self.in_flight))
+        await asyncio.sleep(1e-3 * (1. + np.sin(1e3 * abs(u_pert).sum())))
+        self.in_flight.remove(fork_id)
+        return self.proceed(t1, u_pert=u_pert, fork_id=fork_id)
+
+    def proceed_launch(self, t1, u_pert, fork_id=None):
+        key = len([event for event in self.events if event[0] == "launch"])
+        self.events.append(("launch", key, fork_id))
+
+        def wait():
+            self.events.append(("wait", key, fork_id))
+
+            def collect():
+                self.events.append(("collect", key, fork_id))
+                return self.proceed(t1, u_pert=u_pert, fork_id=fork_id)
+
+            return collect
+
+        return wait
+
+
+def jobs(n):
+    return [(i, 1e-3 * np.eye(32)[i]) for i in range(n)]
+
+
+def test_concurrent_runs(tmp_path):
+    process = ConcurrentToyProcess(str(tmp_path))
+    results = {}
+    run_concurrently(process, 1., jobs(12), lambda key, ut: results.update({key: ut}), runs_in_flight=3)
+    assert process.max_in_flight == 3
+    assert sorted(results) == list(range(12))
+    for key, u_pert in jobs(12):
+        np.testing.assert_array_equal(results[key], process.proceed(1., u_pert=u_pert))
+
+
+def test_serial_runs_in_order(toy_process):
+    keys = []
+    run_concurrently(toy_process, 1., jobs(5), lambda key, ut: keys.append(key))
+    assert keys == list(range(5))
+    with pytest.raises(ValueError):
+        run_concurrently(toy_process, 1., jobs(5), lambda key, ut: None, runs_in_flight=2)
+    with pytest.raises(ValueError):
+        run_concurrently(toy_process, 1., jobs(5), lambda key, ut: None, pipelined=True)
+
+
+def test_pipelined_runs(tmp_path):
+    process = ConcurrentToyProcess(str(tmp_path))
+    results = []
+
+    def on_result(key, ut):
+        process.events.append(("result", key, None))
+        results.append((key, ut))
+
+    run_concurrently(process, 1., jobs(5), on_result, pipelined=True)
+    assert [key for key, _ in results] == list(range(5))
+    for key, u_pert in jobs(5):
+        np.testing.assert_array_equal(results[key][1], process.proceed(1., u_pert=u_pert))
+    events = process.events
+    launches = [fork_id for event, _, fork_id in events if event == "launch"]
+    # the runs alternate between two slots
+    assert launches[0::2] == [launches[0]] * 3
+    assert launches[1::2] == [launches[1]] * 2
+    assert launches[0] != launches[1]
+    for key in range(4):
+        # the result of run k is handled after run k + 1 is launched, and the output of run k is collected before
+        # its slot is used again by run k + 2
+        assert events.index(("launch", key + 1, launches[key + 1])) < events.index(("result", key, None))
+        if key + 2 < 5:
+            assert events.index(("collect", key, launches[key])) < events.index(("launch", key + 2, launches[key]))
+    with pytest.raises(ValueError):
+        run_concurrently(process, 1., jobs(5), on_result, runs_in_flight=2, pipelined=True)
+
+
+def test_gradient_does_not_depend_on_the_launcher(tmp_path):
+    process = ConcurrentToyProcess(str(tmp_path))
+    u_pert = np.full(process.u0.shape, 1e-3)
+    g = grad_defn(process, u_pert, 1., 1e-6, iter0=0)
+    np.testing.assert_array_equal(grad_defn(process, u_pert, 1., 1e-6, iter0=1, runs_in_flight=3), g)
+    np.testing.assert_array_equal(grad_defn(process, u_pert, 1., 1e-6, iter0=2, pipelined=True), g)
+
+
+def test_launcher_options_are_checked_before_any_run(toy_process):
+    toy_process.base_dir = toy_process.mpi_root_dir
+    toy_process.restart = False
+    u_pert = np.zeros(toy_process.u0.shape)
+    # ToyProcess has neither proceed_launch nor proceed_async
+    with pytest.raises(ValueError):
+        Spg2Defn(toy_process, u_pert, 1., 1e-2, pipelined_runs=True)
+    with pytest.raises(ValueError):
+        Spg2Defn(toy_process, u_pert, 1., 1e-2, runs_in_flight=2)
+    assert toy_process.n_runs == 0
+    process = ConcurrentToyProcess(toy_process.mpi_root_dir)
+    process.base_dir = process.mpi_root_dir
+    process.restart = False
+    with pytest.raises(ValueError):
+        Spg2Defn(process, u_pert, 1., 1e-2, runs_in_flight=2, pipelined_runs=True)
+    assert process.n_runs == 0
@@ -0,0 +1,36 @@
+import numpy as np
+from solvers.burgers_nd import BurgersNd, solve_burgers_nd
+
+
+def test_burgers_nd_setup(tmp_path):
+    n = 16
+    x = np.sin(np.pi * np.arange(n) / (n - 1))
+    u_init = np.outer(x, x)
+    process = BurgersNd(u_init, 1., serial=True, base_dir=str(tmp_path))
+    assert process.basename == "burgers_nd"
+    assert process.solve_fn.endswith("burgers_nd.py")
+    # the basic state is on the grid, and evolved by solve_burgers_nd
+    np.testing.assert_array_equal(process.u0, solve_burgers_nd(u_init, 2, [11], 0.5, 0.1, 1.)[0])
+
+    u_pert = process.generate_u_pert(1e-3, seed=0)
+    assert process.proceed(2.).shape == (n * n,)
+    assert process.proceed(2., u_pert=u_pert).shape == (n * n,)
+    np.testing.assert_array_equal(process.proceed([1.5, 2.], u_pert=u_pert)[-1], process.proceed(2., u_pert=u_pert))
+
+
+def test_shared_windows(tmp_path):
+    from cnop_methods import Spg2Defn
+
+    n = 8
+    x = np.sin(np.pi * np.arange(n) / (n - 1))
+    process = BurgersNd(np.outer(x, x), 1., serial=True, base_dir=str(tmp_path))
+    # the basic state is the only field stored once per node for the lifetime of the process
+    assert not process.u0.flags.writeable
+    assert list(process.mpi_shared_windows) == [id(process.u0)]
+    # the initial perturbation is owned by the caller, and its window is freed at once
+    u_pert = process.generate_u_pert(1e-3, seed=0)
+    assert u_pert.flags.writeable
+    assert list(process.mpi_shared_windows) == [id(process.u0)]
+    # the windows of the reference solutions of the gradients are freed at the end of each gradient
+    Spg2Defn(process, u_pert, 1., 1e-3, grad_epsilon=1e-6, max_iter=1)
+    assert list(process.mpi_shared_windows) == [id(process.u0)]
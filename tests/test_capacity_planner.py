@@ -0,0 +1,27 @@
+import json
+import os
+import subprocess
+import sys
+from capacity_planner import CapacityPlanner
+
+PLAN = {"wrapper_nprocs": [16, 32, 64], "times": [410., 230., 150.], "cores_per_node": 128, "node_counts": [4, 8],
+        "n_indices": 4096, "runs_in_flight_options": [1, 2], "max_walltime": 86400.}
+
+
+def test_plan_is_returned_without_printing(capsys):
+    planner = CapacityPlanner(**PLAN)
+    assert capsys.readouterr().out == ""
+    assert planner.recommended in planner.layouts
+    assert planner.job_script.startswith("#!/bin/bash")
+    report = planner.report()
+    assert "Recommended: {} nodes".format(planner.recommended["n_nodes"]) in report
+    assert report.endswith(planner.job_script)
+
+
+def test_command_line(tmp_path):
+    plan_fn = tmp_path / "plan.json"
+    plan_fn.write_text(json.dumps(PLAN))
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, os.path.join(repo_dir, "capacity_planner.py"), str(plan_fn)],
+                            capture_output=True, text=True, check=True, cwd=repo_dir)
+    assert result.stdout == CapacityPlanner(**PLAN).report() + "\n"
@@ -0,0 +1,126 @@
+import os
+import numpy as np
+import pytest
+from cnop_methods import CnopMethod, ProjCgDefn, ProjLbfgsDefn
+from sim_controller import load_checkpoint
+
+
+def memory_method(cls, n=4, **options):
+    # a method with its memory initialized, without the search
+    method = cls.__new__(cls)
+    for key, value in options.items():
+        setattr(method, key, value)
+    method.u_pert = np.zeros(n)
+    method.distributed = False
+    method.pert_delta = 1e3
+    method.pert_mask = None
+    method.mpi_rank = 0
+    method.max_float = 1.e100
+    method.min_float = 1.e-100
+    method.lambda_ = 1.
+    method.init_memory()
+    return method
+
+
+def search_process(process):
+    process.base_dir = process.mpi_root_dir
+    process.restart = False
+    return process
+
+
+def test_cnop_method_is_abstract(toy_process):
+    class NoMemory(CnopMethod):
+        def search_direction(self):
+            return self.projected_gradient_direction()
+
+    with pytest.raises(TypeError):
+        CnopMethod(toy_process, np.zeros(toy_process.u0.shape), 1., 1e-2)
+    with pytest.raises(TypeError):
+        NoMemory(toy_process, np.zeros(toy_process.u0.shape), 1., 1e-2)
+    assert toy_process.n_runs == 0
+
+
+def test_lbfgs_ring_buffer():
+    lbfgs = memory_method(ProjLbfgsDefn, lbfgs_num=3, curvature_eps=1e-10)
+    pairs = [(np.eye(4)[k % 4] * (k + 1.), np.eye(4)[k % 4]) for k in range(5)]
+    for s, y in pairs:
+        lbfgs.update_memory(s, y)
+    # a pair without positive curvature is not stored
+    lbfgs.update_memory(np.ones(4), -np.ones(4))
+    assert lbfgs.hist_count == 5
+    for k in range(2, 5):
+        np.testing.assert_array_equal(lbfgs.s_hist[k % 3], pairs[k][0])
+        np.testing.assert_array_equal(lbfgs.y_hist[k % 3], pairs[k][1])
+
+
+def test_lbfgs_two_loop_recursion():
+    rng = np.random.default_rng(0)
+    a = rng.standard_normal((6, 6))
+    hessian = a @ a.T + 6. * np.eye(6)
+    lbfgs = memory_method(ProjLbfgsDefn, n=6, lbfgs_num=3, curvature_eps=1e-10)
+    pairs = []
+    for _ in range(5):
+        s = rng.standard_normal(6)
+        pairs.append((s, hessian @ s))
+        lbfgs.update_memory(*pairs[-1])
+    # the BFGS update of the scaled identity with the 3 most recent pairs, from the oldest
+    s, y = pairs[-1]
+    inverse = (s @ y) / (y @ y) * np.eye(6)
+    for s, y in pairs[-3:]:
+        rho = 1. / (s @ y)
+        v = np.eye(6) - rho * np.outer(y, s)
+        inverse = v.T @ inverse @ v + rho * np.outer(s, s)
+    g = rng.standard_normal(6)
+    np.testing.assert_allclose(lbfgs.apply_inverse_hessian(g), inverse @ g)
+
+
+def test_cg_restart():
+    cg = memory_method(ProjCgDefn, cg_restart=3)
+    cg.g = np.array([1., -2., 0.5, 0.])
+    cg.d_prev = np.array([-1., 1., 0., 1.])
+    cg.beta = 0.5
+    cg.iter0 = 2
+    np.testing.assert_allclose(cg.search_direction(), -cg.g + 0.5 * np.array([-1., 1., 0., 1.]))
+    # every cg_restart iterations, the direction is the projected gradient
+    cg.iter0 = 3
+    np.testing.assert_allclose(cg.search_direction(), -cg.g)
+    np.testing.assert_allclose(cg.d_prev, -cg.g)
+    # a conjugate direction which is not descent falls back to the projected gradient
+    cg.iter0 = 4
+    cg.d_prev = 10. * cg.g
+    np.testing.assert_allclose(cg.search_direction(), -cg.g)
+
+
+def test_lbfgs_memory_checkpoint(toy_process):
+    process = search_process(toy_process)
+    lbfgs = memory_method(ProjLbfgsDefn, lbfgs_num=3, curvature_eps=1e-10, iter0=2, mpi_comm=process.mpi_comm,
+                          storage_dtype=None, storage_compression=None, storage_scaleoffset=None, surrogate=False,
+                          surrogate_num=5, surrogate_radius=None)
+    lbfgs.u_pert_best = lbfgs.u_pert.copy()
+    lbfgs.g = np.array([1., -2., 0.5, 0.])
+    lbfgs.init_surrogate()
+    for k in range(4):
+        lbfgs.update_memory(np.eye(4)[k] + 0.1, np.eye(4)[k] * (k + 1.))
+    lbfgs.save(process)
+    # the next job loads the memory from the checkpoint
+    resumed = ProjLbfgsDefn.__new__(ProjLbfgsDefn)
+    resumed.mpi_comm = process.mpi_comm
+    load_checkpoint(os.path.join(process.base_dir, "ToyProcess_checkpoint_0002.h5"), "method", resumed)
+    resumed.restore_vectors()
+    assert resumed.hist_count == lbfgs.hist_count
+    np.testing.assert_array_equal(resumed.s_hist, lbfgs.s_hist)
+    np.testing.assert_array_equal(resumed.y_hist, lbfgs.y_hist)
+    np.testing.assert_array_equal(resumed.apply_inverse_hessian(resumed.g), lbfgs.apply_inverse_hessian(lbfgs.g))
+
+
+def test_cg_restart_from_checkpoint(toy_process):
+    process = search_process(toy_process)
+    u_pert = 1e-2 * np.sin(np.linspace(0., 3. * np.pi, process.u0.size))
+    full = ProjCgDefn(process, u_pert, 1., 1e-2, grad_epsilon=1e-7, max_iter=3, eps=0.)
+    # the job is interrupted after iteration 2, and the next job resumes from its checkpoint
+    process.restart = True
+    process.restart_checkpoint_fn = os.path.join(process.base_dir, "ToyProcess_checkpoint_0002.h5")
+    resumed = ProjCgDefn(process, u_pert, 1., 1e-2, grad_epsilon=1e-7, max_iter=3, eps=0.)
+    assert resumed.iter0 == full.iter0
+    for name in ["d_prev", "beta", "u_pert", "g", "lambda_"]:
+        np.testing.assert_allclose(getattr(resumed, name), getattr(full, name), rtol=1e-12)
@@ -0,0 +1,59 @@
+import numpy as np
+from continuation import ContinuationDefn
+from cnop_methods import Spg2Defn
+from solvers.burgers_nd import BurgersNd
+
+
+class CountingBurgersNd(BurgersNd):
+    # the perturbed runs of all the search processes (shallow copies) are counted in the list of the class
+    perturbed_runs = []
+
+    def proceed(self, t1, u_pert=None, fork_id=None):
+        if u_pert is not None:
+            self.perturbed_runs.append(np.array(u_pert))
+        return super().proceed(t1, u_pert=u_pert, fork_id=fork_id)
+
+
+class RecordingSpg2Defn(Spg2Defn):
+    starts = []
+
+    def __init__(self, process, u_pert, t1, pert_delta, **kwargs):
+        self.starts.append((pert_delta, u_pert.copy()))
+        super().__init__(process, u_pert, t1, pert_delta, **kwargs)
+
+
+def continuation(base_dir, pert_deltas, method=Spg2Defn):
+    n = 8
+    x = np.sin(np.pi * np.arange(n) / (n - 1))
+    process = CountingBurgersNd(np.outer(x, x), 1., serial=True, base_dir=str(base_dir))
+    u_pert = np.array(process.generate_u_pert(1e-3, seed=0))
+    n_runs = len(CountingBurgersNd.perturbed_runs)
+    result = ContinuationDefn(process, u_pert, 1., pert_deltas, method=method, results_fn=str(base_dir / "results.npz"),
+                              grad_epsilon=1e-6, max_iter=2)
+    return result, len(CountingBurgersNd.perturbed_runs) - n_runs
+
+
+def test_warm_start(tmp_path):
+    RecordingSpg2Defn.starts.clear()
+    result, _ = continuation(tmp_path, [1e-3, 2e-3, 4e-3], method=RecordingSpg2Defn)
+    assert [pert_delta for pert_delta, _ in RecordingSpg2Defn.starts] == [1e-3, 2e-3, 4e-3]
+    # each bound starts from the optimum of the previous one, rescaled to the new bound
+    for i in range(1, 3):
+        np.testing.assert_allclose(RecordingSpg2Defn.starts[i][1], 2. * result.u_pert_bests[i - 1])
+    saved = np.load(str(tmp_path / "results.npz"))
+    np.testing.assert_array_equal(saved["j_bests"], result.j_bests)
+    np.testing.assert_array_equal(saved["u_pert_bests"], result.u_pert_bests)
+    assert (result.iterations == 3).all()
+
+
+def test_resume(tmp_path):
+    (tmp_path / "full").mkdir()
+    (tmp_path / "resumed").mkdir()
+    full, full_runs = continuation(tmp_path / "full", [1e-3, 2e-3])
+    # the job stops after the first bound, and the next job resumes the sequence from the checkpoints
+    first, first_runs = continuation(tmp_path / "resumed", [1e-3])
+    resumed, resumed_runs = continuation(tmp_path / "resumed", [1e-3, 2e-3])
+    assert first_runs + resumed_runs == full_runs
+    np.testing.assert_allclose(resumed.j_bests, full.j_bests, rtol=1e-12)
+    np.testing.assert_allclose(resumed.u_pert_bests, full.u_pert_bests, rtol=1e-12)
+    np.testing.assert_array_equal(resumed.iterations, full.iterations)
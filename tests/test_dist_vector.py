@@ -0,0 +1,61 @@
+import numpy as np
+from cnop_methods import Spg2Defn
+from dist_vector import DistVector, partition
+from serial_mpi import SerialMPI
+from utils import do_projection
+
+
+def test_partition():
+    counts, displs = partition(10, 3)
+    np.testing.assert_array_equal(counts, [4, 3, 3])
+    np.testing.assert_array_equal(displs, [0, 4, 7])
+    assert [len(part) for part in np.array_split(np.arange(10), 3)] == list(counts)
+
+
+def test_arithmetic_matches_dense():
+    comm = SerialMPI.COMM_WORLD
+    rng = np.random.default_rng(0)
+    a, b = rng.standard_normal((2, 3, 4))
+    da, db = DistVector.from_global(comm, a), DistVector.from_global(comm, b)
+    assert da.shape == a.shape
+    assert da.size == a.size
+    for dist, dense in [(da + db, a + b), (da - 2., a - 2.), (1. - da, 1. - a), (da * db, a * b),
+                        (np.float64(3.) * da, 3. * a), (da / db, a / b), (da ** 2., a ** 2.), (-da, -a),
+                        (abs(da), abs(a)), (da - 0.5 * db, a - 0.5 * b)]:
+        np.testing.assert_allclose(dist.gather(), dense)
+        np.testing.assert_allclose(dist.allgather(), dense)
+    np.testing.assert_allclose((da * db).sum(), (a * b).sum())
+    assert da.max() == a.max()
+    assert da.min() == a.min()
+    np.testing.assert_allclose(do_projection(da, 0.1, None).gather(), do_projection(a, 0.1, None))
+
+
+def test_batch_matches_dense():
+    comm = SerialMPI.COMM_WORLD
+    a = np.arange(12.).reshape(3, 4)
+    batch = DistVector.from_global(comm, np.zeros(a.shape)).zeros_batch(2)
+    assert batch.shape == (2, 3, 4)
+    batch[1] = DistVector.from_global(comm, a)
+    np.testing.assert_allclose(batch[1].gather(), a)
+    np.testing.assert_allclose(batch.gather(), np.array([np.zeros(a.shape), a]))
+    # an empty batch keeps its layout
+    empty = DistVector.from_global(comm, np.zeros((0, 3, 4)), batch_ndim=1)
+    assert empty.shape == (0, 3, 4)
+
+
+def test_distributed_search_matches_dense(tmp_path):
+    from conftest import ToyProcess
+
+    u_pert = 1e-2 * np.sin(np.linspace(0., 3. * np.pi, 32))
+    results = []
+    for distributed in [False, True]:
+        process = ToyProcess(str(tmp_path / str(distributed)))
+        process.base_dir = process.mpi_root_dir
+        process.restart = False
+        (tmp_path / str(distributed)).mkdir()
+        results.append(Spg2Defn(process, u_pert, 1., 1e-2, grad_epsilon=1e-7, max_iter=3, distributed=distributed))
+    dense, dist = results
+    assert isinstance(dist.u_pert, DistVector)
+    np.testing.assert_allclose(dist.u_pert_best, dense.u_pert_best, rtol=1e-12)
+    np.testing.assert_allclose(dist.j_best, dense.j_best, rtol=1e-12)
+    assert dist.ifcnt == dense.ifcnt
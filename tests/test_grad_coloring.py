@@ -0,0 +1,19 @@
+import numpy as np
+from grad_coloring import estimate_influence_radius, grad_colored
+from grad_defn import grad_defn
+
+
+def test_influence_radius(toy_process):
+    u_pert = np.full(toy_process.u0.shape, 1e-3)
+    # each step of the solver reaches one more cell
+    assert estimate_influence_radius(toy_process, u_pert, 1., 1e-6, margin=0) == toy_process.n_steps
+    assert estimate_influence_radius(toy_process, u_pert, 1., 1e-6) == toy_process.n_steps + 1
+
+
+def test_colored_gradient_matches_grad_defn(toy_process):
+    u_pert = 1e-2 * np.random.default_rng(0).standard_normal(toy_process.u0.shape)
+    radius = estimate_influence_radius(toy_process, u_pert, 1., 1e-6)
+    g_colored = grad_colored(toy_process, u_pert, 1., 1e-6, radius)
+    g = grad_defn(toy_process, u_pert, 1., 1e-6, iter0=0)
+    assert 2 * radius + 1 < u_pert.size
+    np.testing.assert_allclose(g_colored, g, rtol=1e-6, atol=1e-9 * np.abs(g).max())
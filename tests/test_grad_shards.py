@@ -0,0 +1,40 @@
+import numpy as np
+from grad_shards import GradShardWriter, load_grad_shards, shard_fn, shard_counts
+
+
+def test_resume_after_torn_write(tmp_path):
+    tmp_dir = str(tmp_path)
+    writer = GradShardWriter(tmp_dir, 0, 0)
+    writer.append(1, 0.5)
+    writer.append(3, -1.5)
+    writer.file.close()
+    # the run is killed in the middle of the third record
+    with open(shard_fn(tmp_dir, 0, 0), "ab") as f:
+        f.write(b"\x07" * 5)
+
+    writer = GradShardWriter(tmp_dir, 0, 0)
+    writer.append(4, 2.5)
+    writer.append(0, 3.5)
+    writer.close()
+
+    done, values = load_grad_shards(tmp_dir, 0, 6)
+    np.testing.assert_array_equal(done, [True, True, False, True, True, False])
+    np.testing.assert_array_equal(values, [3.5, 0.5, 0., -1.5, 2.5, 0.])
+    assert shard_counts(tmp_dir, 0, 1)[0] == 4
+
+
+def test_resume_after_torn_write_with_horizons(tmp_path):
+    tmp_dir = str(tmp_path)
+    writer = GradShardWriter(tmp_dir, 2, 1, storage_dtype="float32", value_shape=(2,))
+    writer.append(2, [1., 2.])
+    writer.file.close()
+    with open(shard_fn(tmp_dir, 2, 1), "ab") as f:
+        f.write(b"\x01" * 3)
+
+    writer = GradShardWriter(tmp_dir, 2, 1, storage_dtype="float32", value_shape=(2,))
+    writer.append(0, [3., 4.])
+    writer.close()
+
+    done, values = load_grad_shards(tmp_dir, 2, 3, storage_dtype="float32", value_shape=(2,))
+    np.testing.assert_array_equal(done, [True, False, True])
+    np.testing.assert_array_equal(values, [[3., 4.], [0., 0.], [1., 2.]])
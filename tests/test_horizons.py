@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from cnop_methods import Spg2Defn
+from solvers.burgers_nd import BurgersNd
+from utils import compute_obj
+
+
+def burgers_nd(tmp_path, n=10):
+    x = np.sin(np.pi * np.arange(n) / (n - 1))
+    return BurgersNd(np.outer(x, x), 1., serial=True, base_dir=str(tmp_path))
+
+
+def test_proceed_horizons_matches_separate_runs(tmp_path):
+    process = burgers_nd(tmp_path)
+    horizons = [0.5, 2., 1.]
+    u_pert = process.generate_u_pert(1e-2, seed=0)
+    uts = process.proceed(horizons, u_pert=u_pert)
+    uts_unperturbed = process.proceed(horizons)
+    assert uts.shape == (3, process.u0.size)
+    for t1, ut, ut_unperturbed in zip(horizons, uts, uts_unperturbed):
+        np.testing.assert_allclose(ut, process.proceed(t1, u_pert=u_pert), rtol=1e-12)
+        np.testing.assert_allclose(ut_unperturbed, process.proceed(t1), rtol=1e-12)
+    # the unperturbed solutions are kept per horizon
+    assert sorted(process.horizon_nts) == sorted([int(t / process.delta_t + 1) for t in horizons])
+    np.testing.assert_array_equal(process.proceed([2., 0.5]), uts_unperturbed[[1, 0]])
+    # a batch of perturbations has the horizons after the batch axis
+    batch = np.array([u_pert, 2. * u_pert])
+    np.testing.assert_allclose(process.proceed(horizons, u_pert=batch)[1],
+                               process.proceed(horizons, u_pert=2. * u_pert), rtol=1e-12)
+
+
+def test_horizon_objectives(tmp_path):
+    process = burgers_nd(tmp_path)
+    horizons = [1., 2.]
+    u_pert = np.array(process.generate_u_pert(1e-2, seed=0))
+    spg2 = Spg2Defn(process, u_pert, horizons, 1e-2, grad_epsilon=1e-6, max_iter=0, eps=1e3,
+                    horizon_weights=[0.25, 0.75])
+    # the objectives of all horizons are evaluated by the same runs as separate objectives
+    j_separate = np.array([compute_obj(process, spg2.u_pert, t1) for t1 in horizons])
+    np.testing.assert_allclose(spg2.j_horizons, j_separate.ravel(), rtol=1e-10)
+    np.testing.assert_allclose(spg2.j_val, (np.array([0.25, 0.75]) * j_separate.ravel()).sum(), rtol=1e-10)
+
+
+def test_horizon_options(tmp_path):
+    process = burgers_nd(tmp_path)
+    u_pert = np.zeros(process.u0.shape)
+    with pytest.raises(ValueError):
+        Spg2Defn(process, u_pert, [1., 2.], 1e-2, horizon_weights=[1.])
+    with pytest.raises(ValueError):
+        Spg2Defn(process, u_pert, [1., 2.], 1e-2, secant_gradient=True)
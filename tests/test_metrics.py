@@ -0,0 +1,52 @@
+import json
+import numpy as np
+import pytest
+from grad_defn import grad_defn, grad_tmp_dir
+from grad_shards import failure_counts, record_failure
+from metrics import update_metrics
+
+
+def test_json_null_for_inf_and_nan(tmp_path):
+    metrics_fn = str(tmp_path / "metrics.json")
+    update_metrics(metrics_fn, "method", {"eta": np.inf, "iteration_time": np.nan, "j_best": np.squeeze([-2.]),
+                                          "rank_throughput": np.array([1., np.inf])})
+    with open(metrics_fn) as f:
+        method = json.load(f)["method"]
+    assert method["eta"] is None
+    assert method["iteration_time"] is None
+    assert method["j_best"] == -2.
+    assert method["rank_throughput"] == [1., None]
+
+
+def test_failed_runs_are_counted(toy_process, tmp_path):
+    metrics_fn = str(tmp_path / "metrics.json")
+    proceed = toy_process.proceed
+
+    def failing_proceed(t1, u_pert=None, fork_id=None):
+        # the reference runs and two gradient runs succeed
+        if toy_process.n_runs == 4:
+            raise RuntimeError("The simulation is not finished!")
+        return proceed(t1, u_pert=u_pert, fork_id=fork_id)
+
+    toy_process.proceed = failing_proceed
+    u_pert = np.full(toy_process.u0.shape, 1e-3)
+    with pytest.raises(RuntimeError):
+        grad_defn(toy_process, u_pert, 1., 1e-6, iter0=0, metrics_fn=metrics_fn)
+    with open(metrics_fn) as f:
+        gradient = json.load(f)["gradient"]
+    assert gradient["failed_runs"] == 1
+    assert gradient["timed_out_runs"] == 0
+
+    # the job is restarted: the failure is kept until the gradient is finished, and the computed indices are loaded
+    toy_process.proceed = proceed
+    record_failure(grad_tmp_dir(toy_process), 0, 1, "timed_out")
+    prom_fn = str(tmp_path / "metrics.prom")
+    update_metrics(prom_fn, "gradient", {"failed_runs": 0})
+    g = grad_defn(toy_process, u_pert, 1., 1e-6, iter0=0, metrics_fn=prom_fn)
+    with open(prom_fn) as f:
+        lines = f.read().splitlines()
+    assert "cnop_gradient_failed_runs 1.0" in lines
+    assert "cnop_gradient_timed_out_runs 1.0" in lines
+    assert "cnop_gradient_n_loaded 2.0" in lines
+    assert failure_counts(grad_tmp_dir(toy_process), 0) == {"failed": 0, "timed_out": 0}
+    assert g.shape == u_pert.shape
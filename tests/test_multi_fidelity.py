@@ -0,0 +1,80 @@
+import numpy as np
+from cnop_methods import Spg2Defn
+from solvers.simulation import Simulation
+from utils import restrict_field
+from conftest import ToyProcess
+
+
+class ToyLadderProcess(ToyProcess):
+    # the toy solver with one coarse level at half the resolution, and the reference bookkeeping of Simulation
+    set_fidelity = Simulation.set_fidelity
+    fidelity_factor = Simulation.fidelity_factor
+    unperturbed_suffix = Simulation.unperturbed_suffix
+
+    def __init__(self, root_dir):
+        super().__init__(root_dir)
+        self.base_dir = root_dir
+        self.restart = False
+        self.fidelity_ladder = [{"factor": 2, "params": {}}]
+        self.fidelity_level = 1
+        self.fidelity_references = {}
+        self.t1 = None
+        self.ut1_unperturbed_fn = None
+        self.horizon_t1s = []
+        self.horizon_ut_fns = []
+        # the kept unperturbed solutions by file name, and the number of reference runs per level
+        self.mpi_outputs = {}
+        self.reference_runs = [0, 0]
+
+    def proceed(self, t1, u_pert=None, fork_id=None):
+        u0 = self.u0
+        self.u0 = restrict_field(u0, self.fidelity_factor())
+        try:
+            if u_pert is not None:
+                return super().proceed(t1, u_pert=u_pert, fork_id=fork_id)
+            if self.ut1_unperturbed_fn is not None and self.t1 == t1:
+                return self.mpi_outputs[self.ut1_unperturbed_fn]
+            self.reference_runs[self.fidelity_level] += 1
+            self.ut1_unperturbed_fn = "ut" + self.unperturbed_suffix()
+            self.t1 = t1
+            self.mpi_outputs[self.ut1_unperturbed_fn] = super().proceed(t1)
+            return self.mpi_outputs[self.ut1_unperturbed_fn]
+        finally:
+            self.u0 = u0
+
+
+def test_references_are_kept_per_level(tmp_path):
+    process = ToyLadderProcess(str(tmp_path))
+    u_pert = 1e-2 * np.sin(np.linspace(0., 3. * np.pi, process.u0.size))
+    # the levels always agree, so that the coarse level is kept after each check until it has converged
+    spg2 = Spg2Defn(process, u_pert, 1., 1e-2, grad_epsilon=1e-7, max_iter=8, multi_fidelity=True,
+                    fidelity_rtol=0.9, fidelity_agreement=-1.)
+    assert spg2.igcnt > 3
+    # the reference of each level is run once, however many times the finer level was checked
+    assert process.reference_runs[0] == 1
+    assert process.reference_runs[1] == 1
+    assert sorted(process.mpi_outputs) == ["ut_level_0_unperturbed", "ut_unperturbed"]
+
+
+def test_switch_to_the_finer_level(tmp_path):
+    process = ToyLadderProcess(str(tmp_path))
+    u_pert = 1e-2 * np.sin(np.linspace(0., 3. * np.pi, process.u0.size))
+    # the levels never agree, so that the first check switches to the full resolution
+    spg2 = Spg2Defn(process, u_pert, 1., 1e-2, grad_epsilon=1e-7, max_iter=3, multi_fidelity=True,
+                    fidelity_rtol=0.9, fidelity_agreement=2.)
+    assert spg2.fidelity_level == 1
+    assert process.fidelity_level == 1
+    assert process.reference_runs == [1, 1]
+    assert spg2.u_pert.shape == process.u0.shape
+
+
+def test_restrict_adjoint(tmp_path):
+    process = ToyLadderProcess(str(tmp_path))
+    spg2 = Spg2Defn(process, np.zeros(process.u0.shape), 1., 1e-2, grad_epsilon=1e-7, max_iter=0,
+                    multi_fidelity=True)
+    process.set_fidelity(0)
+    rng = np.random.default_rng(0)
+    u = rng.standard_normal(process.u0.shape)
+    g = rng.standard_normal(process.u0.size // 2)
+    # <R u, g> = <u, R^T g>
+    np.testing.assert_allclose((spg2.restrict(process, u) * g).sum(), (u * spg2.restrict_adjoint(process, g)).sum())
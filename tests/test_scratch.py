@@ -0,0 +1,61 @@
+import os
+from serial_mpi import SerialMPI
+from solvers.simulation import Simulation
+
+
+def test_stage_and_cleanup_scratch_with_spaces(tmp_path):
+    base_dir = tmp_path / "base dir"
+    (base_dir / "tables dir").mkdir(parents=True)
+    (base_dir / "flash4").write_text("binary")
+    (base_dir / "tables dir" / "helm table.dat").write_text("table")
+    sim = Simulation.__new__(Simulation)
+    sim.mpi = SerialMPI
+    sim.mpi_comm = SerialMPI.COMM_WORLD
+    sim.mpi_node_comms = None
+    sim.base_dir = str(base_dir)
+    sim.scratch_dir = str(tmp_path / "scratch dir")
+    sim.link_list = ["tables dir"]
+    sim.copy_list = ["flash4"]
+
+    sim.stage_scratch()
+    scratch_base_dir = sim.fork_root_dir()
+    assert scratch_base_dir.startswith(sim.scratch_dir)
+    assert open(os.path.join(scratch_base_dir, "tables dir", "helm table.dat")).read() == "table"
+    assert open(os.path.join(scratch_base_dir, "flash4")).read() == "binary"
+
+    sim.cleanup_scratch()
+    assert not os.path.exists(scratch_base_dir)
+    assert sim.fork_root_dir() == sim.base_dir
+    # a second cleanup, e.g., by a driver after its searches, does nothing
+    sim.cleanup_scratch()
+
+
+def test_fork_dir_with_spaces(tmp_path):
+    base_dir = tmp_path / "base dir"
+    (base_dir / "tables dir").mkdir(parents=True)
+    (base_dir / "flash4").write_text("binary")
+    (base_dir / "flash.par").write_text("params")
+    # a sibling which an unquoted "rm -rf <fork_dir>/*" would remove
+    (tmp_path / "base").mkdir()
+    (tmp_path / "base" / "keep.txt").write_text("keep")
+    sim = Simulation.__new__(Simulation)
+    sim.base_dir = str(base_dir)
+    sim.scratch_base_dir = None
+    sim.link_list = ["tables dir", "flash4"]
+    sim.copy_list = ["flash.par"]
+
+    fork_dir = str(base_dir / "fork 1")
+    sim.make_fork_dir(fork_dir)
+    assert os.path.islink(os.path.join(fork_dir, "tables dir"))
+    assert open(os.path.join(fork_dir, "flash4")).read() == "binary"
+    assert open(os.path.join(fork_dir, "flash.par")).read() == "params"
+
+    # the outputs of a run are removed when the fork_dir is made again, but not the inputs it links to
+    os.mkdir(os.path.join(fork_dir, "out dir"))
+    open(os.path.join(fork_dir, "out dir", "chk_0001"), "w").close()
+    sim.make_fork_dir(fork_dir)
+    assert sorted(os.listdir(fork_dir)) == ["flash.par", "flash4", "tables dir"]
+    assert os.path.exists(base_dir / "tables dir")
+    assert Simulation.cleanup_fork_dir(fork_dir)
+    assert os.listdir(fork_dir) == []
+    assert (tmp_path / "base" / "keep.txt").exists()
@@ -0,0 +1,63 @@
+import numpy as np
+from cnop_methods import CnopMethod, Spg2Defn
+from grad_defn import grad_defn
+from utils import compute_obj
+
+
+def search_process(process):
+    process.base_dir = process.mpi_root_dir
+    process.restart = False
+    return process
+
+
+def test_secant_correction():
+    rng = np.random.default_rng(0)
+    g = rng.standard_normal(8)
+    directions = list(rng.standard_normal((3, 8)))
+    derivatives = rng.standard_normal(3)
+    g_new = CnopMethod.secant_correction(g, directions, derivatives)
+    # the secant conditions hold, and the correction is in the span of the directions (the smallest one)
+    np.testing.assert_allclose([(g_new * v).sum() for v in directions], derivatives)
+    coeffs = np.linalg.lstsq(np.array(directions).T, g_new - g, rcond=None)[0]
+    np.testing.assert_allclose(np.array(directions).T @ coeffs, g_new - g, atol=1e-12)
+
+
+def test_secant_grad(toy_process):
+    process = search_process(toy_process)
+    u_pert = 1e-2 * np.sin(np.linspace(0., 3. * np.pi, process.u0.size))
+    spg2 = Spg2Defn(process, u_pert, 1., 1e-2, grad_epsilon=1e-7, max_iter=0, eps=1e3, secant_gradient=True,
+                    secant_probes=2, secant_rtol=1.)
+    s = 1e-3 * np.cos(np.linspace(0., 2. * np.pi, process.u0.size))
+    u_pert_new = spg2.u_pert + s
+    j_new = compute_obj(process, u_pert_new, 1.)
+    n_runs = process.n_runs
+    g_new = spg2.secant_grad(process, u_pert_new, j_new, s, 1.)
+    # one reference run and one run per direction, instead of one run per cell
+    assert process.n_runs - n_runs == 1 + 1 + spg2.secant_probes
+    g_true = grad_defn(process, u_pert_new, 1., 1e-7)
+    s_unit = s / abs(s).max()
+    np.testing.assert_allclose((g_new * s_unit).sum(), (g_true * s_unit).sum(), rtol=1e-3)
+    assert np.linalg.norm(g_new - g_true) < np.linalg.norm(spg2.g - g_true)
+
+    # the estimate is rejected if the held-out probe does not match
+    spg2.secant_rtol = 0.
+    assert spg2.secant_grad(process, u_pert_new, j_new, s, 1.) is None
+
+
+def test_secant_search(tmp_path):
+    from conftest import ToyProcess
+
+    u_pert = 1e-2 * np.sin(np.linspace(0., 3. * np.pi, 32))
+    results = []
+    for secant_gradient in [False, True]:
+        (tmp_path / str(secant_gradient)).mkdir()
+        process = search_process(ToyProcess(str(tmp_path / str(secant_gradient))))
+        spg2 = Spg2Defn(process, u_pert, 1., 1e-2, grad_epsilon=1e-7, max_iter=4, secant_gradient=True,
+                        secant_refresh=3, secant_rtol=0.5) if secant_gradient else \
+            Spg2Defn(process, u_pert, 1., 1e-2, grad_epsilon=1e-7, max_iter=4)
+        results.append((spg2, process.n_runs))
+    (full, full_runs), (secant, secant_runs) = results
+    assert secant.iscnt > 0
+    assert secant.igcnt + secant.iscnt == full.igcnt
+    assert secant_runs < full_runs
+    assert secant.j_best < secant.j_best_history[0]
@@ -0,0 +1,12 @@
+import pytest
+from sim_controller import find_latest_checkpoint
+
+
+def test_find_latest_checkpoint_skips_search_checkpoints(tmp_path):
+    for fn in ["Burgers_checkpoint_0002.h5", "Burgers_checkpoint_0010.h5", "Burgers_checkpoint_search_1_0042.h5"]:
+        (tmp_path / fn).touch()
+    assert find_latest_checkpoint(str(tmp_path), "Burgers_checkpoint").endswith("Burgers_checkpoint_0010.h5")
+    assert find_latest_checkpoint(str(tmp_path), "Burgers_checkpoint_search_1").endswith(
+        "Burgers_checkpoint_search_1_0042.h5")
+    with pytest.raises(FileNotFoundError):
+        find_latest_checkpoint(str(tmp_path), "Burgers_checkpoint_search_0")
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from singular_vectors import SingularVectorDefn
+from solvers.burgers_nd import BurgersNd
+from conftest import ToyProcess
+
+
+def exact_singular_values(process, t1, epsilon, mask):
+    # the SVD of the full finite-difference Jacobian, one run per cell of mask
+    ut = process.proceed(t1)
+    columns = []
+    for i in np.flatnonzero(mask):
+        u_pert_eps = np.zeros(mask.shape)
+        u_pert_eps.flat[i] = epsilon
+        columns.append((process.proceed(t1, u_pert=u_pert_eps) - ut) / epsilon)
+    return np.linalg.svd(np.array(columns).T, compute_uv=False)
+
+
+def test_power_iterations_must_not_be_negative(toy_process):
+    with pytest.raises(ValueError):
+        SingularVectorDefn(toy_process, np.zeros(toy_process.u0.shape), 1., 2, power_iterations=-1)
+    assert toy_process.n_runs == 0
+
+
+def test_growth_rates_match_the_exact_jacobian(tmp_path):
+    # enough diffusion steps for a decaying spectrum
+    toy_process = ToyProcess(str(tmp_path), n_steps=8)
+    mask = np.ones(toy_process.u0.shape, dtype=bool)
+    s = exact_singular_values(toy_process, 1., 1e-7, mask)
+    svd = SingularVectorDefn(toy_process, np.zeros(mask.shape), 1., 2, epsilon=1e-7, power_iterations=3)
+    np.testing.assert_allclose(svd.growth_rates, s[:2], rtol=1e-3)
+    # the modes are orthonormal, and the growth rates are the norms of their images
+    np.testing.assert_allclose(svd.modes.reshape(2, -1) @ svd.modes.reshape(2, -1).T, np.eye(2), atol=1e-8)
+    ut = toy_process.proceed(1.)
+    for mode, growth_rate in zip(svd.modes, svd.growth_rates):
+        image = SingularVectorDefn.apply_jacobian(toy_process, mode, 1., ut, 1e-7)
+        np.testing.assert_allclose(np.sqrt((image ** 2).sum()), growth_rate, rtol=1e-3)
+
+    # the colored products with J^T give the same modes in fewer runs
+    colored = SingularVectorDefn(toy_process, np.zeros(mask.shape), 1., 2, epsilon=1e-7, power_iterations=3,
+                                 influence_radius=toy_process.n_steps + 1)
+    np.testing.assert_allclose(colored.growth_rates, svd.growth_rates, rtol=1e-6)
+    assert colored.n_runs < svd.n_runs
+
+
+def test_burgers_nd_with_pert_mask(tmp_path):
+    n = 10
+    x = np.sin(np.pi * np.arange(n) / (n - 1))
+    process = BurgersNd(np.outer(x, x), 1., serial=True, base_dir=str(tmp_path))
+    mask = np.zeros((n, n), dtype=bool)
+    mask[1:-1, 1:-1] = True
+    s = exact_singular_values(process, 3., 1e-6, mask)
+    svd = SingularVectorDefn(process, process.generate_u_pert(1e-3, seed=0), 3., 2, epsilon=1e-6,
+                             power_iterations=2, pert_mask=mask)
+    np.testing.assert_allclose(svd.growth_rates, s[:2], rtol=1e-2)
+    np.testing.assert_allclose(svd.modes[:, ~mask], 0., atol=1e-12)
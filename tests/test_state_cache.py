@@ -0,0 +1,53 @@
+import os
+import numpy as np
+import pytest
+import state_cache
+from state_cache import StateCache
+from solvers.burgers_nd import BurgersNd
+
+
+def test_store_and_fetch(tmp_path):
+    cache = StateCache(str(tmp_path / "cache"))
+    src = tmp_path / "u0.h5"
+    src.write_bytes(b"state")
+    cache.store("key", str(src))
+    dest = tmp_path / "run dir" / "u0.h5"
+    dest.parent.mkdir()
+    dest.write_bytes(b"old")
+    assert cache.fetch("key", str(dest))
+    assert dest.read_bytes() == b"state"
+    assert not cache.fetch("other", str(dest))
+
+
+def test_copy_across_filesystems(tmp_path, monkeypatch):
+    def no_link(src, dest):
+        raise OSError("Invalid cross-device link")
+
+    monkeypatch.setattr(state_cache.os, "link", no_link)
+    cache = StateCache(str(tmp_path / "cache"))
+    src = tmp_path / "u0.h5"
+    src.write_bytes(b"state")
+    cache.store("key", str(src))
+    assert open(cache.lookup("key"), "rb").read() == b"state"
+
+    # a failed copy raises, and leaves neither an entry nor a temporary file
+    def failing_copy(src, dest):
+        open(dest, "wb").write(b"sta")
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(state_cache.shutil, "copy2", failing_copy)
+    with pytest.raises(OSError):
+        cache.store("partial", str(src))
+    assert cache.lookup("partial") is None
+    assert sorted(os.listdir(tmp_path / "cache")) == ["key"]
+
+
+def test_burgers_nd_basic_state_is_cached(tmp_path):
+    n = 8
+    x = np.sin(np.pi * np.arange(n) / (n - 1))
+    kwargs = dict(serial=True, base_dir=str(tmp_path), cache_dir=str(tmp_path / "cache"))
+    process = BurgersNd(np.outer(x, x), 1., **kwargs)
+    assert os.listdir(tmp_path / "cache") == [process.u0_key]
+    # no temporary file is left in base_dir
+    assert sorted(os.listdir(tmp_path)) == ["cache"]
+    np.testing.assert_array_equal(BurgersNd(np.outer(x, x), 1., **kwargs).u0, process.u0)
@@ -0,0 +1,106 @@
+import numpy as np
+from cnop_methods import CnopMethod, Spg2Defn
+
+
+def model_value(b, hessian, z):
+    return b @ z + z @ hessian @ z / 2.
+
+
+def test_trust_region_step_interior():
+    hessian = np.array([[2., 0.5], [0.5, 1.]])
+    b = np.array([0.1, -0.2])
+    z = CnopMethod.trust_region_step(b, hessian, 10.)
+    np.testing.assert_allclose(z, -np.linalg.solve(hessian, b))
+
+
+def test_trust_region_step_boundary():
+    hessian = np.array([[2., 0.5], [0.5, 1.]])
+    b = np.array([3., -4.])
+    z = CnopMethod.trust_region_step(b, hessian, 0.5)
+    np.testing.assert_allclose(np.linalg.norm(z), 0.5)
+    # (hessian + mu I) z = -b with mu >= 0
+    mu = -((hessian @ z + b) / z).mean()
+    assert mu >= 0
+    np.testing.assert_allclose(hessian @ z + mu * z, -b, atol=1e-8)
+    angles = np.linspace(0., 2. * np.pi, 3601)
+    boundary = 0.5 * np.array([np.cos(angles), np.sin(angles)]).T
+    assert model_value(b, hessian, z) <= min([model_value(b, hessian, y) for y in boundary]) + 1e-8
+
+
+def test_trust_region_step_indefinite():
+    hessian = np.array([[1., 0.], [0., -2.]])
+    b = np.array([0.5, 0.1])
+    z = CnopMethod.trust_region_step(b, hessian, 1.)
+    # the minimizer is on the boundary, mostly along the direction of negative curvature
+    np.testing.assert_allclose(np.linalg.norm(z), 1.)
+    assert abs(z[1]) > abs(z[0])
+    angles = np.linspace(0., 2. * np.pi, 3601)
+    boundary = np.array([np.cos(angles), np.sin(angles)]).T
+    assert model_value(b, hessian, z) <= min([model_value(b, hessian, y) for y in boundary]) + 1e-8
+
+
+def trust_method(predicted_j):
+    # a method at u_pert = 0 with j_val = 0, whose model predicts predicted_j everywhere
+    method = Spg2Defn.__new__(Spg2Defn)
+    method.u_pert = np.zeros(4)
+    method.j_val = 0.
+    method.pert_mask = None
+    method.pert_delta = 1.
+    method.surrogate_delta = 0.5
+    method.surrogate_predict = lambda model, u_pert_new: predicted_j
+    return method
+
+
+def test_update_trust_radius():
+    step = np.full(4, 0.1)
+    for j_new, radius in [(-0.9, 1.), (-0.5, 0.5), (-0.1, 0.25), (0.3, 0.25)]:
+        # the ratio of the actual to the predicted reduction 1 is j_new / -1
+        method = trust_method(-1.)
+        method.update_trust_radius({}, step, j_new)
+        assert method.surrogate_delta == radius
+    # the radius is at most the diameter of the feasible set
+    method = trust_method(-1.)
+    method.surrogate_delta = 1.5
+    method.update_trust_radius({}, step, -1.)
+    assert method.surrogate_delta == 2.
+    # no update without a model, outside of the trust region, or without a predicted reduction
+    method = trust_method(-1.)
+    method.update_trust_radius(None, step, -1.)
+    method.update_trust_radius({}, np.full(4, 0.6), -1.)
+    assert method.surrogate_delta == 0.5
+    method = trust_method(1.)
+    method.update_trust_radius({}, step, -1.)
+    assert method.surrogate_delta == 0.5
+
+
+def test_screened_trial_is_not_run(toy_process):
+    toy_process.base_dir = toy_process.mpi_root_dir
+    toy_process.restart = False
+    u_pert = 1e-2 * np.sin(np.linspace(0., 3. * np.pi, toy_process.u0.size))
+    spg2 = Spg2Defn(toy_process, u_pert, 1., 1e-2, grad_epsilon=1e-7, max_iter=0, surrogate=True)
+    d = -1e-3 * spg2.g / np.abs(spg2.g).max()
+    gtd = (spg2.g * d).sum()
+    j_max = spg2.j_values.max()
+    spg2.surrogate_delta = 1.
+    spg2.fit_surrogate = lambda: {}
+    spg2.surrogate_trial = lambda *args: (None, None)
+
+    def surrogate_predict(model, u_pert_new):
+        # the model predicts the first trial (alpha = 1) to fail, and the shorter ones to pass
+        alpha = ((u_pert_new - spg2.u_pert) * d).sum() / (d * d).sum()
+        return np.squeeze(spg2.j_val) + 1. if alpha > 0.99 else j_max - 1.
+
+    spg2.surrogate_predict = surrogate_predict
+    runs = []
+    proceed = toy_process.proceed
+    toy_process.proceed = lambda t1, u_pert=None, fork_id=None: (
+        runs.append(None if u_pert is None else u_pert.copy()), proceed(t1, u_pert=u_pert, fork_id=fork_id))[1]
+    skips = spg2.surrogate_skips
+    u_pert_new, j_new = spg2.line_search(toy_process, 1., d, gtd)
+
+    assert spg2.surrogate_skips == skips + 1
+    perturbed = [u for u in runs if u is not None]
+    assert len(perturbed) > 0
+    assert not any([np.allclose(u, spg2.u_pert + d) for u in perturbed])
+    alpha = spg2.backtrack(1., surrogate_predict({}, spg2.u_pert + d), gtd)
+    np.testing.assert_allclose(perturbed[0], spg2.u_pert + alpha * d)
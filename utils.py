@@ -1,28 +1,63 @@
+import asyncio
 import numpy as np
 import os
 import time
 import sys
+from dist_vector import DistVector
 
 
 def do_projection(u, delta, mask):
     # sum u**2 * dx = sum u**2 * L * (dx / L) = sum u**2 / n * L, let L = 1
-    if mask is None:
-        mask = np.ones_like(u, dtype=bool)
-    else:
+    if mask is not None:
         if not mask.all():
             # if not all true
             raise NotImplementedError("Not sure masked projection works correctly in cnop.")
-    if not np.array_equal(u.shape, mask.shape):
-        raise ValueError("u and mask must have the same shape.")
+        if not np.array_equal(u.shape, mask.shape):
+            raise ValueError("u and mask must have the same shape.")
+    if isinstance(u, DistVector):
+        # the mask is all true, so only the global mean of u ** 2 is needed
+        mean = (u ** 2.).sum() / u.size
+        return u if np.sqrt(mean) <= delta else delta / np.sqrt(mean) * u
+    if mask is None:
+        mask = np.ones_like(u, dtype=bool)
     mean = (u[mask] ** 2.).mean()
     if np.sqrt(mean) <= delta:
         proj_u = u
     else:
-        proj_u = u
+        # do not scale u in place, since it may be a read-only (node-shared) array
+        proj_u = u.copy()
         proj_u[mask] = delta / np.sqrt(mean) * u[mask]
     return proj_u
 
 
+def restrict_field(u, factor):
+    """
+    Restrict a field to a coarser grid by averaging blocks of factor cells along each axis longer than 1
+    :param u: the field
+    :param factor: the coarsening factor, which must divide the length of these axes
+    :return: the restricted field
+    """
+    factors = [factor if n > 1 else 1 for n in u.shape]
+    if any([n % f != 0 for n, f in zip(u.shape, factors)]):
+        raise ValueError("The coarsening factor {} does not divide the shape {}.".format(factor, u.shape))
+    blocks = []
+    for n, f in zip(u.shape, factors):
+        blocks += [n // f, f]
+    return u.reshape(blocks).mean(axis=tuple(range(1, 2 * u.ndim, 2)))
+
+
+def prolong_field(u, shape):
+    """
+    Prolong a field to a finer grid with the given shape by piecewise-constant injection
+    :param u: the field
+    :param shape: the shape of the finer grid
+    :return: the prolonged field
+    """
+    for axis, n in enumerate(shape):
+        u = np.repeat(u, n // u.shape[axis], axis=axis)
+    return u
+
+
 def usphere_sample(n):
     # Generate standard normal random variables
     tmp = np.random.randn(n)
@@ -39,11 +74,24 @@ def usphere_sample(n):
     return x
 
 
+def obj_fork_id(process):
+    # concurrent searches (see multi_start.py) cannot share base_dir, so their root runs in its own fork_dir
+    if process.mpi_search_id is None:
+        return None
+    return process.mpi_fork_offset + process.mpi_rank
+
+
+def slot_fork_id(process, slot):
+    # fork_id of the slot-th concurrent run of the rank (see run_concurrently); slot 0 is the usual fork_id of the
+    # rank, and the other slots are numbered after all ranks of COMM_WORLD so that they never collide
+    return process.mpi_fork_offset + process.mpi_rank + slot * process.mpi.COMM_WORLD.Get_size()
+
+
 def compute_obj(process, u_pert, t):
-    # compute the objective value
+    # compute the objective value, or one value per horizon if t is a list of horizons (see proceed)
     ut = process.proceed(t)
-    ut_pert = process.proceed(t, u_pert=u_pert)
-    j_val = - ((ut_pert - ut) ** 2).sum()
+    ut_pert = process.proceed(t, u_pert=u_pert, fork_id=obj_fork_id(process))
+    j_val = - ((ut_pert - ut) ** 2).sum(axis=-1)
     return j_val
 
 
@@ -107,6 +155,29 @@ def wait_for_last_line(file_path, ending_remark, timeout=np.inf, poll_interval=1
     return False
 
 
+async def wait_for_file_async(file_path, timeout=60, poll_interval=1):
+    # same as wait_for_file, but other coroutines (e.g., other solver runs of the rank) proceed while polling
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        if os.path.exists(file_path):
+            return True
+        await asyncio.sleep(poll_interval)
+    return False
+
+
+async def wait_for_last_line_async(file_path, ending_remark, timeout=np.inf, poll_interval=10):
+    # same as wait_for_last_line, but other coroutines proceed while polling
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        with open(file_path, 'r') as file:
+            lines = file.readlines()
+            if len(lines) > 0:
+                if lines[-1].strip() == ending_remark:
+                    return True
+        await asyncio.sleep(poll_interval)
+    return False
+
+
 def generate_shell_wrapper(exec_command, wrapper_name, wrapper_output,
                            wrapper_path=None, ending_remark=""):
     """